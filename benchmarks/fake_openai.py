@@ -0,0 +1,148 @@
+'''A local stand-in for the OpenAI (and DeepSeek) http api, for load testing aiapi offline.
+  Serves the subset of the api the bot uses: chat completions (plain and streamed) and image
+  generation, with configurable latency, error rates and reply sizes. Nothing is validated beyond
+  what is needed to answer, and any api key is accepted.
+
+  Usage (from the repository root):
+    python -m benchmarks.fake_openai --port 8080 --latency lognormal:-0.7:0.5 --error-rate 0.05
+
+  Then point the bot at it (see aiapi.PROVIDERS):
+    AI_BASE_URL=http://127.0.0.1:8080/v1 DEEPSEEK_API_KEY=x OPENAI_API_KEY=x python3 clydebutwigglier.py
+
+  GET /stats returns the request/error counts so far, as json.'''
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+from aiohttp import web
+from benchmarks.latency import parse_latency
+
+# A 1x1 transparent png, returned by the fake image generator
+TINY_PNG = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAAC0lEQVR4nGNgAAIAAAUAAXpeqz8AAAAASUVORK5CYII='
+
+WORDS = ('wiggle', 'clyde', 'remilia', 'hello', 'yes', 'no', 'maybe', 'honestly', 'the', 'a', 'post')
+
+class FakeOpenAiServer():
+  def __init__(self, latency, token_latency, completion_tokens, error_rate=0.0, error_status=500, hang_rate=0.0):
+    self.latency = latency # time to the first token (or the whole reply when not streaming)
+    self.token_latency = token_latency # time between streamed tokens
+    self.completion_tokens = completion_tokens # length of each reply
+    self.error_rate = error_rate
+    self.error_status = error_status
+    self.hang_rate = hang_rate # requests that never get an answer (to exercise client timeouts)
+    self.stats = Counter()
+
+  def make_app(self):
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', self.chat_completions)
+    app.router.add_post('/v1/images/generations', self.image_generations)
+    app.router.add_get('/stats', self.get_stats)
+    return app
+
+  # Decide how this request goes wrong, if at all. Returns an error response or None
+  async def inject_failure(self, kind):
+    self.stats[kind + '_requests'] += 1
+    if random.random() < self.hang_rate:
+      self.stats[kind + '_hangs'] += 1
+      await asyncio.sleep(3600)
+    if random.random() < self.error_rate:
+      self.stats[kind + '_errors'] += 1
+      await asyncio.sleep(self.latency() / 4)
+      return web.json_response({'error': {'message': 'injected failure', 'type': 'server_error', 'code': None}},
+        status=self.error_status)
+    return None
+
+  async def chat_completions(self, request):
+    body = await request.json()
+    failure = await self.inject_failure('chat')
+    if failure:
+      return failure
+
+    model = body.get('model', 'unknown')
+    n_tokens = max(1, int(self.completion_tokens()))
+    if body.get('max_tokens'):
+      n_tokens = min(n_tokens, body['max_tokens'])
+    tokens = [random.choice(WORDS) + ' ' for _ in range(n_tokens)]
+    usage = {'prompt_tokens': count_prompt_tokens(body.get('messages', [])), 'completion_tokens': n_tokens}
+    usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+    self.stats['completion_tokens'] += n_tokens
+
+    completion = {'id': 'chatcmpl-' + uuid.uuid4().hex, 'created': int(time.time()), 'model': model}
+    if not body.get('stream'):
+      await asyncio.sleep(self.latency() + self.token_latency() * n_tokens)
+      return web.json_response(dict(completion, object='chat.completion', usage=usage, choices=[{'index': 0,
+        'message': {'role': 'assistant', 'content': ''.join(tokens).strip()}, 'finish_reason': 'stop'}]))
+
+    # Streamed as server sent events, one token per chunk
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+    chunk = lambda delta, finish=None: dict(completion, object='chat.completion.chunk',
+      choices=[{'index': 0, 'delta': delta, 'finish_reason': finish}])
+
+    await asyncio.sleep(self.latency())
+    await send_event(response, chunk({'role': 'assistant', 'content': ''}))
+    for token in tokens:
+      await send_event(response, chunk({'content': token}))
+      await asyncio.sleep(self.token_latency())
+    await send_event(response, chunk({}, 'stop'))
+    if (body.get('stream_options') or {}).get('include_usage'):
+      await send_event(response, dict(completion, object='chat.completion.chunk', choices=[], usage=usage))
+    await response.write(b'data: [DONE]\n\n')
+    await response.write_eof()
+    return response
+
+  async def image_generations(self, request):
+    body = await request.json()
+    failure = await self.inject_failure('image')
+    if failure:
+      return failure
+
+    await asyncio.sleep(self.latency())
+    n = body.get('n', 1)
+    if body.get('response_format') == 'b64_json':
+      data = [{'b64_json': TINY_PNG}] * n
+    else:
+      data = [{'url': 'data:image/png;base64,' + TINY_PNG}] * n
+    return web.json_response({'created': int(time.time()), 'data': data})
+
+  async def get_stats(self, request):
+    return web.json_response(dict(self.stats))
+
+# Rough token count of a list of chat messages (about 4 characters a token)
+def count_prompt_tokens(messages):
+  return sum(len(json.dumps(message.get('content', ''))) // 4 + 4 for message in messages)
+
+async def send_event(response, data):
+  await response.write(f'data: {json.dumps(data)}\n\n'.encode())
+
+# Start the server in the running event loop. Returns the aiohttp runner (call runner.cleanup() to stop it)
+async def start_server(server, port, host='127.0.0.1'):
+  runner = web.AppRunner(server.make_app())
+  await runner.setup()
+  await web.TCPSite(runner, host, port).start()
+  return runner
+
+def get_args(argv=None):
+  parser = argparse.ArgumentParser(description='Serve a fake OpenAI compatible api for load testing.')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--latency', type=parse_latency, default=parse_latency('lognormal:-0.7:0.5'),
+    help='time to first token, in seconds (default lognormal:-0.7:0.5, a median of ~0.5s)')
+  parser.add_argument('--token-latency', type=parse_latency, default=parse_latency('0.01'),
+    help='time per generated token, in seconds (default 0.01)')
+  parser.add_argument('--completion-tokens', type=parse_latency, default=parse_latency('uniform:50:300'),
+    help='tokens per reply, as a distribution (default uniform:50:300, capped by max_tokens)')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail (default 0)')
+  parser.add_argument('--error-status', type=int, default=500, help='http status of failures, eg. 429 (default 500)')
+  parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of requests that never finish (default 0)')
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  args = get_args()
+  server = FakeOpenAiServer(args.latency, args.token_latency, args.completion_tokens,
+    args.error_rate, args.error_status, args.hang_rate)
+  web.run_app(server.make_app(), host=args.host, port=args.port)
+  print(dict(server.stats))
@@ -0,0 +1,23 @@
+'''Latency distributions for the benchmark stubs, given as strings, in seconds:
+    const:X, uniform:A:B, lognormal:MU:SIGMA (of the underlying normal, so exp(MU) is the median)
+    or just a number (the same as const:X)'''
+import argparse
+import random
+
+# Turn a latency spec into a function that returns a sample in seconds
+def parse_latency(spec):
+  kind, _, params = str(spec).partition(':')
+  try:
+    if not params:
+      value = float(kind)
+      return lambda: value
+    args = [float(x) for x in params.split(':')]
+    if kind == 'const':
+      return lambda: args[0]
+    if kind == 'uniform':
+      return lambda: random.uniform(args[0], args[1])
+    if kind == 'lognormal':
+      return lambda: random.lognormvariate(args[0], args[1])
+  except (ValueError, IndexError):
+    pass
+  raise argparse.ArgumentTypeError(f'bad latency "{spec}" (try const:0.5, uniform:0.2:1, lognormal:-0.7:0.5)')
@@ -0,0 +1,279 @@
+'''Offline replay benchmark for RemiliaClakeBot.on_message
+  Replays a corpus of recorded messages through the full dispatch path, without connecting to
+  discord or any other api, and reports throughput, per-command latency and memory growth.
+
+  Usage (from the repository root):
+    python -m benchmarks.replay benchmarks/sample_corpus.jsonl --rate 20 --repeat 5 --ai-latency lognormal:-0.7:0.5
+
+  The corpus is a jsonl file with one message per line:
+    {"id": 1, "content": "!ai hello", "author": 10, "channel": 100, "guild": 1000,
+     "mentions": [1], "reference": 1, "admin": false, "attachments": [{"url": "...", "content_type": "image/png"}]}
+  Only content is required. author can also be {"id": 10, "name": "remi", "bot": false}.
+  Mentioning --bot-id (default 1) pings the bot, and reference is the id of an earlier message.
+
+  Latencies are given as a distribution, in seconds (see benchmarks/latency.py), eg. const:0.5
+
+  The bot runs in a temporary working directory (with a copy of data/prompts.txt and
+  data/nlpstuff.db), so replays dont touch the real user databases or logs.'''
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import concurrent.futures
+from types import SimpleNamespace
+
+from lib import aiapi, aiusage, attachments, metrics, postrater, selfawareness
+from lib.Responses import aichat, itsyou
+from clydebutwigglier import RemiliaClakeBot, get_intents
+from benchmarks.fake_openai import TINY_PNG
+from benchmarks.latency import parse_latency
+from benchmarks.standins import FakeChannel, FakeUser, FakeWorld
+
+# Stand in for the AsyncOpenAI client. Only the calls aiapi makes are implemented
+class FakeAiClient():
+  def __init__(self, latency, reply_chars, token_latency=lambda: 0.0):
+    self.latency = latency
+    self.reply_chars = reply_chars
+    self.token_latency = token_latency
+    self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_completion))
+    self.images = SimpleNamespace(generate=self.generate_image)
+
+  async def create_completion(self, model, messages, stream=False, **kwargs):
+    await asyncio.sleep(self.latency())
+    words = ' '.join(random.choice(('wiggle', 'clyde', 'remilia', 'hello', 'yes')) for _ in range(self.reply_chars // 6 + 1))
+    if stream:
+      return FakeStream(words[:self.reply_chars], self.token_latency)
+    prompt_tokens = sum(len(json.dumps(m['content'])) // 4 for m in messages)
+    return SimpleNamespace(
+      choices=[SimpleNamespace(message=SimpleNamespace(content=words[:self.reply_chars]), finish_reason='stop')],
+      usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=self.reply_chars // 4,
+        total_tokens=prompt_tokens + self.reply_chars // 4))
+
+  async def generate_image(self, model, prompt, **kwargs):
+    await asyncio.sleep(self.latency())
+    return SimpleNamespace(data=[SimpleNamespace(b64_json=TINY_PNG)])
+
+# Stand in for a streamed completion, one word per chunk
+class FakeStream():
+  def __init__(self, text, token_latency):
+    self.words = text.split(' ')
+    self.token_latency = token_latency
+
+  async def __aiter__(self):
+    for i, word in enumerate(self.words):
+      yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=(' ' if i else '') + word))])
+      await asyncio.sleep(self.token_latency())
+
+  async def close(self):
+    pass
+
+# Replace every external call the bot makes (ai, http helpers, the postrater) with local stubs
+#   If there is no ai_client, ai requests really are sent (eg. to benchmarks/fake_openai.py)
+def install_stubs(ai_client, http_latency):
+  if ai_client:
+    aiapi.get_client = lambda model: ai_client
+
+  async def fake_gif(*args, **kwargs):
+    await asyncio.sleep(http_latency())
+    return 'https://media.giphy.com/media/fake/giphy.gif'
+
+  async def fake_image(url):
+    await asyncio.sleep(http_latency())
+    return base64.b64decode(TINY_PNG)
+
+  async def fake_articles(n=1):
+    await asyncio.sleep(http_latency())
+    return [f'Article {random.randrange(10**6)}' for _ in range(n)]
+
+  itsyou.get_random_gif = fake_gif
+  attachments.cache.download = fake_image
+  selfawareness.get_random_gif = fake_gif
+  aichat.get_random_wikipedia_article_name = fake_articles
+
+  # The real rater needs java and a language model download, so score on length instead
+  postrater.get_rating = lambda text, history: f'{min(10, len(text) // 10)}/10'
+  postrater.get_detailed_rating = lambda text, history: f'length: {len(text)}\nrating: {min(10, len(text) // 10)}/10'
+
+# Make a scratch working directory with just the data files the bot needs to read
+def make_workdir(repo):
+  workdir = tempfile.mkdtemp(prefix='replay_')
+  os.makedirs(os.path.join(workdir, 'data'))
+  for name in ('prompts.txt', 'nlpstuff.db'):
+    source = os.path.join(repo, 'data', name)
+    if os.path.exists(source):
+      shutil.copy(source, os.path.join(workdir, 'data', name))
+  return workdir
+
+# Read the corpus, skipping blank lines
+def load_corpus(path):
+  with open(path, 'r') as corpus:
+    return [json.loads(line) for line in corpus if line.strip()]
+
+# Create the bot as discord would, minus the connection
+async def start_bot(bot_user):
+  bot = RemiliaClakeBot(intents=get_intents())
+  bot._connection.user = bot_user
+  bot.init_process_pool = lambda responses: concurrent.futures.ThreadPoolExecutor() # see install_stubs
+  await bot._async_setup_hook()
+  await bot.setup_hook()
+  await bot.on_ready()
+  return bot
+
+# Work out which command a message will run, for the latency breakdown
+def classify(bot, message):
+  flags, _ = bot.extract_flags(message.content)
+  commands = [flag for flag in flags if flag in bot.responses]
+  if commands:
+    return '+'.join(dict.fromkeys(commands))
+  if any(map(bot.is_me, message.mentions)):
+    return '_chat'
+  return 'ignored'
+
+# Give every pass over the corpus its own message ids, so replies still point at the right message
+def offset_record(record, offset):
+  if not offset:
+    return record
+  record = dict(record)
+  for key in ('id', 'reference'):
+    if record.get(key):
+      record[key] += offset
+  return record
+
+# Get a percentile (0-100) of a sorted list of samples
+def percentile(samples, p):
+  return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+# Replay the corpus through on_message, returning (elapsed seconds, {command: [latencies]}, failures)
+async def replay(bot, world, corpus, rate, repeat):
+  latencies = {}
+  failures = 0
+
+  async def handle(message):
+    nonlocal failures
+    command = classify(bot, message)
+    start = time.perf_counter()
+    try:
+      await bot.on_message(message)
+    except Exception as e:
+      failures += 1
+      print(f'{command} failed: {e!r}', file=sys.stderr)
+    latencies.setdefault(command, []).append(time.perf_counter() - start)
+
+  tasks = []
+  start = time.perf_counter()
+  for n in range(repeat):
+    for i, record in enumerate(corpus):
+      if rate:
+        # Open loop: messages arrive on schedule whether or not earlier ones are finished
+        delay = start + (n * len(corpus) + i) / rate - time.perf_counter()
+        if delay > 0:
+          await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(handle(world.make_message(offset_record(record, n * 10**12)))))
+      else:
+        await handle(world.make_message(offset_record(record, n * 10**12)))
+  await asyncio.gather(*tasks)
+  return time.perf_counter() - start, latencies, failures
+
+# Peak resident set size, in MB
+def get_peak_rss():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def print_report(total, elapsed, latencies, failures, world, memory):
+  ai_requests = sum(h.count for h in metrics.registry.histograms.get('ai_request_seconds', {}).values())
+  print(f'\n{total} messages in {elapsed:.2f}s: {total / elapsed:.1f} messages/sec ({failures} failed)')
+  print(f'{ai_requests} ai requests, {sum(c.sent for c in world.channels.values())} messages posted, '
+    f'{sum(c.edited for c in world.channels.values())} edited')
+
+  print(f'\n{"command":<20}{"n":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"mean ms":>10}')
+  for command, samples in sorted(latencies.items(), key=lambda x: -len(x[1])):
+    samples.sort()
+    print(f'{command:<20}{len(samples):>8}{percentile(samples, 50)*1000:>10.1f}{percentile(samples, 95)*1000:>10.1f}'
+      f'{percentile(samples, 99)*1000:>10.1f}{sum(samples)/len(samples)*1000:>10.1f}')
+
+  print('\nmemory:')
+  for line in memory:
+    print('  ' + line)
+
+async def main(args):
+  if args.ai_server:
+    os.environ['AI_BASE_URL'] = args.ai_server
+    for provider in aiapi.PROVIDERS:
+      os.environ.setdefault(provider.upper() + '_API_KEY', 'replay')
+  install_stubs(None if args.ai_server else FakeAiClient(args.ai_latency, args.reply_chars, args.token_latency),
+    args.http_latency)
+  FakeChannel.api_latency = args.api_latency
+  os.environ.pop('METRICS_PORT', None)
+
+  corpus = load_corpus(args.corpus)
+  repo = os.getcwd()
+  workdir = make_workdir(repo)
+  os.chdir(workdir)
+  try:
+    bot_user = FakeUser(args.bot_id, 'ClydeButWigglier', bot=True)
+    world = FakeWorld(bot_user)
+    bot = await start_bot(bot_user)
+    FakeChannel.gateway = bot
+    if args.no_admission:
+      for response in bot.responses.values():
+        response.admission = None
+
+    if args.trace_memory:
+      tracemalloc.start(10)
+    rss_before = get_peak_rss()
+    traced_before = tracemalloc.take_snapshot() if args.trace_memory else None
+
+    elapsed, latencies, failures = await replay(bot, world, corpus, args.rate, args.repeat)
+
+    memory = [f'peak rss: {rss_before:.1f}MB before, {get_peak_rss():.1f}MB after']
+    if args.trace_memory:
+      stats = tracemalloc.take_snapshot().compare_to(traced_before, 'lineno')
+      memory.append(f'traced growth: {sum(s.size_diff for s in stats) / 1024:.1f}KB, top allocations:')
+      memory += [str(s) for s in stats[:10]]
+      tracemalloc.stop()
+
+    print_report(len(corpus) * args.repeat, elapsed, latencies, failures, world, memory)
+    if args.metrics:
+      print('\n' + metrics.registry.summary())
+
+    await bot.tasks.shutdown()
+    await aiapi.close_clients()
+    await attachments.cache.close()
+    await aiusage.log.close()
+    bot.thread_pool.shutdown()
+    bot.process_pool.shutdown()
+  finally:
+    os.chdir(repo)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+def get_args(argv=None):
+  parser = argparse.ArgumentParser(description='Replay recorded messages through the bot, offline.')
+  parser.add_argument('corpus', help='jsonl file of messages to replay')
+  parser.add_argument('--rate', type=float, default=0,
+    help='messages per second to send (default 0: send each one as soon as the last is done)')
+  parser.add_argument('--repeat', type=int, default=1, help='number of passes over the corpus')
+  parser.add_argument('--ai-latency', type=parse_latency, default=parse_latency('lognormal:-0.7:0.5'),
+    help='latency of each ai request, or time to the first word of a streamed one (default lognormal:-0.7:0.5, a median of ~0.5s)')
+  parser.add_argument('--token-latency', type=parse_latency, default=parse_latency('0.005'),
+    help='time per word of a streamed ai reply (default 0.005)')
+  parser.add_argument('--ai-server', metavar='URL',
+    help='send ai requests to this api instead of stubbing them, eg. http://127.0.0.1:8080/v1 (see fake_openai.py)')
+  parser.add_argument('--http-latency', type=parse_latency, default=parse_latency('uniform:0.05:0.2'),
+    help='latency of each misc http request, like giphy (default uniform:0.05:0.2)')
+  parser.add_argument('--api-latency', type=float, default=0.05, help='latency of each discord api call (default 0.05)')
+  parser.add_argument('--reply-chars', type=int, default=400, help='length of each ai reply (default 400)')
+  parser.add_argument('--bot-id', type=int, default=1, help="the bot's user id, for mentions (default 1)")
+  parser.add_argument('--no-admission', action='store_true', help='turn off the per guild/user rate limits')
+  parser.add_argument('--trace-memory', action='store_true', help='trace python allocations (slower)')
+  parser.add_argument('--metrics', action='store_true', help="also print the bot's own metrics summary")
+  return parser.parse_args(argv)
+
+if __name__ == '__main__':
+  asyncio.run(main(get_args()))
@@ -0,0 +1,182 @@
+'''Lightweight discord stand-ins used by the replay benchmark.
+  These follow tests/helpers.get_mock_discord_message, but are plain classes instead of
+  unittest Mocks, because Mocks remember every call made on them and that would show up
+  in the benchmark as memory growth.'''
+import asyncio
+import random
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+import discord
+from discord.utils import time_snowflake
+
+# Make a new message id, in order like discord's snowflakes
+last_id = 0
+def next_id():
+  global last_id
+  last_id = max(last_id + 1, time_snowflake(datetime.now(timezone.utc)))
+  return last_id
+
+class FakePermissions():
+  def __init__(self, administrator=False):
+    self.administrator = administrator
+
+class FakeUser():
+  def __init__(self, id, name=None, bot=False):
+    self.id = id
+    self.name = name or f'user{id}'
+    self.nick = None
+    self.global_name = None
+    self.bot = bot
+    self.guild_permissions = FakePermissions()
+
+  async def edit(self, **kwargs):
+    pass
+
+class FakeGuild():
+  def __init__(self, id):
+    self.id = id
+    self.members = {}
+
+  # Get (or add) a member of the guild
+  def get_member(self, id, name=None, bot=False):
+    if id not in self.members:
+      self.members[id] = FakeUser(id, name, bot)
+    return self.members[id]
+
+class FakeAttachment():
+  def __init__(self, url, content_type='image/png', id=None):
+    self.id = id or random.getrandbits(48)
+    self.url = url
+    self.content_type = content_type
+
+class FakeReference():
+  def __init__(self, message_id):
+    self.message_id = message_id
+
+class FakeMessage():
+  def __init__(self, id, content, author, channel, mentions=(), reference=None, attachments=(), created_at=None):
+    self.id = id
+    self.content = content
+    self.author = author
+    self.channel = channel
+    self.guild = channel.guild
+    self.mentions = list(mentions)
+    self.reference = FakeReference(reference) if reference else None
+    self.attachments = list(attachments)
+    self.created_at = created_at or datetime.now(timezone.utc)
+    self.edited_at = None
+
+  async def reply(self, content=None, **kwargs):
+    return await self.channel.send(content=content, **kwargs)
+
+  async def edit(self, content=None, **kwargs):
+    await asyncio.sleep(self.channel.api_latency)
+    self.channel.edited += 1
+    self.content = content
+    self.edited_at = datetime.now(timezone.utc)
+    if self.channel.gateway:
+      await self.channel.gateway.on_message_edit(self, self)
+    return self
+
+  async def add_reaction(self, emoji):
+    pass
+
+  async def create_thread(self, name):
+    return self.channel.create_thread(name)
+
+# A text channel which remembers the messages sent to it (so history can be read back)
+class FakeChannel():
+  # Simulated latency of a discord api call (seconds)
+  api_latency = 0.0
+  # The bot, to send the messages it posts back to (like discord's gateway would), or None
+  gateway = None
+
+  def __init__(self, id, guild, bot_user, type=discord.ChannelType.text):
+    self.id = id
+    self.guild = guild
+    self.type = type
+    self.bot_user = bot_user
+    self.messages = [] # oldest first
+    self.by_id = {}
+    self.sent = 0
+    self.edited = 0
+
+  @property
+  def members(self):
+    return list(self.guild.members.values())
+
+  def add(self, message):
+    self.messages.append(message)
+    self.by_id[message.id] = message
+
+  async def send(self, content=None, **kwargs):
+    await asyncio.sleep(self.api_latency)
+    self.sent += 1
+    message = FakeMessage(next_id(), content or '', self.bot_user, self)
+    self.add(message)
+    if self.gateway:
+      await self.gateway.on_message(message)
+    return message
+
+  async def fetch_message(self, id):
+    await asyncio.sleep(self.api_latency)
+    if id not in self.by_id:
+      raise LookupError(f'unknown message {id}')
+    return self.by_id[id]
+
+  # Mirrors channel.history: newest first, optionally only messages from before a message/datetime
+  async def history(self, limit=100, before=None, **kwargs):
+    await asyncio.sleep(self.api_latency)
+    if isinstance(before, datetime):
+      messages = [m for m in self.messages if m.created_at < before]
+    elif before is not None:
+      messages = [m for m in self.messages if m.created_at < before.created_at]
+    else:
+      messages = self.messages
+    for message in reversed(messages[-limit:] if limit else messages):
+      yield message
+
+  @asynccontextmanager
+  async def typing(self):
+    yield
+
+  def create_thread(self, name):
+    return FakeChannel(random.getrandbits(62), self.guild, self.bot_user, discord.ChannelType.public_thread)
+
+# Keeps track of all the guilds/channels mentioned in a corpus, creating them on demand
+class FakeWorld():
+  def __init__(self, bot_user):
+    self.bot_user = bot_user
+    self.guilds = {}
+    self.channels = {}
+    self.ids = {} # {corpus message id: message id}
+
+  def get_channel(self, guild_id, channel_id):
+    if channel_id not in self.channels:
+      guild = self.guilds.get(guild_id)
+      if guild is None:
+        guild = self.guilds[guild_id] = FakeGuild(guild_id)
+        guild.members[self.bot_user.id] = self.bot_user
+      self.channels[channel_id] = FakeChannel(channel_id, guild, self.bot_user)
+    return self.channels[channel_id]
+
+  # Build a message from one corpus record (see benchmarks/replay.py for the format)
+  def make_message(self, record):
+    channel = self.get_channel(record.get('guild', 0), record.get('channel', 0))
+    author = record.get('author', 0)
+    if not isinstance(author, dict):
+      author = {'id': author}
+    author = channel.guild.get_member(author['id'], author.get('name'), author.get('bot', False))
+    if record.get('admin'):
+      author.guild_permissions = FakePermissions(True)
+
+    mentions = [channel.guild.get_member(id) for id in record.get('mentions', [])]
+    attachments = [FakeAttachment(a['url'], a.get('content_type', 'image/png')) for a in record.get('attachments', [])]
+
+    # Corpus ids are swapped for ordered ones, like the snowflakes the bot expects
+    message = FakeMessage(next_id(), record.get('content', ''), author,
+      channel, mentions, self.ids.get(record.get('reference')), attachments)
+    if record.get('id'):
+      self.ids[record['id']] = message.id
+    channel.add(message)
+    return message
@@ -1,25 +1,96 @@
+# Start the startup clock before anything else is imported
+from lib.startup import StartupReport
+startup = StartupReport()
+
 # Library Imports
 import discord
 import asyncio
+import functools
+import importlib
 import concurrent.futures
+import multiprocessing
+import os
 from textwrap import wrap
 import random
+import time
+from collections import Counter
+from contextlib import aclosing
 
 # Local Imports
 from lib.discord_helpers import *
-from lib.Responses import *
+from lib.Responses.registry import ResponseRegistry
+from lib.Responses.response import run_worker_initializers
 from lib.uwuify import uwu, UwuifyFlag as fwag
-from lib.selfawareness import AiRpResponseType, should_redirect_response
+from lib.selfawareness import AiRpResponseType, should_redirect_response, is_active_channel, load_state
+from lib.postlanes import PostScheduler, get_destination_id
+from lib.progressive import ProgressiveMessage
+from lib.admission import AdmissionControl
+from lib.supervisor import TaskSupervisor
+from lib import aiapi, aiusage, attachments, history, metrics, profiling, sharedstate
+startup.mark('imported')
 
 class RemiliaClakeBot(discord.Client):
-	# Function executed when bot connects
-	async def on_ready(self):
+	# If True, messages with several command flags run all of their responses at once
+	#   (under a single typing indicator). Otherwise they are run one after another.
+	concurrent_responses = True
+
+	# Which of the bot's processes this is, and how many there are (only > 1 when shards are split across processes)
+	process_index = 0
+	process_count = 1
+
+	metrics_server = None # Serves /metrics (only if METRICS_PORT is set, see lib/metrics.py)
+
+	# One time setup, run after logging in but before connecting to the gateway
+	#   (on_ready runs again after every reconnect, so nothing in here belongs there)
+	async def setup_hook(self):
+		self.startup = startup
+		startup.mark('logged in')
+
 		# Register the response pool
-		self.responses = self.init_responses()
+		with startup.phase('responses'):
+			self.tasks = TaskSupervisor() # Tracks everything run in the background
+			self.admission = AdmissionControl() # Shared by all of the ai responses
+			self.registry = ResponseRegistry(self.connect_response) # Responses from the manifest in lib/Responses
+			self.responses = self.registry.load_all()
 	
 		# Setup useful resources
-		self.thread_pool = concurrent.futures.ThreadPoolExecutor()
-		self._post_lock = asyncio.Lock() # Mutex lock to stop replies from interrupting eachother
+		with startup.phase('pools'):
+			self.thread_pool = concurrent.futures.ThreadPoolExecutor()
+			self.process_pool = self.init_process_pool(self.responses)
+		self.post_scheduler = PostScheduler() # Per-channel lanes to stop replies from interrupting eachother
+		self.message_counts = Counter() # How many messages were 'filtered' out early vs 'processed'
+		with startup.phase('state'):
+			load_state() # Cache the roleplay location now, so the message filter never has to read it
+
+		# Report the bot's own state whenever metrics are read, and serve them locally if asked to
+		metrics.register_collector(self.collect_metrics)
+		metrics.register_collector(self.tasks.collect_metrics)
+		metrics.register_collector(startup.collect_metrics)
+		metrics.register_collector(aiapi.collect_metrics)
+		aiusage.log.start() # Write down what the ai requests cost, in batches
+		port = os.getenv('METRICS_PORT')
+		if port:
+			self.metrics_server = await metrics.start_server(int(port) + self.process_index)
+
+		# Load the slow stuff in the background, so we can connect (and answer) in the meantime
+		self.create_background_task(self.warm_up(), 'startup')
+
+	# Get heavy subsystems ready, so the first requests dont have to wait for them
+	#   (the process pool's workers each run their responses' initializers as they start)
+	async def warm_up(self):
+		await self.run_thread(importlib.import_module, 'openai')
+		startup.mark('ai client loaded')
+		await asyncio.gather(*[self.loop.run_in_executor(self.process_pool, int)
+			for _ in range(self.get_process_workers())])
+		startup.mark('process pool ready')
+
+	# Function executed when bot connects (and again whenever it reconnects)
+	async def on_ready(self):
+		if startup.mark('ready'):
+			print(startup.format())
+		else:
+			metrics.increment('gateway_reconnects')
+			history.store.clear() # Messages could have been missed while we were away
 		
 		# Alert the admin (me) we're ready to start
 		print('\nConnected!')
@@ -31,8 +102,15 @@ class RemiliaClakeBot(discord.Client):
 
 	# Message event handler (will dispatch new thread)
 	async def on_message(self, message):
+		history.store.add(message) # Every message (even ours) is kept as context for later
 		if self.is_me(message.author):
 			return
+
+		# Drop ordinary chatter before doing any real work
+		if not self.could_trigger(message):
+			self.message_counts['filtered'] += 1
+			return
+		self.message_counts['processed'] += 1
 		
 		# Extract relevant info from the message before we modify it
 		flags, text = self.extract_flags(message.content)
@@ -65,26 +143,59 @@ class RemiliaClakeBot(discord.Client):
 					# Manually call the secret chatgpt response handler
 					replies.append(await self.get_response('_chat', text, message, channel))
 			
-			# Otherwise, check for any commands
+			# Otherwise, check for any commands (in the order they were given, without repeats)
 			else:
-				for flag in set(flags) & set(self.responses.keys()):
+				commands = list(dict.fromkeys(flag for flag in flags if flag in self.responses))
+				if self.concurrent_responses and len(commands) > 1:
 					async with channel.typing():
-						replies.append(await self.get_response(flag, text, message, channel))
+						replies += await self.get_responses(commands, text, message, channel)
+				else:
+					for flag in commands:
+						async with channel.typing():
+							replies.append(await self.get_response(flag, text, message, channel))
 
 		# redirect == IGNORE_RESPONSE does nothing
 
 		# reply to all relevant messages
 		for reply in replies:
 			if reply[0]: # Check No-Post Condition
-				text = self.apply_text_modifiers(reply[0], flags)
 				post_kwargs = self.get_extra_post_kwargs(flags)
 
 				# Check if we're supposed to reply to a message
 				# (Dont Reply to thread starting messages, discord doesnt like it)
-				if not reply[1] or new_thread:
-					await self.post(text, channel, post_kwargs, is_reply=False)
+				context, is_reply = (channel, False) if not reply[1] or new_thread else (reply[1], True)
+
+				# Ai replies that are still being written are posted as they arrive
+				if isinstance(reply[0], aiapi.StreamedCompletion):
+					await self.post_stream(reply[0], flags, context, post_kwargs, is_reply)
 				else:
-					await self.post(text, reply[1], post_kwargs)
+					await self.post(self.apply_text_modifiers(reply[0], flags), context, post_kwargs, is_reply)
+
+	# Keep the recent message history (see lib/history.py) and its ai formatted versions up to date
+	#   Edits of messages discord has cached come with the whole message, others only with what changed
+	async def on_message_edit(self, before, after):
+		history.store.edit(after.channel.id, after.id, message=after)
+
+	async def on_raw_message_edit(self, payload):
+		aiapi.format_cache.invalidate(payload.message_id)
+		if payload.cached_message is None:
+			history.store.edit(payload.channel_id, payload.message_id, data=payload.data)
+
+	async def on_raw_message_delete(self, payload):
+		aiapi.format_cache.invalidate(payload.message_id)
+		history.store.delete(payload.channel_id, payload.message_id)
+
+	async def on_raw_bulk_message_delete(self, payload):
+		for message_id in payload.message_ids:
+			aiapi.format_cache.invalidate(message_id)
+			history.store.delete(payload.channel_id, message_id)
+
+	# Quick, in-memory check of whether a message could possibly trigger a response
+	#   (it has command flags, it mentions the bot, or it is in the active roleplay channel)
+	def could_trigger(self, message):
+		return message.content.startswith('!') \
+			or any(map(self.is_me, message.mentions)) \
+			or (message.guild is not None and is_active_channel(message.guild.id, message.channel.id))
 
 	# Helper function to get a specific response and handle autofire
 	async def get_response(self, command, text, message, channel) -> str:
@@ -93,10 +204,25 @@ class RemiliaClakeBot(discord.Client):
 
 		# Check for and handle autofire
 		if response.inactivity_autofire > 30 and not response.autofiring:
-			self.create_background_task(response.perform_autofire(channel))
+			self.create_background_task(response.perform_autofire(channel), 'autofire', command)
 
 		return reply
 
+	# Run several responses concurrently, returning their replies in the order requested
+	#   A response that fails is logged and skipped, without cancelling the others
+	async def get_responses(self, commands, text, message, channel):
+		results = await asyncio.gather(
+			*[self.get_response(command, text, message, channel) for command in commands],
+			return_exceptions=True)
+
+		replies = []
+		for command, result in zip(commands, results):
+			if isinstance(result, BaseException):
+				print("'{}' failed: {}".format(command, repr(result)))
+			else:
+				replies.append(result)
+		return replies
+
 	# Extract any flags from the text
 	# (flags are extra commands that start with ! and are at the start of the message)
 	def extract_flags(self, text):
@@ -122,7 +248,19 @@ class RemiliaClakeBot(discord.Client):
 		return text
 	
 	# Apply Text Modifiers to the input string based on the requested flags
-	def apply_text_modifiers(self, text, flags):
+	#   Text that is modified more than once as it grows (see post_stream) passes the same seed
+	#   every time, so the random parts (smileys, shininess) come out the same each time
+	def apply_text_modifiers(self, text, flags, seed=None):
+		if seed is None:
+			return self._apply_text_modifiers(text, flags)
+		state = random.getstate()
+		random.seed(seed)
+		try:
+			return self._apply_text_modifiers(text, flags)
+		finally:
+			random.setstate(state)
+
+	def _apply_text_modifiers(self, text, flags):
 		if 'uwu' in flags:
 			text = uwu(text, flags=fwag.SMILEY | fwag.YU | fwag.STUTTER)
 		if 'yell' in flags:
@@ -136,47 +274,232 @@ class RemiliaClakeBot(discord.Client):
 
 	# Post a message with input content to the channel in the provided message context
 	async def post(self, content, context, post_kwargs, is_reply=True, start_thread=False):    
-		async with self._post_lock: # Only one message at a time
+		# Only one message at a time per channel (other channels can post in parallel)
+		queued_at = time.perf_counter()
+		async with self.post_scheduler.lane(get_destination_id(context, is_reply)):
+			metrics.observe('post_wait_seconds', time.perf_counter() - queued_at)
 			try:
-				# Break up messages longer than the max character limit
-				chunks = wrap(content, 2000, replace_whitespace=False, drop_whitespace=False)
-				if(is_reply):
-					await context.reply(content=chunks[0], **post_kwargs)
-					context = context.channel # Set the channel as the new context for multi-part-messages
-				else:
-					await context.send(content=chunks[0], **post_kwargs)
+				with metrics.timer('post_seconds'):
+					# Break up messages longer than the max character limit
+					chunks = wrap(content, 2000, replace_whitespace=False, drop_whitespace=False)
+					if(is_reply):
+						await context.reply(content=chunks[0], **post_kwargs)
+						context = context.channel # Set the channel as the new context for multi-part-messages
+					else:
+						await context.send(content=chunks[0], **post_kwargs)
 
-				# Queue up any additonal message chunks
-				if len(chunks) > 1:
-					for part in chunks[1:]:
-						await context.send(content=part, **post_kwargs)
+					# Queue up any additonal message chunks
+					if len(chunks) > 1:
+						for part in chunks[1:]:
+							await context.send(content=part, **post_kwargs)
+				if startup.mark('first reply'):
+					print(startup.format())
 			except Exception as e:
+				metrics.increment('post_errors')
 				print(e)
 
+	# Post an ai reply while it is still being written, editing it as it grows (see lib/progressive.py)
+	#   Keeps the channel "typing..." until the first words arrive. Text modifiers are applied
+	#   to the whole reply so far on every edit, and to the finished reply at the end
+	#   The stream is always closed, even if this is cancelled before it starts reading it
+	async def post_stream(self, stream, flags, context, post_kwargs, is_reply=True):
+		try:
+			queued_at = time.perf_counter()
+			async with self.post_scheduler.lane(get_destination_id(context, is_reply)):
+				metrics.observe('post_wait_seconds', time.perf_counter() - queued_at)
+				channel = context.channel if is_reply else context
+				send_first = context.reply if is_reply else context.send
+				message = ProgressiveMessage(
+					lambda text: send_first(content=text, **post_kwargs),
+					lambda text: channel.send(content=text, **post_kwargs))
+				seed = random.getrandbits(32)
+				try:
+					with metrics.timer('post_stream_seconds'):
+						async with aclosing(aiter(stream)) as parts:
+							async with channel.typing():
+								await anext(parts, None)
+							if stream.text.strip():
+								await message.update(self.apply_text_modifiers(stream.text.lstrip(), flags, seed))
+							async for _ in parts:
+								if message.due():
+									await message.update(self.apply_text_modifiers(stream.text.lstrip(), flags, seed))
+
+						text = stream.get_text()
+						if text:
+							await message.update(self.apply_text_modifiers(text, flags, seed))
+					metrics.increment('post_stream_edits', message.edits)
+					if message.messages and startup.mark('first reply'):
+						print(startup.format())
+				except Exception as e:
+					metrics.increment('post_errors')
+					print(e)
+		finally:
+			await stream.close() # In case it was cancelled (or failed) before it was read to the end
+
+	# Gauges describing the bot's current state (read by the metrics registry)
+	def collect_metrics(self):
+		gauges = [('messages_seen', {'result': result}, count) for result, count in self.message_counts.items()]
+		gauges += [('post_queue_depth', {'channel': channel}, depth)
+			for channel, depth in self.post_scheduler.get_queue_depths().items()]
+
+		levels = self.admission.get_levels()
+		gauges += [('admission_guild_tokens', {'guild': guild}, tokens) for guild, tokens in levels['guilds'].items()]
+		gauges.append(('admission_user_buckets', {}, len(levels['users'])))
+		gauges.append(('history_channels', {}, len(history.store.channels)))
+		gauges.append(('history_messages', {}, sum(len(c.messages) for c in history.store.channels.values())))
+		return gauges
+
 	# helper funciton to run a function in a thread
 	async def run_thread(self, func, *args):
-		return await self.loop.run_in_executor(self.thread_pool, func, *args)
+		return await self.run_in_pool(self.thread_pool, func, *args)
+
+	# helper function to run a (picklable, module level) function in a worker process
+	async def run_process(self, func, *args):
+		return await self.run_in_pool(self.process_pool, func, *args)
+
+	# Run a function in an executor, profiling it over there if the calling command is being profiled
+	async def run_in_pool(self, executor, func, *args):
+		sample = profiling.current_sample()
+		if sample is None:
+			return await self.loop.run_in_executor(executor, func, *args)
+
+		result, stats = await self.loop.run_in_executor(executor, profiling.run_profiled, func, *args)
+		if stats:
+			sample.add(stats)
+		return result
+
+	# Create the worker process pool used by cpu bound responses
+	#   Every worker runs the responses' initializers once when it starts, and all workers
+	#   are started by warm_up so that setup isnt paid for by the first request
+	def init_process_pool(self, responses):
+		initializers = tuple(response.worker_initializer for response in responses.values()
+			if response.executor == 'process' and response.worker_initializer)
+
+		# Use spawn, since forking a process with a running event loop and threads isnt safe
+		return concurrent.futures.ProcessPoolExecutor(self.get_process_workers(),
+			mp_context=multiprocessing.get_context('spawn'),
+			initializer=run_worker_initializers, initargs=(initializers,))
+
+	# Number of worker processes to use: PROCESS_WORKERS, or a few of the cores (shared with any other bot processes)
+	def get_process_workers(self):
+		workers = os.getenv('PROCESS_WORKERS')
+		if workers:
+			return max(1, int(workers))
+		return max(1, min(4, os.cpu_count() or 1) // self.process_count)
 	
-	# Create a background task that doesnt have a return value
-	def create_background_task(self, awaitable):
-		self.loop.create_task(awaitable)
-
-	# Dynamically collect and instantiate the command/response dictionary
-	def init_responses(self):
-		responses = {}
-		for cls in ResponseInterface.__subclasses__():
-			inst = cls()
-			inst.run_thread = self.run_thread
-			inst.is_me = self.is_me
-			inst.post = self.post
-			inst.run_in_background = self.create_background_task
-			responses[inst.callsign] = inst
-			print("'{}' registered to '{}'".format(cls.__name__, inst.callsign))
-
-		# Make the help response aware of the avaliable options
-		responses['help'].responses = responses
-		
-		return responses
+	# Create a supervised background task that doesnt have a return value (see lib/supervisor.py)
+	#   owner is who started it (eg. a callsign), and kind is what sort of work it is
+	def create_background_task(self, awaitable, kind='background', owner=None):
+		return self.tasks.spawn(awaitable, kind, owner)
+
+	# Finish up background work before disconnecting
+	async def close(self):
+		if hasattr(self, 'tasks'):
+			await self.tasks.shutdown()
+		await aiapi.close_clients()
+		await attachments.cache.close()
+		await aiusage.log.close()
+		if self.metrics_server:
+			await self.metrics_server.cleanup()
+			self.metrics_server = None
+		await super().close()
+
+	# Hook a newly loaded response up to the bot
+	#   previous is the response it replaces when a module is reloaded (or None)
+	def connect_response(self, inst, previous):
+		inst.run_thread = self.run_process if inst.executor == 'process' else self.run_thread
+		inst.is_me = self.is_me
+		inst.post = self.post
+		inst.run_in_background = functools.partial(self.create_background_task, owner=inst.callsign)
+		inst.admission = self.admission if inst.admission_controlled else None
+
+		# Make the help response aware of the avaliable options, and let admins reload responses
+		if inst.callsign == 'help':
+			inst.responses = self.registry.responses
+		if inst.callsign == 'reload':
+			inst.reload_module = self.reload_responses
+
+		# Pick up the autofire timer where the old version left off
+		if previous:
+			inst.inactivity_autofire = previous.inactivity_autofire
+			inst.last_message_at = previous.last_message_at
+
+	# Reload the code of one response module (see lib/Responses/registry.py)
+	#   The old versions' autofire loops are stopped, and restart on the next message
+	def reload_responses(self, module):
+		callsigns = self.registry.reload(module)
+		for callsign in callsigns:
+			for task in self.tasks.get_owned(callsign, 'autofire'):
+				task.cancel()
+		metrics.increment('response_reloads', module=module)
+		return callsigns
+
+# The bot, connected through one or more gateway shards (guilds are spread across the shards)
+#   All of the shards handled by one process share its event loop, responses and pools
+class ShardedRemiliaClakeBot(RemiliaClakeBot, discord.AutoShardedClient):
+	# Also report the heartbeat latency of each shard
+	def collect_metrics(self):
+		gauges = super().collect_metrics()
+		gauges += [('shard_latency_seconds', {'shard': shard}, latency)
+			for shard, latency in self.latencies if latency == latency and latency != float('inf')] # skip nan/inf
+		return gauges
+
+# Where shards running in separate processes keep the state they share (see lib/sharedstate.py)
+SHARED_STATE_FILE = 'data/shared_state.db'
+
+# How often the parent process checks on its shard processes (seconds)
+SHARD_PROCESS_CHECK_INTERVAL = 10
+
+# Run the bot, sharded according to the environment
+#   SHARD_COUNT: number of gateway shards (unset runs a single, unsharded connection)
+#   SHARD_PROCESSES: number of processes to split those shards across (default 1)
+def run():
+	shard_count = int(os.getenv('SHARD_COUNT', '0'))
+	processes = min(int(os.getenv('SHARD_PROCESSES', '1')), max(shard_count, 1))
+	if not shard_count:
+		RemiliaClakeBot(intents=get_intents()).run(get_token())
+	elif processes <= 1:
+		ShardedRemiliaClakeBot(intents=get_intents(), shard_count=shard_count).run(get_token())
+	else:
+		run_shard_processes(shard_count, processes)
+
+# Run the shards in worker processes, restarting any that crash
+#   Shards are dealt out round robin, so process i runs shards i, i + processes, ...
+def run_shard_processes(shard_count, processes):
+	context = multiprocessing.get_context('spawn')
+	workers = {}
+
+	def start(index):
+		shard_ids = list(range(index, shard_count, processes))
+		workers[index] = context.Process(target=run_shard_process, name=f'shards-{index}',
+			args=(shard_ids, shard_count, index, processes))
+		workers[index].start()
+		print('process {} started with shards {}'.format(index, shard_ids))
+
+	for index in range(processes):
+		start(index)
+	try:
+		while workers:
+			time.sleep(SHARD_PROCESS_CHECK_INTERVAL)
+			for index, worker in list(workers.items()):
+				if worker.exitcode == 0:
+					del workers[index]
+				elif worker.exitcode is not None:
+					print('process {} exited with code {}, restarting it'.format(index, worker.exitcode))
+					start(index)
+	except KeyboardInterrupt:
+		for worker in workers.values():
+			worker.terminate()
+		for worker in workers.values():
+			worker.join()
+
+# Entry point of a shard process
+def run_shard_process(shard_ids, shard_count, process_index, process_count):
+	sharedstate.use_file(SHARED_STATE_FILE)
+	ShardedRemiliaClakeBot.process_index = process_index
+	ShardedRemiliaClakeBot.process_count = process_count
+	client = ShardedRemiliaClakeBot(intents=get_intents(), shard_ids=shard_ids, shard_count=shard_count)
+	client.run(get_token())
 
 # Function to get the bot authentication token from a file
 def get_token():
@@ -190,5 +513,6 @@ def get_intents():
 	intents.members = True
 	return intents
 
-client = RemiliaClakeBot(intents=get_intents())
-client.run(get_token())
\ No newline at end of file
+# Guarded so that worker processes can import this file without starting another bot
+if __name__ == '__main__':
+	run()
\ No newline at end of file
@@ -1,23 +1,28 @@
 from typing import Any
 from .response import ResponseInterface
-from lib import aiapi
+from lib import aiapi, aipriority
 from lib import aiprompts
 from lib.discord_helpers import *
 from lib.misc_apis import get_random_wikipedia_article_name
 
 class GptResponse(ResponseInterface):
 	callsign = '_chat' # Keep this sorta hidden
+	admission_controlled = True
+	streaming = True
+	ai_priority = aipriority.INTERACTIVE # Somebody mentioned the bot, and is waiting on it
 	
 	# Generate a reply to a single message using davinici (without guardrails)
 	async def respond_to_message(self, text, request):
 		# Respond to the request
 		quote = await resolve_reference(request)
 		visual = has_images(request) or (quote and has_images(quote))
-		return await aiapi.wiggly_chat_response(request, self.is_me, quote, visual)
+		return await aiapi.wiggly_chat_response(request, self.is_me, quote, visual, self.streaming, self.cache_ai_replies)
 		
 class DeepseekCompletion(ResponseInterface):
 	callsign = 'ai'
 	blurb = 'get deepseek-chat to respond to the chat'
+	admission_controlled = True
+	streaming = True
 
 	# Generate a chat completion reply to the exisitng chat log
 	async def respond_to_message(self, text, request):
@@ -25,22 +30,27 @@ class DeepseekCompletion(ResponseInterface):
 		context = aiprompts.get_context(request.guild.id, request.channel.id)
 		messages = [request] + await get_history(request.channel, limit=context, before=request)
 		messages.reverse()
-		return await aiapi.respond_to_messages(messages, self.is_me, aiapi.DS_CHAT)
+		return await aiapi.respond_to_messages(messages, self.is_me, aiapi.DS_CHAT, stream=self.streaming, cache=self.cache_ai_replies)
 
 class DeepseekThinkCompletion(ResponseInterface):
 	callsign = 'aithink'
 	blurb = 'get deepseek-reasoning to respond to your message in a scholarly way'
+	admission_controlled = True
+	streaming = True
+	ai_deadline = 180 # Reasoning takes a while
 
 	# Generate a chat completion reply to the exisitng chat log
 	async def respond_to_message(self, text, request):
 		request.content = text
 		context = aiprompts.get_context(request.guild.id, request.channel.id)
 		messages = [request] # reasoning must strictly alternate between it and you, thus we ignore context to make it easy
-		return await aiapi.respond_to_messages(messages, self.is_me, aiapi.DS_REASON)
+		return await aiapi.respond_to_messages(messages, self.is_me, aiapi.DS_REASON, stream=self.streaming, cache=self.cache_ai_replies)
 
 class Gpt4Completion(ResponseInterface):
 	callsign = 'gpt'
 	blurb = 'get GPT-4o to respond to the chat'
+	admission_controlled = True
+	streaming = True
 
 	# Generate a chat completion reply to the exisitng chat log
 	async def respond_to_message(self, text, request):
@@ -50,7 +60,7 @@ class Gpt4Completion(ResponseInterface):
 		messages.reverse()
 		visual = any([has_images(m) for m in messages])
 		model =  aiapi.GPT4_VISION if visual else aiapi.GPT4
-		return await aiapi.respond_to_messages(messages, self.is_me, model, visual)
+		return await aiapi.respond_to_messages(messages, self.is_me, model, visual, self.streaming, self.cache_ai_replies)
 		
 class ChangePrompt(ResponseInterface):
 	callsign = 'prompt' # Set the current prompt
@@ -154,17 +164,19 @@ class AiChatInterface():
 			prompt = personality + '\n\n' + prompt
 
 		# Get the respones
-		response = await aiapi.respond_to_messages_with_customized_prompt(messages, prompt, is_me)
+		response = await aiapi.respond_to_messages_with_customized_prompt(messages, prompt, is_me, cache=self.cache_ai_replies)
 		return response or self.no_response
 
 class Insult(ResponseInterface, AiChatInterface):
 	callsign = 'insult'
 	blurb = 'generate a message insulting a user'
+	admission_controlled = True
 	prompt = 'Pretend to agressivley insult and mockingly deride "{0}"'
 	quote_reasoning = 'for foolishly posting the following message:'
 	no_reasoning = "in a silly way, for a made-up silly reason of your choosing."
 	bad_request = 'god you suck'
 	no_response = ':rage:'
+	cache_ai_replies = False
 
 	async def respond_to_message(self, text, request):
 		return await self.get_customized_response(text, request)
@@ -172,9 +184,11 @@ class Insult(ResponseInterface, AiChatInterface):
 class Praise(ResponseInterface, AiChatInterface):
 	callsign = 'praise'
 	blurb = 'generate a message praising a user'
+	admission_controlled = True
 	prompt = 'Praise and dote on "{0}" and tell them they did a good job'
 	bad_request = 'you tried your best, and thats what matters!'
 	no_response = ':heart:'
+	cache_ai_replies = False
 
 	async def respond_to_message(self, text, request):
 		return await self.get_customized_response(text, request)
@@ -182,9 +196,11 @@ class Praise(ResponseInterface, AiChatInterface):
 class Apologize(ResponseInterface, AiChatInterface):
 	callsign = 'sorry'
 	blurb = 'generate an apology on behalf of a message'
+	admission_controlled = True
 	prompt = 'Apologize profusely on behalf of "{0}"'
 	bad_request = 'im truly sorry for this'
 	no_response = ':pensive:'
+	cache_ai_replies = False
 
 	async def respond_to_message(self, text, request):
 		return await self.get_customized_response(text, request)
@@ -192,12 +208,14 @@ class Apologize(ResponseInterface, AiChatInterface):
 class Monologue(ResponseInterface, AiChatInterface):
 	callsign = 'monologue'
 	blurb = 'flaunt your imminent victory'
+	admission_controlled = True
 	prompt = 'Flaunt your imminent victory over "{0}" with a wry and flamboyant monologue. Play up your character\'s special traits, or invent some if none ar provided. Your monologue should be no more than 100 words long, and should end with a short, 1-5 word phrase declaring your monment of victory, such as "farewell", the name of your final special attack, or some other pithy summarization of your opponent ({0}\'s) failures.'
 	text_reasoning = 'You are monologuing {1}'
 	quote_reasoning = 'The following message contains their last pathetic words to you:'
 	bad_request = "You're not even worth monologuing at."
 	no_response = 'hmph'
 	has_personality = True
+	cache_ai_replies = False
 
 	async def respond_to_message(self, text, request):
 		return await self.get_customized_response(text, request)
@@ -206,6 +224,8 @@ class Monologue(ResponseInterface, AiChatInterface):
 class GPTImageGeneration(ResponseInterface):
 	callsign = 'aiimage'
 	blurb = 'use DALLE3 to generate an image for your prompt'
+	admission_controlled = True
+	ai_deadline = 120
 		
 	# Respond to the message
 	async def respond_with_context(self, text, request, channel):
@@ -223,6 +243,9 @@ class GPTImageGeneration(ResponseInterface):
 class InfoDump(ResponseInterface):
 	callsign = 'infodump'
 	blurb = 'get the bot to infodump about a topic'
+	admission_controlled = True
+	streaming = True
+	cache_ai_replies = False # Asking again should get a different infodump
 	
 	def get_help(self) -> str:
 		return  '!infodump [topic]\n' +\
@@ -246,5 +269,5 @@ class InfoDump(ResponseInterface):
 		prompt = personality + '\n\n' + instructions
 
 		# Generate the respone
-		response = await aiapi.respond_to_messages_with_customized_prompt([], prompt, lambda _: False)
-		return response or ':think:'
+		response = await aiapi.respond_to_messages_with_customized_prompt([], prompt, lambda _: False, stream=self.streaming, cache=self.cache_ai_replies)
+		return aiapi.or_default(response, ':think:')
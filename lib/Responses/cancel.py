@@ -1,6 +1,6 @@
 import random
 from .response import ResponseInterface
-from lib.discord_helpers import get_history
+from lib.discord_helpers import get_history, get_message
 
 class Cancel(ResponseInterface):
   callsign = 'cancel'
@@ -40,4 +40,4 @@ async def find_evidence(channel, target, filter, length=20):
     if sus.author.id == target:
       if filter(sus.content):
         if len(sus.content) > length:
-          return sus
\ No newline at end of file
+          return get_message(sus) # (it gets replied to)
\ No newline at end of file
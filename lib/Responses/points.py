@@ -1,5 +1,6 @@
 from .response import ResponseInterface
 from lib.serverdata import ServerDatabase
+from lib import sharedstate
 from lib.discord_helpers import get_username_from_id
 from datetime import datetime, timedelta
 
@@ -9,7 +10,16 @@ DEPUTY_POINT_APOINTEE = 'deputy'
 class Points(ResponseInterface):
     callsign = 'points'
     blurb = 'award and track points given to users'
-    deputy_timeout = datetime.min
+
+    # When the current deputy's term runs out (kept in lib/sharedstate, so every shard sees it)
+    @property
+    def deputy_timeout(self):
+        timestamp = sharedstate.store.get('points.deputy_timeout')
+        return datetime.fromtimestamp(timestamp) if timestamp else datetime.min
+
+    @deputy_timeout.setter
+    def deputy_timeout(self, value):
+        sharedstate.store.set('points.deputy_timeout', value.timestamp() if value > datetime.min else None)
 
     async def respond_to_message(self, text, request):
         #Determine which mode to use, and send it to the appropriate function
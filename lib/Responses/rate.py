@@ -7,8 +7,9 @@ class Rate(ResponseInterface):
   callsign = 'rate'
   blurb = 'rate the quality of a post'
 
-  def __init__(self):
-    self.rater = postrater.PostRater()
+  # Rating is cpu bound, so it runs in worker processes that each load their own rater once
+  executor = 'process'
+  worker_initializer = staticmethod(postrater.init_worker)
   
   # Respond with a custom reply context
   async def respond_with_context(self, text, request, channel):
@@ -20,9 +21,9 @@ class Rate(ResponseInterface):
       
       result = ":confused:"      
       if 'detail' in text.lower():
-        result = await self.run_thread(self.rater.get_detailed_rating, text, history)
+        result = await self.run_thread(postrater.get_detailed_rating, text, history)
       else:
-        result = await self.run_thread(self.rater.get_rating, text, history)
+        result = await self.run_thread(postrater.get_rating, text, history)
         
       return result, target
     
@@ -31,7 +32,7 @@ class Rate(ResponseInterface):
 
   # Get the text contents of the last n chat messages in the channel
   async def get_ratable_chat_history(self, channel, before, n=10):
-    history = await get_history(channel, limit=2*n, before=before)
+    history = await get_history(channel, limit=n, before=before)
     # Its probably more correct to include the bot in the history, esp since it can
     #   do large, on topic responses. (prob higher quality than the users, tbh)
     #notme = filter(lambda x: not self.is_me(x.author), history)
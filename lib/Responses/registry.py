@@ -0,0 +1,47 @@
+import importlib
+from . import MANIFEST
+
+# Loads the responses listed in the manifest, and reloads them a module at a time
+class ResponseRegistry():
+  # connect - function(response, previous) that hooks a new response up to the bot (its delegates),
+  #   where previous is the response it is replacing (or None)
+  def __init__(self, connect, manifest=MANIFEST):
+    self.connect = connect
+    self.manifest = manifest
+    self.responses = {} # {callsign: response}, only ever updated in place so holders of it see reloads
+    self.modules = {} # {module name: [callsigns it registered]}
+
+  # Load every module in the manifest, returning the responses
+  def load_all(self):
+    for name in self.manifest:
+      self.load(name)
+    return self.responses
+
+  # Load (or reload) the responses of one module, returning their callsigns
+  #   The new responses are all made and connected before any are swapped in, so a module that
+  #   fails to load leaves the old ones running. Requests already in progress finish on the old ones
+  def load(self, name, reload=False):
+    if name not in self.manifest:
+      raise KeyError(f"'{name}' is not in the response manifest")
+    module = importlib.import_module(f'{__package__}.{name}')
+    if reload:
+      module = importlib.reload(module)
+
+    loaded = {}
+    for cls_name in self.manifest[name]:
+      response = getattr(module, cls_name)()
+      self.connect(response, self.responses.get(response.callsign))
+      loaded[response.callsign] = response
+
+    for callsign in self.modules.get(name, []):
+      if callsign not in loaded:
+        del self.responses[callsign] # It was removed from the module
+    self.responses.update(loaded)
+    self.modules[name] = list(loaded)
+    for callsign, response in loaded.items():
+      print("'{}' registered to '{}'".format(type(response).__name__, callsign))
+    return list(loaded)
+
+  # Reload the code of one module, and swap in its new responses
+  def reload(self, name):
+    return self.load(name, reload=True)
@@ -1,4 +1,7 @@
 import asyncio
+import time
+from lib import aiapi, aiguard, aipriority, aiusage, metrics, profiling, sharedstate
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Tuple
 
@@ -9,9 +12,17 @@ class ResponseInterface:
 	
 	# Delegate method used to run a call asynchronously in in a new thread and get a result
 	run_thread = None # async def run_thread(func, *args) -> result
+
+	# Which executor run_thread uses: 'thread' (default), or 'process' for cpu bound pure python work
+	#   Process executed functions (and their arguments) must be picklable, module level functions
+	executor = 'thread'
+
+	# Optional module level function to run once in every worker process as it starts (process executor only)
+	#   eg. to build expensive objects once. Wrap it in staticmethod() so it doesnt get bound to the response
+	worker_initializer = None
 	
 	# Delegate method used to run an awaitable in the background without waiting for it
-	run_in_background = None # self.run_in_background(some_awaitable_task())
+	run_in_background = None # self.run_in_background(some_awaitable_task(), kind='background')
 
 	# Delegate method used to determine if a user is the bot
 	is_me = None # def is_me(id) -> boolean
@@ -19,9 +30,31 @@ class ResponseInterface:
 	# Reference to the discord post method
 	post = None
 	
+	# Fair-share admission control (see lib/admission.py). Set admission_controlled on responses
+	#   that call out to the ai apis, and they will share the bot's per guild/user budgets
+	admission_controlled = False
+	admission = None # Delegate AdmissionControl object (only set if admission_controlled)
+
+	# If True, ai replies are posted while they are still being written (and edited as they grow)
+	#   Only for responses that return the ai's reply as is (see aiapi.StreamedCompletion)
+	streaming = False
+
+	# If True, identical ai requests made close together share one answer (see lib/aicache.py)
+	#   Turn this off for responses that should come out different every time
+	cache_ai_replies = True
+
+	# Most seconds the ai requests of one response can take in total, including retries and reading
+	#   streamed replies (see lib/aiguard.py)
+	#   Past it they give up, and the response gets the error reply. None for no deadline
+	ai_deadline = 60
+
+	# How important the ai requests of the response are, when the providers are busy (see lib/aipriority.py)
+	#   Autofires always have aipriority.AUTOFIRE. Override get_ai_priority to pick it per request
+	ai_priority = aipriority.COMMAND
+
 	# Data required by rate limiting of the responses
 	cooldown = timedelta(-20) # Default Cooldown is negative in case of race conditions
-	last_use = datetime.min # Last use of the response
+	# (the last use of each response is kept in lib/sharedstate, so every shard sees it)
 	manual_timer = False # If True, responses will handle their own timers (check is skipped)
 
 	# Autofire controls (allows responses to trigger themselves after a number of seconds of inactivity)
@@ -55,16 +88,42 @@ class ResponseInterface:
 	# Entry point into the class. Will check the cooldown first, then call the response chain
 	# Will Return (Message Text, Optional Message to Reply To, Extra kwargs for post command)
 	async def get_response(self, text, request, channel):
+		# Turn the request away if its guild or user has used up their share
+		guild_id = getattr(request.guild, 'id', None)
+		if self.admission and not self.admission.admit(guild_id, request.author.id):
+			metrics.increment('responses', callsign=self.callsign, outcome='busy')
+			return [self.admission.busy_message, request]
+
 		if self.manual_timer or self.check_cooldown_timer():
-			response = await self.respond_with_context(text, request, channel)
+			metrics.increment('responses', callsign=self.callsign, outcome='ok')
+			response = None
+			started_at = time.perf_counter()
+			try: # (streamed replies are only profiled up to their first words, the rest is read while posting)
+				with profiling.profile(self.callsign), \
+						self.ai_context(self.callsign, guild_id, self.get_ai_priority(request)):
+					response = await self.respond_with_context(text, request, channel)
+			finally:
+				self.observe_response_time(response[0] if response else None, started_at)
 			if self.log_response:
 				self.log(response[0])
 			self.last_message_at = datetime.now()
 			return response
 		else:
+			if self.admission: # It never got to use its share
+				self.admission.refund(guild_id, request.author.id)
+			metrics.increment('responses', callsign=self.callsign, outcome='cooldown')
 			return ['!{} is on cooldown ({}s left)'.format(
 				self.callsign, self.get_cooldown_time()), request]
 	
+	# Record how long a response took, in response_seconds
+	#   Streamed replies are timed until they are finished (see post_stream), not just to their first words
+	def observe_response_time(self, reply, started_at):
+		observe = lambda _: metrics.observe('response_seconds', time.perf_counter() - started_at, callsign=self.callsign)
+		if isinstance(reply, aiapi.StreamedCompletion):
+			reply.on_close.append(observe)
+		else:
+			observe(reply)
+
 	# Autofire response will provide the channel which we are responding to and nothing else
 	# Should return a string containing the response.
 	async def autofire_response(self, channel: object) -> str:
@@ -73,28 +132,40 @@ class ResponseInterface:
 	# Peroform the autofire delay loop
 	# Currently only posts in one channel but that works for now
 	async def perform_autofire(self, channel: object):
-		while self.inactivity_autofire > 30:
-			self.autofiring = True
-			wait_period = self.last_message_at + timedelta(seconds = self.inactivity_autofire) - datetime.now()
-			if wait_period > timedelta(): # > 0, basically
-				await asyncio.sleep(wait_period.total_seconds() + 1)
-			else:
-				text = await self.autofire_response(channel)
-				if text:
-					await self.post(text, channel, {}, is_reply=False)
-				self.last_message_at = datetime.now()
-		self.autofiring = False
+		try:
+			while self.inactivity_autofire > 30:
+				self.autofiring = True
+				wait_period = self.last_message_at + timedelta(seconds = self.inactivity_autofire) - datetime.now()
+				if wait_period > timedelta(): # > 0, basically
+					await asyncio.sleep(wait_period.total_seconds() + 1)
+				else:
+					with self.ai_context(self.callsign + ':autofire', getattr(channel.guild, 'id', None), aipriority.AUTOFIRE):
+						text = await self.autofire_response(channel)
+					if text:
+						await self.post(text, channel, {}, is_reply=False)
+					self.last_message_at = datetime.now()
+		finally: # Also when the loop is cancelled or fails, so it can be started again
+			self.autofiring = False
+
+	# The priority of the ai requests made for a request (see ai_priority)
+	def get_ai_priority(self, request):
+		return self.ai_priority
+
+	# Set up the ai requests made inside the block: their deadline, priority, and who they're
+	#   accounted to (see lib/aiguard.py, lib/aipriority.py and lib/aiusage.py)
+	@contextmanager
+	def ai_context(self, account, guild_id, priority):
+		with aiguard.deadline(self.ai_deadline), aipriority.priority(priority), aiusage.account(account, guild_id):
+			yield
 
 	# Check if the cooldown timer has elapsed, updating it on success
 	def check_cooldown_timer(self):
-		if datetime.now() - self.cooldown > self.last_use:
-			self.last_use = datetime.now()
-			return True
-		else: return False
+		return sharedstate.store.claim('cooldown.' + self.callsign, self.cooldown.total_seconds(), datetime.now().timestamp())
 		
 	# Get the remaining cooldown time in seconds
 	def get_cooldown_time(self):
-		return ((self.cooldown + self.last_use) - datetime.now()).seconds
+		last_use = datetime.fromtimestamp(sharedstate.store.get('cooldown.' + self.callsign, 0.0))
+		return ((self.cooldown + last_use) - datetime.now()).seconds
 	
 	# Get the detailed help text of a response
 	def get_help(self) -> str:
@@ -104,4 +175,9 @@ class ResponseInterface:
 	def log(self, text: str):
 		with open(f"logs/{self.callsign}.log", "a") as logfile:
 			logfile.write(datetime.now().strftime("%y/%m/%d %H:%M:%S.%f") + ":\n")
-			logfile.write(text + "\n")
\ No newline at end of file
+			logfile.write(text + "\n")
+
+# Process pool initializer which runs each of the responses' worker initializers
+def run_worker_initializers(initializers):
+	for initializer in initializers:
+		initializer()
\ No newline at end of file
@@ -1,22 +1,21 @@
-import asyncio
 from .response import ResponseInterface
-from lib import selfawareness, aiapi
+from lib import selfawareness, aiapi, aipriority, sharedstate
 from lib.discord_helpers import get_history, package_discord_images
 
-class ThreadSafeLock:
-    def __init__(self):
-        self._lock = None
-
-    def __call__(self):
-        if self._lock is None: # If i multithread this ever, i need to use a differnt lock.
-            self._lock = asyncio.Lock()
-        return self._lock
-
-# Initialize once (e.g., in bot setup)
-self_aware_single_state_lock = ThreadSafeLock()
+# Only one response can update the state file at a time (across every shard, see lib/sharedstate)
+SELF_AWARE_STATE_LOCK = 'selfaware_state'
 
 class SelfAwareResponse(ResponseInterface):
 	callsign = '_selfaware'
+	admission_controlled = True
+	cache_ai_replies = False # Autofires see the same history again, and should still say something new
+	ai_deadline = 180 # Also covers the image it might post afterwards (the background post shares the deadline)
+
+	# Somebody mentioning the bot is waiting on it, just like for _chat
+	def get_ai_priority(self, request):
+		if any(map(self.is_me, request.mentions)):
+			return aipriority.INTERACTIVE
+		return self.ai_priority
 
 	# Generate a chat completion reply to the existing chat log
 	async def respond_to_message(self, text, request):
@@ -37,13 +36,13 @@ class SelfAwareResponse(ResponseInterface):
 		all_users = channel.members
 		humans = [user for user in all_users if (not user.bot)]
 		me = next(user for user in all_users if self.is_me(user))
-		async with self_aware_single_state_lock():
+		async with sharedstate.store.lock(SELF_AWARE_STATE_LOCK):
 			state = selfawareness.load_state()
 			prompt = selfawareness.construct_prompt(state, channel)
-			response = await aiapi.respond_to_messages_with_customized_prompt(messages, prompt, self.is_me)
+			response = await aiapi.respond_to_messages_with_customized_prompt(messages, prompt, self.is_me, cache=self.cache_ai_replies)
 			self.log(response) # Log the unedited version of the response, before the special commands are removed
 			response = await selfawareness.handle_ai_commands(response, state, humans, me)
-			self.run_in_background(self.check_for_additional_posts(response, channel))
+			self.run_in_background(self.check_for_additional_posts(response, channel), kind='post')
 			self.inactivity_autofire = state.autoresponse_timer
 			selfawareness.save_state(state)
 			return response.clean_reply
@@ -52,7 +51,8 @@ class SelfAwareResponse(ResponseInterface):
 	async def check_for_additional_posts(self, response: selfawareness.SelfAwareCommandResult, channel):
 		# Check for images
 		if response.image_description:
-			image, err = await aiapi.get_image_generation(response.image_description)
+			with aipriority.priority(aipriority.BACKGROUND): # Nobody is waiting on it, it can go after everything else
+				image, err = await aiapi.get_image_generation(response.image_description)
 			if image:
 				images = package_discord_images([image])
 				if response.image_post_title: # Titles are optional
@@ -0,0 +1,102 @@
+from .response import ResponseInterface
+from . import MANIFEST
+import asyncio
+import time
+from lib import aiusage, metrics, profiling
+from lib.discord_helpers import is_admin
+
+# Admin only view of the bot's performance metrics (hidden from the command list)
+class Stats(ResponseInterface):
+  callsign = 'stats'
+
+  async def respond_to_message(self, text, request):
+    if not is_admin(request.author):
+      return "Sorry, that's for admins only. :spy:"
+    return metrics.registry.summary(text.strip()) or 'Nothing has been recorded yet.'
+
+  # Get the help text for the module
+  def get_help(self):
+    return f'!{self.callsign} [filter] will show latency percentiles, counters and gauges (admins only).\n' + \
+           f'> eg. "!{self.callsign} ai_request" only shows metrics with "ai_request" in their name.'
+
+# Admin only switch to profile a command for its next few invocations (see lib/profiling.py)
+class Profile(ResponseInterface):
+  callsign = 'profile'
+
+  async def respond_to_message(self, text, request):
+    if not is_admin(request.author):
+      return "Sorry, that's for admins only. :spy:"
+
+    args = text.split()
+    if not args:
+      targets = profiling.get_targets()
+      if not targets:
+        return 'Nothing is being profiled right now.'
+      return 'Currently profiling: ' + ', '.join(f'!{c} ({n} left)' for c, n in targets.items())
+
+    # Stop profiling early
+    if args[0].lower() == 'stop' and len(args) == 2:
+      path = profiling.disable(args[1])
+      return f'Stopped profiling !{args[1]}' + (f', results are in {path}' if path else '.')
+
+    samples = int(args[1]) if len(args) > 1 and args[1].isdigit() else profiling.DEFAULT_SAMPLES
+    profiling.enable(args[0], samples)
+    return f'Profiling the next {samples} uses of !{args[0]}, results will be written to logs/'
+
+  # Get the help text for the module
+  def get_help(self):
+    return f'!{self.callsign} Usage (admins only):\n' + \
+           f'> "!{self.callsign}" to see which commands are being profiled.\n' + \
+           f'> "!{self.callsign} <command> [samples]" to profile the next [samples] uses of a command.\n' + \
+           f'> "!{self.callsign} stop <command>" to stop early and write out the results.'
+
+# Admin only report of what the ai requests have cost, from the usage log (see lib/aiusage.py)
+class Usage(ResponseInterface):
+  callsign = 'usage'
+
+  DEFAULT_DAYS = 7
+  MAX_ROWS = 15 # (to stay inside discord's message length limit)
+
+  async def respond_to_message(self, text, request):
+    if not is_admin(request.author):
+      return "Sorry, that's for admins only. :spy:"
+
+    args = text.lower().split()
+    days = next((float(arg) for arg in args if arg.replace('.', '', 1).isdigit()), self.DEFAULT_DAYS)
+    by = [arg for arg in args if not arg.replace('.', '', 1).isdigit()] or ['model']
+    if not set(by) <= aiusage.GROUPS.keys():
+      return 'Usage can be grouped by: ' + ', '.join(aiusage.GROUPS)
+
+    await aiusage.log.flush() # Include the requests that havent been written yet
+    rows = await asyncio.to_thread(aiusage.log.rollup, by, time.time() - days * 86400, self.MAX_ROWS)
+    return f'AI usage over the last {days:g} days, by {" and ".join(by)}:\n' + aiusage.format_rollup(rows, by)
+
+  # Get the help text for the module
+  def get_help(self):
+    return f'!{self.callsign} [grouping...] [days] will show the ai tokens and latency used (admins only).\n' + \
+           f'> Group by any of {", ".join(aiusage.GROUPS)} (default model), over the last [days] days (default {self.DEFAULT_DAYS}).\n' + \
+           f'> eg. "!{self.callsign} guild callsign 30"'
+
+# Admin only command to reload the code of a response module, without restarting the bot
+class Reload(ResponseInterface):
+  callsign = 'reload'
+
+  reload_module = None # Delegate: def reload_module(name) -> [callsigns] (set by the bot)
+
+  async def respond_to_message(self, text, request):
+    if not is_admin(request.author):
+      return "Sorry, that's for admins only. :spy:"
+
+    name = text.strip().lower()
+    if name not in MANIFEST:
+      return 'Reloadable modules: ' + ', '.join(MANIFEST)
+    try:
+      callsigns = self.reload_module(name)
+    except Exception as e:
+      return f'Could not reload {name}, the old version is still running: {e!r}'
+    return f'Reloaded {name}: ' + ', '.join(f'!{c}' for c in callsigns)
+
+  # Get the help text for the module
+  def get_help(self):
+    return f'!{self.callsign} <module> will reload the code of a response module, eg. "!{self.callsign} aichat" (admins only).\n' + \
+           f'> "!{self.callsign}" lists the modules.'
@@ -0,0 +1,97 @@
+# Fair-share admission control for expensive (ai) commands
+#   Every guild and every user gets a token bucket. A request has to take a token from both
+#   its guild's and its user's bucket, so one busy server cant starve everybody else.
+import time
+
+# Default bucket sizes. Capacity is the allowed burst, rate is tokens refilled per second
+GUILD_CAPACITY = 20
+GUILD_RATE = 0.2 # 12 requests/minute per guild once the burst is used up
+USER_CAPACITY = 5
+USER_RATE = 0.05 # 3 requests/minute per user once the burst is used up
+
+# Text to reply with when a request is turned away
+BUSY_MESSAGE = "I'm a little swamped right now, try again in a bit :sweat:"
+
+# Number of admissions between sweeps of full (and therefore forgettable) buckets
+SWEEP_INTERVAL = 1000
+
+class TokenBucket():
+  __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+  def __init__(self, capacity, rate, now):
+    self.capacity = capacity
+    self.rate = rate
+    self.tokens = float(capacity)
+    self.updated = now
+
+  # Top up the bucket with whatever has trickled in since it was last touched
+  def refill(self, now):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    return self.tokens
+
+class AdmissionControl():
+  # guild_limits optionally overrides the (capacity, rate) of specific guilds, eg. {1234: (40, 0.5)}
+  def __init__(self, guild_capacity=GUILD_CAPACITY, guild_rate=GUILD_RATE,
+               user_capacity=USER_CAPACITY, user_rate=USER_RATE, guild_limits=None,
+               busy_message=BUSY_MESSAGE, clock=time.monotonic):
+    self.guild_limit = (guild_capacity, guild_rate)
+    self.user_limit = (user_capacity, user_rate)
+    self.guild_limits = guild_limits or {}
+    self.busy_message = busy_message
+    self.clock = clock
+
+    self._guilds = {}
+    self._users = {}
+    self._since_sweep = 0
+
+  # Try to admit a request, taking one token from the guild and the user if both can afford it
+  #   DMs (guild_id None) only have the user's bucket
+  def admit(self, guild_id, user_id):
+    now = self.clock()
+    buckets = [self._get_bucket(self._users, (guild_id, user_id), self.user_limit, now)]
+    if guild_id is not None:
+      buckets.append(self._get_bucket(self._guilds, guild_id, self.guild_limits.get(guild_id, self.guild_limit), now))
+
+    admitted = all(bucket.refill(now) >= 1 for bucket in buckets)
+    if admitted:
+      for bucket in buckets:
+        bucket.tokens -= 1
+
+    self._since_sweep += 1
+    if self._since_sweep >= SWEEP_INTERVAL:
+      self.sweep(now)
+    return admitted
+
+  # Give back the tokens of a request that was admitted but then not run (eg. it was on cooldown)
+  def refund(self, guild_id, user_id):
+    now = self.clock()
+    buckets = [self._users.get((guild_id, user_id))]
+    if guild_id is not None:
+      buckets.append(self._guilds.get(guild_id))
+    for bucket in buckets:
+      if bucket is not None:
+        bucket.tokens = min(bucket.capacity, bucket.refill(now) + 1)
+
+  # Get the current bucket levels, eg. {'guilds': {guild: tokens}, 'users': {(guild, user): tokens}}
+  #   Guilds/users without a bucket have a full one
+  def get_levels(self):
+    now = self.clock()
+    return {
+      'guilds': {key: bucket.refill(now) for key, bucket in self._guilds.items()},
+      'users': {key: bucket.refill(now) for key, bucket in self._users.items()},
+    }
+
+  # Forget about buckets that have refilled completely (same as a new one), to keep memory bounded
+  def sweep(self, now=None):
+    now = self.clock() if now is None else now
+    for buckets in (self._guilds, self._users):
+      for key in [key for key, bucket in buckets.items() if bucket.refill(now) >= bucket.capacity]:
+        del buckets[key]
+    self._since_sweep = 0
+
+  def _get_bucket(self, buckets, key, limit, now):
+    bucket = buckets.get(key)
+    if bucket is None:
+      bucket = buckets[key] = TokenBucket(*limit, now)
+    return bucket
@@ -1,14 +1,26 @@
+import os
 import re
+import asyncio
 import base64
+import time
 from io import BytesIO
 from typing import Tuple
-from openai import AsyncOpenAI
+from . import aiguard, aipriority, aiusage, attachments, metrics
+from .aicache import RequestCache, FormatCache, make_key
+from .aicontext import estimate_tokens, estimate_text_tokens, fit_to_budget
+from .airouting import LatencyTracker, hedged
 from .aiprompts import get_prompt
-from .discord_helpers import get_username, strip_flags, get_attached_images, has_images
+from .discord_helpers import get_username, strip_flags, get_image_attachments, has_images
 
 # Number of tokens allowed per model
 DEFAULT_TOKENS = 2048 # Default Value
 MAX_TOKENS = {} # Specific Overridees
+TEMPERATURE = 0.90
+
+# Number of tokens of input (prompt and chat history) sent to each model
+#   Older messages are left out, and long ones cut short, to fit (see lib/aicontext.py)
+DEFAULT_INPUT_TOKENS = int(os.getenv('AI_INPUT_TOKENS', '6000')) # Default Value
+INPUT_TOKENS = {} # Specific Overrides
 
 GPT4 = 'gpt-4o-mini'
 GPT4_VISION = 'gpt-4o' # updated GPT4 models have built-in visual analysis
@@ -18,79 +30,532 @@ DS_CHAT = 'deepseek-chat'
 DS_REASON = 'deepseek-reasoner'
 DS_MODELS = [DS_CHAT, DS_REASON]
 
-# Check if we've initialized the openai api yet,
-#   And get the secret key from local file if not
-openai_token = None
-deepseek_token = None
+# The closest model on the other provider, to hedge or fail over to (see lib/airouting.py)
+#   Visual models have no equivalent, since deepseek cant see images
+FALLBACK_MODELS = {DS_CHAT: GPT4, DS_REASON: GPT4, GPT4: DS_CHAT}
+# Models whose fallback isnt an equivalent, so it is only used when they fail (never raced against them)
+#   The reasoner says nothing until it has finished thinking, so it would almost always lose the race
+FAILOVER_ONLY = {DS_REASON}
+
+# What to reply with when no model could answer (the error itself is printed)
+ERROR_REPLY = "i cant think right now, try again in a bit :dizzy_face:"
+
+# Where each provider's api lives, and the local file holding its secret key
+#   Both can be overridden from the environment (eg. to load test against a local stand-in
+#   server, see benchmarks/fake_openai.py): <PROVIDER>_BASE_URL and <PROVIDER>_API_KEY for one
+#   provider, or AI_BASE_URL to send every provider's requests to the same place
+PROVIDERS = {
+  'deepseek': {'base_url': 'https://api.deepseek.com', 'keyfile': 'keys/deepseek_apikey.txt'},
+  'openai': {'base_url': 'https://api.openai.com/v1', 'keyfile': 'keys/openai_apikey.txt'},
+}
+
+# Get the name of the provider that serves a model
+def get_provider(model):
+  return 'deepseek' if model in DS_MODELS else 'openai'
+
+# Check if we have a key for a provider (without one, its never failed over to)
+#   Missing keys are remembered too, so the key file isnt looked for on every request
+missing_api_keys = set()
+def has_api_key(provider):
+  if provider in missing_api_keys:
+    return False
+  try:
+    return bool(get_api_key(provider))
+  except OSError:
+    missing_api_keys.add(provider)
+    return False
+
+# Get the base url to send a provider's requests to
+def get_base_url(provider):
+  return os.getenv(provider.upper() + '_BASE_URL') or os.getenv('AI_BASE_URL') or PROVIDERS[provider]['base_url']
+
+# Check if we've loaded the provider's key yet,
+#   And get it from the environment or the local file if not
+api_keys = {}
+def get_api_key(provider):
+  if provider not in api_keys:
+    key = os.getenv(provider.upper() + '_API_KEY')
+    if not key:
+      with open(PROVIDERS[provider]['keyfile'], "r") as tokenfile:
+        key = tokenfile.read().strip()
+    api_keys[provider] = key
+  return api_keys[provider]
+
+# Connection pool, timeout (seconds) and retry settings of the api clients
+MAX_CONNECTIONS = int(os.getenv('AI_MAX_CONNECTIONS', '100'))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('AI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+KEEPALIVE_EXPIRY = float(os.getenv('AI_KEEPALIVE_EXPIRY', '120'))
+CONNECT_TIMEOUT = float(os.getenv('AI_CONNECT_TIMEOUT', '10'))
+REQUEST_TIMEOUT = float(os.getenv('AI_REQUEST_TIMEOUT', '300'))
+MAX_RETRIES = int(os.getenv('AI_MAX_RETRIES', '2')) # (done by us, not the clients, see lib/aiguard.py)
+
+# Failures in a row that open a provider's circuit breaker, and how long it stays open (seconds)
+BREAKER_THRESHOLD = int(os.getenv('AI_BREAKER_THRESHOLD', '5'))
+BREAKER_RESET_AFTER = float(os.getenv('AI_BREAKER_RESET_AFTER', '30'))
+
+# Most requests in flight to each provider at once, and how many more can wait for a turn
+#   before the least important ones are turned away (see lib/aipriority.py)
+PROVIDER_CONCURRENCY = int(os.getenv('AI_PROVIDER_CONCURRENCY', '16'))
+MAX_QUEUED = int(os.getenv('AI_MAX_QUEUED', '64'))
+
+# Whether replies that can be streamed (see get_response_to_chat) are, or are always posted all at once
+STREAMING = os.getenv('AI_STREAMING', '1') != '0'
+
+# How long answers are kept to answer identical requests (seconds), and how many of them at most
+CACHE_TTL = float(os.getenv('AI_CACHE_TTL', '30'))
+CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', '256'))
+
+# Identical chat requests share one answer (see lib/aicache.py)
+request_cache = RequestCache(CACHE_TTL, CACHE_SIZE)
+
+# Messages already converted by convert_to_openai_format (and how many to keep)
+FORMAT_CACHE_SIZE = int(os.getenv('AI_FORMAT_CACHE_SIZE', '5000'))
+format_cache = FormatCache(FORMAT_CACHE_SIZE)
+
+# Whether slow requests are hedged with a backup model (failing over on errors happens either way)
+HEDGING = os.getenv('AI_HEDGING', '1') != '0'
+# How long to wait before hedging a model with too few latencies recorded yet, and the least
+#   time to wait once there are enough (seconds)
+HEDGE_AFTER = float(os.getenv('AI_HEDGE_AFTER', '10'))
+MIN_HEDGE_AFTER = float(os.getenv('AI_MIN_HEDGE_AFTER', '1'))
+
+# Recent time to answer of each model (the time to the first words, for streamed replies)
+latencies = LatencyTracker()
+
+# Each provider's circuit breaker (see lib/aiguard.py)
+breakers = {}
+
+# Get the circuit breaker of a provider
+def get_breaker(provider):
+  breaker = breakers.get(provider)
+  if breaker is None:
+    breaker = breakers[provider] = aiguard.CircuitBreaker(provider, BREAKER_THRESHOLD, BREAKER_RESET_AFTER, on_breaker_change)
+  return breaker
+
+def on_breaker_change(breaker, old):
+  metrics.increment('ai_breaker_transitions', provider=breaker.name, to=breaker.state)
+  print(f'ai circuit breaker for {breaker.name}: {old} -> {breaker.state}')
+
+# Each provider's concurrency limiter (see lib/aipriority.py)
+limiters = {}
+
+# Get the concurrency limiter of a provider
+def get_limiter(provider):
+  limiter = limiters.get(provider)
+  if limiter is None:
+    limiter = limiters[provider] = aipriority.PriorityLimiter(provider, PROVIDER_CONCURRENCY, MAX_QUEUED)
+    metrics.register_collector(limiter.collect_metrics)
+  return limiter
+
+# Check if an error is the provider's fault, and might go away if the request is tried again
+#   (timeouts, dropped connections, rate limits and server errors)
+def is_transient(error):
+  if isinstance(error, (aiguard.BreakerOpen, aiguard.DeadlineExceeded)):
+    return False
+  if isinstance(error, TimeoutError):
+    return True
+  status = getattr(error, 'status_code', None)
+  if status is not None:
+    return status in (408, 409, 429) or status >= 500
+  import openai
+  return isinstance(error, openai.APIConnectionError) # (includes the client's own timeouts)
+
+# Make a request to a model's provider: once one of its slots is free for the current priority
+#   (see lib/aipriority.py), through its circuit breaker and within the current deadline
+#   (see lib/aiguard.py), retrying transient errors up to MAX_RETRIES times
+#   request is an async function taking the timeout (seconds) to give the client
+async def call_provider(model, request):
+  provider = get_provider(model)
+  breaker = get_breaker(provider)
+  limiter = get_limiter(provider)
+
+  async def attempt():
+    await asyncio.wait_for(limiter.acquire(aipriority.current()), aiguard.time_left())
+    try:
+      timeout = aiguard.time_left(REQUEST_TIMEOUT)
+      if timeout <= 0:
+        raise aiguard.DeadlineExceeded(f'no time left for a request to {model}')
+      reply = await breaker.call(lambda: asyncio.wait_for(request(timeout), timeout), is_transient)
+    except BaseException:
+      limiter.release()
+      raise
+    if isinstance(reply, StreamedCompletion):
+      reply.on_close.append(lambda _: limiter.release()) # A streamed reply keeps its slot until it is closed
+    else:
+      limiter.release()
+    return reply
+
+  def on_retry(error):
+    metrics.increment('ai_retries', provider=provider, model=model)
+    print(f'retrying ai request to {model} after {error!r}')
+
+  try:
+    return await aiguard.retry(attempt, MAX_RETRIES + 1, is_transient, on_retry)
+  except aiguard.BreakerOpen:
+    metrics.increment('ai_breaker_rejections', provider=provider, model=model)
+    raise
+
+# One long lived client per provider and base url, so connections are kept alive and reused
+clients = {}
+
+# Get the api client for the provider of a model
 def get_client(model):
-  if model in DS_MODELS:
-    global deepseek_token
-    if not deepseek_token:
-      with open("keys/deepseek_apikey.txt", "r") as tokenfile:
-        deepseek_token = tokenfile.read().strip()
-    return AsyncOpenAI(api_key=deepseek_token, base_url='https://api.deepseek.com')
+  provider = get_provider(model)
+  key = (provider, get_base_url(provider))
+  client = clients.get(key)
+  if client is None:
+    client = clients[key] = make_client(*key)
+  return client
 
-  else:
-    global openai_token
-    if not openai_token:
-      with open("keys/openai_apikey.txt", "r") as tokenfile:
-        openai_token = tokenfile.read().strip()
-    return AsyncOpenAI(api_key=openai_token)
+# Make a client with our connection limits and timeouts
+def make_client(provider, base_url):
+  import openai # Slow to import, so its loaded in the background at startup instead
+  import httpx
+  limits = httpx.Limits(
+    max_connections=MAX_CONNECTIONS,
+    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=KEEPALIVE_EXPIRY)
+  timeout = openai.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+  http_client = openai.DefaultAsyncHttpxClient(limits=limits, timeout=timeout,
+    event_hooks={'request': [track_connections(provider)]})
+  metrics.register_collector(collect_metrics)
+  return openai.AsyncOpenAI(api_key=get_api_key(provider), base_url=base_url,
+    http_client=http_client, timeout=timeout, max_retries=0)
+
+# Close every client (and their connections), eg. when shutting down
+async def close_clients():
+  for client in clients.values():
+    await client.close()
+  clients.clear()
+
+# Make a request hook that counts requests, and the new connections/tls handshakes they needed
+#   (through httpcore's request tracing), to show how often connections get reused
+def track_connections(provider):
+  async def trace(event, info):
+    if event == 'connection.connect_tcp.complete':
+      metrics.increment('ai_connections_opened', provider=provider)
+    elif event == 'connection.start_tls.complete':
+      metrics.increment('ai_tls_handshakes', provider=provider)
+
+  async def on_request(request):
+    metrics.increment('ai_http_requests', provider=provider)
+    request.extensions['trace'] = trace
+  return on_request
+
+# Gauges of the clients, and the share of requests that reused an open connection
+def collect_metrics():
+  requests = metrics.registry.counters.get('ai_http_requests', {})
+  opened = metrics.registry.counters.get('ai_connections_opened', {})
+  gauges = [('ai_clients', {}, len(clients)), ('ai_cache_entries', {}, len(request_cache.entries))]
+  gauges += [('ai_format_cache_messages', {}, len(format_cache.messages)),
+    ('ai_format_cache_lookups', {'outcome': 'hit'}, format_cache.hits),
+    ('ai_format_cache_lookups', {'outcome': 'miss'}, format_cache.misses),
+    ('ai_format_cache_hit_ratio', {}, format_cache.hit_ratio())]
+  gauges += [('ai_breaker_state', {'provider': provider}, aiguard.STATE_VALUES[breaker.state])
+    for provider, breaker in breakers.items()]
+  gauges += [('ai_latency_p95_seconds', {'provider': get_provider(model), 'model': model}, latencies.percentile(model))
+    for model in latencies.latencies if latencies.percentile(model) is not None]
+  gauges += [('ai_connection_reuse_ratio', dict(key), 1 - opened.get(key, 0) / count)
+    for key, count in requests.items() if count]
+  return gauges
 
 # Get a response for a set prompt
-async def get_response_to_chat(messages, model=DS_CHAT):
+#   If stream is True (and streaming is turned on), this returns a StreamedCompletion as soon as
+#   the model starts answering, instead of waiting for the whole reply.
+#   If cache is True, an identical request made at about the same time shares its answer
+#   (which is then always plain text)
+#   Slow or failed requests are retried on the fallback model (see route_chat), and if nothing
+#   can answer (or the deadline of the command passes, see lib/aiguard.py), ERROR_REPLY is returned
+async def get_response_to_chat(messages, model=DS_CHAT, stream=False, cache=True):
   try:
-    return (await get_client(model).chat.completions.create(
-        model = model,
-        messages = messages,
-        max_tokens = MAX_TOKENS.get(model, DEFAULT_TOKENS),
-        temperature=0.90,
-      )).choices[0].message.content.strip()
+    if not cache:
+      return await route_chat(messages, model, stream)
+    key = make_key(model, messages, max_tokens=MAX_TOKENS.get(model, DEFAULT_TOKENS), temperature=TEMPERATURE)
+    return await request_cache.get_or_request(key, lambda finish: route_chat(messages, model, stream, finish),
+      timeout=aiguard.time_left(REQUEST_TIMEOUT))
   except Exception as e:
-    return str(e)
+    metrics.increment('ai_failed_requests', model=model)
+    print(f'ai request to {model} failed: {e!r}')
+    return ERROR_REPLY
+
+# Get the model to hedge or fail over to, or None if there isnt one
+def get_fallback_model(model):
+  fallback = FALLBACK_MODELS.get(model)
+  return fallback if fallback and has_api_key(get_provider(fallback)) else None
+
+# How long to give a model before hedging it, or None to not hedge
+def get_hedge_after(model):
+  if not HEDGING or model in FAILOVER_ONLY:
+    return None
+  p95 = latencies.percentile(model)
+  return HEDGE_AFTER if p95 is None else max(MIN_HEDGE_AFTER, p95)
+
+# Send a chat request, hedging it (or failing over) to the fallback model (see lib/airouting.py)
+#   finish is called with the finished reply, once there is one (for the request cache)
+async def route_chat(messages, model, stream, finish=None):
+  fallback = get_fallback_model(model)
+  reply, outcome = await hedged(
+    lambda: request_chat(messages, model, stream),
+    (lambda: request_chat(messages, fallback, stream)) if fallback else None,
+    get_hedge_after(model),
+    discard=close_reply)
+  winner = reply.model if isinstance(reply, StreamedCompletion) else (model if outcome == 'primary' else fallback)
+  metrics.increment('ai_routes', model=model, provider=get_provider(winner), outcome=outcome)
+
+  if finish and isinstance(reply, StreamedCompletion):
+    reply.on_done = finish
+  elif finish:
+    finish(reply)
+  return reply
+
+# Clean up a reply that lost a race
+async def close_reply(reply):
+  if isinstance(reply, StreamedCompletion):
+    await reply.close()
+
+# Send a chat request to one model, recording how long it took to answer
+#   Streamed requests wait for the first words, so a stream that stalls before saying anything counts as slow
+#   Only requests that answered are recorded. One cancelled because it lost a race says nothing about
+#   how long it would have taken
+async def request_chat(messages, model, stream):
+  started_at = time.perf_counter()
+  try:
+    reply = await call_provider(model, lambda timeout: send_chat(messages, model, stream, started_at, timeout))
+  except Exception:
+    metrics.increment('ai_errors', model=model)
+    raise
+  latencies.record(model, time.perf_counter() - started_at)
+  return reply
+
+# Send one chat request (for request_chat), giving the client timeout seconds
+#   What it cost is recorded once it is finished (see record_usage)
+async def send_chat(messages, model, stream, started_at, timeout):
+  sent_at = time.perf_counter()
+  reply = None # (a streamed reply records itself, when it is closed)
+  try:
+    if stream and STREAMING:
+      chunks = await get_client(model).chat.completions.create(
+          model = model,
+          messages = messages,
+          max_tokens = MAX_TOKENS.get(model, DEFAULT_TOKENS),
+          temperature=TEMPERATURE,
+          stream=True,
+          stream_options={'include_usage': True},
+          timeout=timeout,
+        )
+      reply = StreamedCompletion(chunks, model, started_at)
+      account = aiusage.current() # (the reply is read later, somewhere else)
+      reply.on_close.append(lambda reply: record_usage(messages, model, reply.outcome, sent_at, reply.usage,
+        reply.text[:len(reply.text) - len(reply.error_text)], reply.first_token, account))
+      try:
+        await reply.start()
+      except BaseException as e:
+        reply.outcome = 'error' if isinstance(e, Exception) else 'cancelled'
+        await asyncio.shield(reply.close())
+        raise
+      return reply
+    with metrics.timer('ai_request_seconds', model=model):
+      completion = await get_client(model).chat.completions.create(
+          model = model,
+          messages = messages,
+          max_tokens = MAX_TOKENS.get(model, DEFAULT_TOKENS),
+          temperature=TEMPERATURE,
+          timeout=timeout,
+        )
+  except asyncio.CancelledError:
+    if reply is None:
+      record_usage(messages, model, 'cancelled', sent_at)
+    raise
+  except Exception:
+    if reply is None:
+      record_usage(messages, model, 'error', sent_at)
+    raise
+  text = completion.choices[0].message.content.strip()
+  record_usage(messages, model, 'ok', sent_at, getattr(completion, 'usage', None), text)
+  return text
+
+# Keep a record of what a chat request cost (see lib/aiusage.py)
+#   usage is the provider's account of the tokens used, if it gave one. Otherwise they're estimated
+#   from the messages sent and the text received (requests that failed before answering cost nothing)
+def record_usage(messages, model, outcome, sent_at, usage=None, text='', first_token=None, account=None):
+  if usage is not None:
+    prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+  else:
+    prompt_tokens = sum(map(estimate_tokens, messages)) if outcome == 'ok' or text else 0
+    completion_tokens = estimate_text_tokens(text)
+  aiusage.log.record(model, get_provider(model), outcome, len(messages), prompt_tokens, completion_tokens,
+    time.perf_counter() - sent_at, first_token, usage is None, account)
+
+# A chat completion that is still being generated
+#   Iterate over it (async for) to get each piece of text as it arrives. text holds everything
+#   received so far. An error part way through adds ERROR_REPLY to the end of the text.
+#   on_done(text) is called with the finished reply (on_done(None, error) if it failed, or
+#   on_done(None) if it was abandoned, even before it was read)
+#   Each of on_close is called with the reply once it is closed, whether it finished or not
+#   Whoever gets a stream has to read it to the end or close() it, to free the provider's
+#   slot, the http response and the request cache's entry
+class StreamedCompletion():
+  def __init__(self, chunks, model, started_at, on_done=None):
+    self.chunks = chunks
+    self.model = model
+    self.started_at = started_at
+    self.on_done = on_done
+    self.text = ''
+    self.empty_text = '' # What to post instead if the model doesnt say anything
+    self._iterator = aiter(chunks)
+    self._first = None
+    self._started = False
+    self._closed = False
+    self.on_close = []
+    self.outcome = 'cancelled' # Until it is read to the end ('ok') or fails ('error')
+    self.error_text = '' # What was added to the text because of an error
+    self.usage = None # The provider's account of the tokens used (sent at the end, if at all)
+    self.first_token = None # Seconds until the first words
+    self.deadline = aiguard.get_deadline() # The reply is read later, outside of the command's deadline
+
+  # Read chunks until the next piece of text (None at the end)
+  #   Raises aiguard.DeadlineExceeded if the deadline it was made under passes first
+  async def _next_delta(self):
+    while True:
+      try:
+        if self.deadline is None:
+          chunk = await anext(self._iterator)
+        else:
+          chunk = await asyncio.wait_for(anext(self._iterator), max(0.0, self.deadline - time.monotonic()))
+      except StopAsyncIteration:
+        return None
+      except asyncio.TimeoutError:
+        raise aiguard.DeadlineExceeded(f'reply from {self.model} ran past its deadline')
+      self.usage = getattr(chunk, 'usage', None) or self.usage
+      delta = chunk.choices[0].delta.content if chunk.choices else None
+      if delta:
+        return delta
+
+  # Wait for the first piece of text (errors before then are raised, instead of added to the text)
+  async def start(self):
+    if not self._started:
+      self._first = await self._next_delta()
+      self._started = True
+      self.first_token = time.perf_counter() - self.started_at
+      metrics.observe('ai_first_token_seconds', self.first_token, model=self.model)
+
+  async def __aiter__(self):
+    result = (None,)
+    try:
+      await self.start()
+      delta = self._first
+      while delta:
+        self.text += delta
+        yield delta
+        delta = await self._next_delta()
+      metrics.observe('ai_request_seconds', time.perf_counter() - self.started_at, model=self.model)
+      self.outcome = 'ok'
+      result = (self.text.strip(),)
+    except Exception as e:
+      metrics.increment('ai_errors', model=self.model)
+      print(f'ai stream from {self.model} failed: {e!r}')
+      result = (None, e)
+      self.outcome = 'error'
+      self.error_text = ('\n' if self.text else '') + ERROR_REPLY
+      self.text += self.error_text
+      error = self.error_text
+      yield error
+    finally:
+      await self.close(*result)
+
+  # Release everything the reply holds on to (only the first call does anything)
+  #   result is what on_done is called with, nothing for a reply that was abandoned
+  async def close(self, *result):
+    if self._closed:
+      return
+    self._closed = True
+    for callback in self.on_close:
+      callback(self)
+    self.on_close = []
+    if self.on_done:
+      self.on_done(*(result or (None,)))
+    await self.chunks.close()
+
+  # The finished reply (or the empty text, if there isnt one)
+  def get_text(self):
+    return self.text.strip() or self.empty_text
+
+# Use a default reply when the model doesnt say anything (for plain and streamed replies alike)
+def or_default(response, default):
+  if isinstance(response, StreamedCompletion):
+    response.empty_text = default
+    return response
+  return response or default
 
 # Generate an image for the requested prompt
 #   Will return (image, title) to post.
 #   If an error is encountered, image will be None,
 #     and the title will be an error message instead
+#   Like chat requests, it goes through the provider's circuit breaker and retries (see call_provider)
 async def get_image_generation(prompt) -> Tuple[BytesIO, str]:
+  sent_at = time.perf_counter()
   try:
-    image_str = (await get_client(IMAGES).images.generate(
-        model=IMAGES,
-        prompt=prompt,
-        size="1024x1024",
-        quality="hd",
-        n=1,
-        response_format='b64_json'
-      )).data[0].b64_json
+    with metrics.timer('ai_request_seconds', model=IMAGES):
+      image_str = (await call_provider(IMAGES, lambda timeout: get_client(IMAGES).images.generate(
+          model=IMAGES,
+          prompt=prompt,
+          size="1024x1024",
+          quality="hd",
+          n=1,
+          response_format='b64_json',
+          timeout=timeout,
+        ))).data[0].b64_json
     image = BytesIO(base64.b64decode(image_str.encode()))
+    aiusage.log.record(IMAGES, get_provider(IMAGES), 'ok', 0, 0, 0, time.perf_counter() - sent_at)
     return image, f'"{prompt}"'
 
   except Exception as e:
+    metrics.increment('ai_errors', model=IMAGES)
+    aiusage.log.record(IMAGES, get_provider(IMAGES), 'error', 0, 0, 0, time.perf_counter() - sent_at)
     return None, str(e)
 
 # Format a list of discord messaegs in openai's preferred format
 def format_message_log(messages, is_me, visual):
   return [convert_to_openai_format(x, is_me, visual) for x in messages]
+
+# Build the messages to send a model: the system prompt (if there is one) and as much of
+#   the chat log (oldest first) as fits in the model's input budget
+#   For visual models, the attached images are downloaded first (see lib/attachments.py)
+async def build_prompt(system, messages, is_me, model, visual):
+  if visual:
+    await attachments.cache.prepare([a for message in messages for a in get_image_attachments(message)])
+  frame = [{"role": "system", "content": system}] if system is not None else []
+  budget = INPUT_TOKENS.get(model, DEFAULT_INPUT_TOKENS) - sum(map(estimate_tokens, frame))
+  return frame + fit_to_budget(format_message_log(messages, is_me, visual), budget)
   
 # Convert a discord message to the openai completion format
 # message - the message to format
 # is_me - a predicate to check if a message was sent by the bot user
 # visual - boolen true/false if image embeds are allowed 
+#   The results are cached (see format_cache), so they shouldnt be modified
+#   Messages with images arent, since their images are large and already cached on their own
 def convert_to_openai_format(message, is_me, visual):
   # The bot's role is "assistant", everything else is user. Flag message appropriatley
   role = "user"
   if is_me(message.author) and not visual:
     role = "assistant"
+  if visual and has_images(message):
+    return format_message(message, role, visual)
+  return format_cache.get(message, (role, visual), lambda: format_message(message, role, visual))
+
+# Convert a discord message to the openai completion format, with the given role (see convert_to_openai_format)
+def format_message(message, role, visual):
   name = gpt_name(get_username(message.author))
 
   # Content is either the text content of the message, or
   #   a formatted dictionary of text and image attachments
+  #   (Images are sent inline if they've been cached, and as links otherwise)
   content = strip_flags(message.content)
-  images = get_attached_images(message) if visual else []
+  images = get_image_attachments(message) if visual else []
   if images:
     content = [{'type':'text', 'text':content}]
-    content += [{'type':'image_url', "image_url": {"url": url}} for url in images]
+    content += [{'type':'image_url', "image_url": {"url": attachments.cache.get_data_url(image) or image.url}}
+      for image in images]
 
   # Return the composed dictionary
   return {"role": role, "content": content, "name": name}
@@ -100,31 +565,31 @@ def convert_to_openai_format(message, is_me, visual):
 # is_me - predicate to identify if a message was sent by the bot user
 # model - the openai model to use when responding
 # visual - true/false if model needs to respond to images
-async def respond_to_messages(messages, is_me, model, visual = False):
+async def respond_to_messages(messages, is_me, model, visual = False, stream = False, cache = True):
   task = get_prompt(messages[0].guild.id, messages[0].channel.id)
-  frame = {"role": "system", "content": task}
-  prompt = [frame] + format_message_log(messages, is_me, visual)
-  return await get_response_to_chat(prompt, model)
+  prompt = await build_prompt(task, messages, is_me, model, visual)
+  return await get_response_to_chat(prompt, model, stream, cache)
 
 # They keep killing my models :(
 #  Use the cheap chat completion model with no prompt instead
 # reply_to is an optional message to reply to
-async def wiggly_chat_response(request, is_me, reply_to, visual):
+async def wiggly_chat_response(request, is_me, reply_to, visual, stream = False, cache = True):
   # Add context in "s if needed
   messages = ([reply_to] if reply_to else []) + [request]
   model = GPT4_VISION if visual else DS_CHAT
-  prompt = format_message_log(messages, is_me, visual)
-  return await get_response_to_chat(prompt, model) or ":confused:"
+  prompt = await build_prompt(None, messages, is_me, model, visual)
+  return or_default(await get_response_to_chat(prompt, model, stream, cache), ":confused:")
 
 # Get a chatgpt response to a series of discord messages.
 # messages - A list of the discord messages to which we are responding.
 # prompt - the custom prompt to use in the response
 # is_me - predicate to identify if a message was sent by the bot user
 # model - the openai model to use when responding
-async def respond_to_messages_with_customized_prompt(messages, prompt, is_me, model=DS_CHAT):
-  frame = {"role": "system", "content": prompt}
-  query = [frame] + format_message_log(messages, is_me, False)
-  return await get_response_to_chat(query, model)
+# stream - if True, the reply may be a StreamedCompletion (see get_response_to_chat)
+# cache - if True, identical requests made at about the same time share an answer
+async def respond_to_messages_with_customized_prompt(messages, prompt, is_me, model=DS_CHAT, stream=False, cache=True):
+  query = await build_prompt(prompt, messages, is_me, model, False)
+  return await get_response_to_chat(query, model, stream, cache)
 
 # Convert all openai friendly name's _id_ to discord id's <@id> in the string
 def name_to_id(text):
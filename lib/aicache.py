@@ -0,0 +1,136 @@
+# Coalescing and caching of identical ai requests
+#   When the same request is already on its way (eg. several people piling on with "!ai" at
+#   once), later copies wait for its answer instead of sending their own. Answers are then kept
+#   for a little while (up to a bounded number, least recently used first out) to answer exact repeats.
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from lib import metrics
+
+# Key identifying a request: a hash of the model, its settings and the messages sent
+#   Messages without any text (eg. a bare "!ai" command) are left out, since they dont change the answer
+def make_key(model, messages, **settings):
+  normalized = []
+  for message in messages:
+    content = message.get('content')
+    if isinstance(content, str):
+      content = content.strip()
+      if not content:
+        continue
+    normalized.append(dict(message, content=content))
+  payload = json.dumps([model, settings, normalized], sort_keys=True, ensure_ascii=False)
+  return hashlib.sha256(payload.encode()).hexdigest()
+
+class RequestCache():
+  # ttl is how long answers are kept (seconds), and max_entries how many of them at most
+  #   Either can be 0 to only share requests that are in flight at the same time
+  def __init__(self, ttl, max_entries, clock=time.monotonic):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.clock = clock
+    self.entries = OrderedDict() # {key: (expires at, text)}, least recently used first
+    self.in_flight = {} # {key: future of (text, error)}
+
+  # Get a cached answer, or None
+  def get(self, key):
+    entry = self.entries.get(key)
+    if entry is None:
+      return None
+    if entry[0] <= self.clock():
+      del self.entries[key]
+      return None
+    self.entries.move_to_end(key)
+    return entry[1]
+
+  def put(self, key, text):
+    if self.ttl <= 0 or self.max_entries <= 0:
+      return
+    self.entries[key] = (self.clock() + self.ttl, text)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+  # Get the answer to a request, only sending it if it isnt cached or already in flight
+  #   request(finish) sends it. It must call finish(text) with the final answer, or
+  #   finish(None, error) if it failed, which may be after it returns (eg. for a streamed answer).
+  #   finish(None) means it was abandoned, and anybody waiting on it sends their own instead.
+  #   Waiting on somebody else's request gives up after timeout seconds.
+  async def get_or_request(self, key, request, timeout=None):
+    text = self.get(key)
+    if text is not None:
+      metrics.increment('ai_cache', outcome='hit')
+      return text
+
+    pending = self.in_flight.get(key)
+    if pending is not None:
+      metrics.increment('ai_cache', outcome='coalesced')
+      text, error = await asyncio.wait_for(asyncio.shield(pending), timeout)
+      if error is not None:
+        raise error
+      if text is None:
+        return await self.get_or_request(key, request, timeout)
+      return text
+
+    metrics.increment('ai_cache', outcome='miss')
+    future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+    finish = lambda text, error=None: self.finish(key, future, text, error)
+    try:
+      return await request(finish)
+    except Exception as e:
+      finish(None, e)
+      raise
+    except BaseException:
+      finish(None)
+      raise
+
+  # Hand a request's answer to everybody waiting on it, and cache it if it succeeded
+  def finish(self, key, future, text, error=None):
+    if future.done():
+      return
+    if self.in_flight.get(key) is future:
+      del self.in_flight[key]
+    future.set_result((text, error))
+    if text is not None and error is None:
+      self.put(key, text)
+
+# Discord messages already converted to the openai format, so the same recent messages dont
+#   have to be formatted again for every request. Entries are kept per message (the least
+#   recently used are dropped first), for each way it was formatted, and only used while the
+#   message is unedited. Edited and deleted messages should also be forgotten with invalidate.
+class FormatCache():
+  def __init__(self, max_messages):
+    self.max_messages = max_messages
+    self.messages = OrderedDict() # {message id: {mode: (edited at, content, formatted)}}
+    self.hits = 0
+    self.misses = 0
+
+  # Get a message's formatted version, making it with format() if it isnt cached
+  #   mode tells apart the different ways a message can be formatted
+  def get(self, message, mode, format):
+    entries = self.messages.get(message.id)
+    entry = entries.get(mode) if entries else None
+    if entry and entry[0] == message.edited_at and entry[1] == message.content:
+      self.hits += 1
+      self.messages.move_to_end(message.id)
+      return entry[2]
+
+    self.misses += 1
+    formatted = format()
+    if self.max_messages > 0:
+      if entries is None:
+        entries = self.messages[message.id] = {}
+        if len(self.messages) > self.max_messages:
+          self.messages.popitem(last=False)
+      entries[mode] = (message.edited_at, message.content, formatted)
+      self.messages.move_to_end(message.id)
+    return formatted
+
+  def invalidate(self, message_id):
+    self.messages.pop(message_id, None)
+
+  # Share of lookups answered from the cache
+  def hit_ratio(self):
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups else 0.0
@@ -0,0 +1,69 @@
+# Token budgeting of the chat history sent to the ai
+#   Tokens are estimated locally (about 4 characters a token, which is close enough to both
+#   providers' tokenizers for english) so the history can be trimmed to fit before it is sent.
+#   The newest messages are kept first. Long messages are cut short, so one long paste cant push
+#   the rest of the conversation out, and the older messages that dont fit are left out.
+from lib import metrics
+
+CHARS_PER_TOKEN = 4
+MESSAGE_TOKENS = 4 # for each message's role and separators
+IMAGE_TOKENS = 765 # for an attached image (about what a 1024x1024 image costs at high detail)
+MAX_MESSAGE_SHARE = 0.5 # most of the budget any one message can use (except the newest)
+MIN_TRUNCATED_TOKENS = 32 # messages arent cut shorter than this, they're left out instead
+TRUNCATION_MARK = '...'
+
+# Estimate the tokens in some text
+def estimate_text_tokens(text):
+  return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+# Estimate the tokens in a message (in the openai format, see aiapi.convert_to_openai_format)
+def estimate_tokens(message):
+  tokens = MESSAGE_TOKENS + estimate_text_tokens(message.get('name', ''))
+  content = message['content']
+  if isinstance(content, str):
+    return tokens + estimate_text_tokens(content)
+  for part in content:
+    tokens += estimate_text_tokens(part['text']) if part['type'] == 'text' else IMAGE_TOKENS
+  return tokens
+
+# Cut a message's text short so the message fits in a number of tokens
+#   Returns a shortened copy, or None if it cant be made to fit
+def truncate(message, tokens):
+  spare = tokens - (estimate_tokens(message) - estimate_text_tokens(get_text(message)))
+  if spare < MIN_TRUNCATED_TOKENS:
+    return None
+  text = get_text(message)[:spare * CHARS_PER_TOKEN - len(TRUNCATION_MARK)] + TRUNCATION_MARK
+  if isinstance(message['content'], str):
+    return dict(message, content=text)
+  return dict(message, content=[dict(part, text=text) if part['type'] == 'text' else part for part in message['content']])
+
+# Get the text of a message (without any images)
+def get_text(message):
+  content = message['content']
+  if isinstance(content, str):
+    return content
+  return ''.join(part['text'] for part in content if part['type'] == 'text')
+
+# Fit a chat history (oldest first) into a budget of tokens, newest messages first
+#   The newest message is always kept (shortened if needed). Returns the messages that fit, oldest first
+def fit_to_budget(messages, budget):
+  kept = []
+  remaining = budget
+  for message in reversed(messages):
+    limit = min(remaining, int(budget * MAX_MESSAGE_SHARE)) if kept else remaining
+    tokens = estimate_tokens(message)
+    if tokens > limit:
+      shortened = truncate(message, limit)
+      if shortened is None:
+        if not kept:
+          kept.append(message) # Better to send too much than nothing at all
+        break
+      metrics.increment('ai_context_messages', outcome='truncated')
+      message, tokens = shortened, estimate_tokens(shortened)
+    kept.append(message)
+    remaining -= tokens
+
+  if len(kept) < len(messages):
+    metrics.increment('ai_context_messages', len(messages) - len(kept), outcome='dropped')
+  kept.reverse()
+  return kept
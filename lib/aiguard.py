@@ -0,0 +1,147 @@
+# Circuit breakers, deadlines and retries for the ai apis
+#   Each provider has a circuit breaker. After enough failures in a row it opens, and requests to
+#   that provider fail straight away (so they fail over, instead of piling up behind a provider
+#   that is down). Once it has been open for a while, a single trial request is let through
+#   (half open): if it works the breaker closes again, and if not it stays open for another while.
+#   Commands set a deadline for their ai requests, which every request made inside it shares:
+#   the clients are only given the time that is left, and nothing is retried past it.
+#   Transient errors are retried a bounded number of times, with jittered exponential backoff.
+import asyncio
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Breaker states (and the numbers they're reported as)
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Failures in a row that open a breaker, and how long it stays open before a trial request (seconds)
+FAILURE_THRESHOLD = 5
+RESET_AFTER = 30.0
+
+# Backoff between retries: a random time up to base * 2^retry seconds, but never more than the cap
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+
+# Raised instead of making a request while the provider's breaker is open
+class BreakerOpen(Exception):
+  pass
+
+# Raised instead of making (or waiting on) a request after the deadline has passed
+class DeadlineExceeded(TimeoutError):
+  pass
+
+class CircuitBreaker():
+  def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_after=RESET_AFTER, on_change=None):
+    self.name = name
+    self.failure_threshold = failure_threshold
+    self.reset_after = reset_after
+    self.on_change = on_change # Called with (breaker, old state) whenever the state changes
+    self.state = CLOSED
+    self.failures = 0 # failures in a row
+    self.opened_at = 0.0
+    self.trial = False # Whether the half open trial request is in flight
+
+  # Check if a request can be made now (taking the trial request, when half open)
+  def allow(self, now=None):
+    now = time.monotonic() if now is None else now
+    if self.state == OPEN and now - self.opened_at >= self.reset_after:
+      self._set_state(HALF_OPEN)
+    if self.state == HALF_OPEN:
+      if self.trial:
+        return False
+      self.trial = True
+    return self.state != OPEN
+
+  def record_success(self):
+    self.failures = 0
+    self.trial = False
+    self._set_state(CLOSED)
+
+  def record_failure(self, now=None):
+    self.failures += 1
+    self.trial = False
+    if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+      self.opened_at = time.monotonic() if now is None else now
+      self._set_state(OPEN)
+
+  # Give up the trial request without a verdict (eg. it was cancelled)
+  def release(self):
+    self.trial = False
+
+  # Run a request (an async function taking no arguments) through the breaker
+  #   Errors that is_failure says are the provider's fault count against it, anything else
+  #   (eg. a bad request) means it is up. Raises BreakerOpen without calling it if it is open
+  async def call(self, request, is_failure):
+    if not self.allow():
+      raise BreakerOpen(f'{self.name} is unavailable (circuit breaker open)')
+    try:
+      result = await request()
+    except Exception as e:
+      if is_failure(e):
+        self.record_failure()
+      else:
+        self.record_success()
+      raise
+    except BaseException: # Cancelled, so we learned nothing
+      self.release()
+      raise
+    self.record_success()
+    return result
+
+  def _set_state(self, state):
+    if state != self.state:
+      old, self.state = self.state, state
+      if self.on_change:
+        self.on_change(self, old)
+
+# When the ai requests of the current command have to be done by (time.monotonic()), if ever
+_deadline = ContextVar('ai_deadline', default=None)
+
+# Give the ai requests made inside the block (including in tasks started there) a deadline
+#   A nested deadline can only shorten the one around it. None leaves it as it is
+@contextmanager
+def deadline(seconds):
+  if seconds is None:
+    yield
+    return
+  at = time.monotonic() + seconds
+  current = _deadline.get()
+  token = _deadline.set(at if current is None else min(at, current))
+  try:
+    yield
+  finally:
+    _deadline.reset(token)
+
+# Get the current deadline (in time.monotonic() time), or None if there isnt one
+#   For work that carries on outside of the block that set it (eg. reading a streamed reply)
+def get_deadline():
+  return _deadline.get()
+
+# Get the seconds left until the deadline (never below 0), or default if there isnt one
+#   If both are set, the lower of the two
+def time_left(default=None):
+  at = _deadline.get()
+  if at is None:
+    return default
+  left = max(0.0, at - time.monotonic())
+  return left if default is None else min(left, default)
+
+# Run a request (an async function taking no arguments) up to attempts times, retrying the
+#   errors is_retryable says are transient after a jittered backoff. Gives up early if the
+#   backoff would run past the deadline. on_retry is called with each error that gets retried
+async def retry(request, attempts, is_retryable, on_retry=None, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+  for attempt in range(attempts):
+    try:
+      return await request()
+    except Exception as e:
+      delay = random.uniform(0, min(cap, base * 2 ** attempt))
+      left = time_left()
+      if attempt + 1 >= attempts or not is_retryable(e) or (left is not None and delay >= left):
+        raise
+      if on_retry:
+        on_retry(e)
+    await asyncio.sleep(delay)
@@ -0,0 +1,108 @@
+# Priority aware limits on the ai requests in flight to each provider
+#   Each provider only gets so many requests at once. When they're all taken, new requests wait
+#   in a queue, and the next free slot always goes to the most important request waiting:
+#   someone mentioning the bot, then commands, then autofires, then background work (like images
+#   posted after a reply). If too much piles up, the least important queued work is turned away.
+#   The priority of a request comes from the code that made it (see priority()), like deadlines do.
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from lib import metrics
+
+# Priority classes, most important first
+INTERACTIVE = 0
+COMMAND = 1
+AUTOFIRE = 2
+BACKGROUND = 3
+NAMES = ('interactive', 'command', 'autofire', 'background')
+
+# Queued requests this important or less can be turned away when the queue is full
+SHEDDABLE = AUTOFIRE
+
+# Raised to a queued request that was turned away to make room for more important ones
+class QueueFull(Exception):
+  pass
+
+class PriorityLimiter():
+  def __init__(self, name, limit, max_waiting):
+    self.name = name
+    self.limit = limit
+    self.max_waiting = max_waiting
+    self.active = 0
+    self.waiting = [] # heap of [priority, order, future]
+    self._order = itertools.count()
+
+  # Wait for a free slot (call release() when done with it)
+  #   Raises QueueFull if it is turned away while waiting
+  async def acquire(self, priority=COMMAND):
+    started_at = time.perf_counter()
+    if self.active < self.limit and not self.waiting:
+      self.active += 1
+    else:
+      future = asyncio.get_running_loop().create_future()
+      entry = [priority, next(self._order), future]
+      heapq.heappush(self.waiting, entry)
+      self.shed_excess()
+      try:
+        await future
+      except asyncio.CancelledError:
+        if future.done() and not future.cancelled() and future.exception() is None: # It got the slot just as it was cancelled
+          self.release()
+        else:
+          self._remove(entry)
+        raise
+    metrics.observe('ai_queue_wait_seconds', time.perf_counter() - started_at, provider=self.name, priority=NAMES[priority])
+
+  def release(self):
+    self.active -= 1
+    while self.active < self.limit and self.waiting:
+      _, _, future = heapq.heappop(self.waiting)
+      if not future.done():
+        future.set_result(None)
+        self.active += 1
+
+  # Turn away the least important queued requests while there are too many waiting
+  #   (only ones that are SHEDDABLE, everything else just waits its turn)
+  def shed_excess(self):
+    while len(self.waiting) > self.max_waiting:
+      entry = max(self.waiting)
+      if entry[0] < SHEDDABLE:
+        break
+      self._turn_away(entry)
+
+  def _turn_away(self, entry):
+    self._remove(entry)
+    metrics.increment('ai_queue_shed', provider=self.name, priority=NAMES[entry[0]])
+    if not entry[2].done():
+      entry[2].set_exception(QueueFull(f'too many {NAMES[entry[0]]} requests waiting for {self.name}'))
+
+  def _remove(self, entry):
+    if entry in self.waiting:
+      self.waiting.remove(entry)
+      heapq.heapify(self.waiting)
+
+  # Gauges of the slots in use and the queue by priority (read by the metrics registry)
+  def collect_metrics(self):
+    counts = [0] * len(NAMES)
+    for priority, _, _ in self.waiting:
+      counts[priority] += 1
+    gauges = [('ai_requests_active', {'provider': self.name}, self.active)]
+    return gauges + [('ai_queue_waiting', {'provider': self.name, 'priority': name}, count) for name, count in zip(NAMES, counts)]
+
+# The priority of the ai requests made in the current context
+_priority = ContextVar('ai_priority', default=COMMAND)
+
+# Give the ai requests made inside the block (including in tasks started there) a priority
+@contextmanager
+def priority(level):
+  token = _priority.set(level)
+  try:
+    yield
+  finally:
+    _priority.reset(token)
+
+def current():
+  return _priority.get()
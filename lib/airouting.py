@@ -0,0 +1,70 @@
+# Hedged requests, failover and latency tracking for the ai apis
+#   Every model's recent latencies are tracked. When a request takes longer than its model
+#   usually does (the 95th percentile), a backup request is sent to an equivalent model on the
+#   other provider, and whichever answers first wins. A request that fails goes straight to the backup.
+import asyncio
+from collections import deque
+
+# Number of recent latencies kept per model, and how many are needed before hedging on them
+LATENCY_SAMPLES = 200
+MIN_SAMPLES = 20
+
+class LatencyTracker():
+  def __init__(self, samples=LATENCY_SAMPLES, min_samples=MIN_SAMPLES):
+    self.samples = samples
+    self.min_samples = min_samples
+    self.latencies = {} # {model: deque of recent latencies (seconds)}
+
+  def record(self, model, seconds):
+    latencies = self.latencies.get(model)
+    if latencies is None:
+      latencies = self.latencies[model] = deque(maxlen=self.samples)
+    latencies.append(seconds)
+
+  # Get a percentile (0-100) of a model's recent latencies, or None if there arent enough yet
+  def percentile(self, model, p=95):
+    latencies = self.latencies.get(model, ())
+    if len(latencies) < self.min_samples:
+      return None
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+# Run a request, sending a backup request if the first hasnt answered after hedge_after seconds
+#   (None to never hedge), or fails. first and backup are async functions taking no arguments,
+#   and backup can be None. Returns (result, outcome) from whichever succeeds first, where
+#   outcome is 'primary', 'hedge' (the backup won a race) or 'failover' (the first request failed).
+#   discard is called with the result of a request that finished but lost, to clean up after it.
+#   Raises the first error if nothing succeeds.
+async def hedged(first, backup, hedge_after, discard=None):
+  primary = asyncio.ensure_future(first())
+  tasks = {primary}
+  outcome = 'hedge'
+  error = None
+  try:
+    done, _ = await asyncio.wait(tasks, timeout=hedge_after if backup else None)
+    if done and not primary.exception():
+      return primary.result(), 'primary'
+    if done:
+      error = primary.exception()
+      tasks.clear()
+      outcome = 'failover'
+    if backup is None:
+      return await primary, 'primary' # Only reached when there is nothing to hedge with
+    tasks.add(asyncio.ensure_future(backup()))
+
+    while tasks:
+      done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+      winners = [task for task in done if not task.exception()]
+      for task in done:
+        if task.exception() and error is None:
+          error = task.exception()
+      if winners:
+        winner = primary if primary in winners else winners[0]
+        for loser in winners:
+          if loser is not winner and discard:
+            await discard(loser.result())
+        return winner.result(), 'primary' if winner is primary else outcome
+    raise error
+  finally:
+    for task in tasks:
+      task.cancel()
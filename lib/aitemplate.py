@@ -0,0 +1,41 @@
+# Prompt templates that keep the start of a prompt the same from one request to the next
+#   Both providers cache the start of prompts they've seen recently, and charge less (and answer
+#   sooner) for the part of a prompt that matches. So a template is split in two: the static text,
+#   which never changes and always goes first, and the dynamic text after it, whose {fields} are
+#   filled in every time. Put the dynamic sections in order from least to most likely to change,
+#   so as much as possible still matches. Both halves are prepared once, when the template is made.
+import string
+from lib import metrics
+from lib.aicontext import estimate_text_tokens
+
+class PromptTemplate():
+  def __init__(self, name, static, dynamic):
+    self.name = name
+    self.prefix = static.strip() + '\n\n'
+    self.prefix_tokens = estimate_text_tokens(self.prefix)
+    # The dynamic text as [(literal text, field name or None)]
+    self.parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(dynamic.strip('\n'))]
+    self.fields = {field for _, field in self.parts if field is not None}
+    self.last = None # (static, dynamic) estimated tokens of the latest render
+    metrics.register_collector(self.collect_metrics)
+
+  # Fill in the template. Every field has to be given
+  def render(self, **values):
+    missing = self.fields - values.keys()
+    if missing:
+      raise KeyError(f'missing prompt fields: {", ".join(sorted(missing))}')
+    suffix = ''.join(literal + (str(values[field]) if field is not None else '') for literal, field in self.parts)
+    self.last = (self.prefix_tokens, estimate_text_tokens(suffix))
+    metrics.increment('ai_prompt_renders', template=self.name)
+    metrics.increment('ai_prompt_tokens', self.last[0], template=self.name, part='static')
+    metrics.increment('ai_prompt_tokens', self.last[1], template=self.name, part='dynamic')
+    return self.prefix + suffix
+
+  # Gauges of the latest render (read by the metrics registry)
+  def collect_metrics(self):
+    if self.last is None:
+      return []
+    static, dynamic = self.last
+    return [('ai_prompt_last_tokens', {'template': self.name, 'part': 'static'}, static),
+      ('ai_prompt_last_tokens', {'template': self.name, 'part': 'dynamic'}, dynamic),
+      ('ai_prompt_static_share', {'template': self.name}, static / (static + dynamic))]
@@ -0,0 +1,177 @@
+# Accounting of what every ai request cost: tokens, latency, model, and who it was for
+#   Each request made to a provider is kept as one row of an append-only sqlite table (rows are
+#   only ever added), so spending can be broken down by guild, command, model or day afterwards
+#   (see rollup, and the admin only !usage command). Rows are buffered in memory and written in
+#   batches from a background task, so requests never wait on the disk.
+#   Requests are accounted to the command (callsign) and guild set with account() around them.
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from lib import metrics
+
+USAGE_PATH = 'data/ai_usage.db'
+
+# Rows written at once, and the longest a row waits before it is written (seconds)
+BATCH_SIZE = int(os.getenv('AI_USAGE_BATCH', '50'))
+FLUSH_INTERVAL = float(os.getenv('AI_USAGE_FLUSH_INTERVAL', '10'))
+
+# Most rows kept waiting to be written (the oldest are dropped if writing falls this far behind)
+MAX_PENDING = 10000
+
+COLUMNS = ('at', 'model', 'provider', 'callsign', 'guild', 'outcome', 'messages',
+  'prompt_tokens', 'completion_tokens', 'estimated', 'latency', 'first_token')
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS ai_usage(
+  at REAL NOT NULL, -- when the request was made (unix time)
+  model TEXT NOT NULL,
+  provider TEXT NOT NULL,
+  callsign TEXT, -- the command it was for (NULL if it was made outside of one)
+  guild INTEGER,
+  outcome TEXT NOT NULL, -- ok, error or cancelled
+  messages INTEGER NOT NULL, -- chat messages sent (including the system prompt)
+  prompt_tokens INTEGER NOT NULL,
+  completion_tokens INTEGER NOT NULL,
+  estimated INTEGER NOT NULL, -- 1 if the provider didnt say, and the tokens were estimated
+  latency REAL NOT NULL, -- seconds until the whole reply was received
+  first_token REAL -- seconds until the first words of a streamed reply
+)'''
+
+# What rollups can be grouped by, and the sql for each
+GROUPS = {
+  'model': 'model',
+  'provider': 'provider',
+  'callsign': "COALESCE(callsign, '-')",
+  'guild': 'guild',
+  'day': "date(at, 'unixepoch')",
+}
+
+class UsageLog():
+  def __init__(self, path=USAGE_PATH, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+    self.path = path
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.pending = [] # rows waiting to be written
+    self.full = asyncio.Event() # set when a whole batch is waiting
+    self.writer = None # the background task writing batches
+    self._db = None
+    self._lock = threading.Lock() # (the database is used from worker threads)
+
+  # Keep a row for a finished request, accounted to the current command and guild
+  #   (or to account, a (callsign, guild) from current(), if it finished somewhere else)
+  def record(self, model, provider, outcome, messages, prompt_tokens, completion_tokens, latency,
+      first_token=None, estimated=False, account=None):
+    callsign, guild = account or _account.get()
+    self.pending.append((time.time() - latency, model, provider, callsign, guild, outcome, messages,
+      prompt_tokens, completion_tokens, int(estimated), latency, first_token))
+    if len(self.pending) > MAX_PENDING:
+      del self.pending[0]
+      metrics.increment('ai_usage_dropped')
+    if len(self.pending) >= self.batch_size:
+      self.full.set()
+
+  # Start writing batches in the background
+  def start(self):
+    if self.writer is None:
+      self.writer = asyncio.ensure_future(self._write_batches())
+
+  async def _write_batches(self):
+    while True:
+      try:
+        await asyncio.wait_for(self.full.wait(), self.flush_interval)
+      except asyncio.TimeoutError:
+        pass
+      await self.flush()
+
+  # Write out every waiting row now
+  async def flush(self):
+    rows, self.pending = self.pending, []
+    self.full.clear()
+    if not rows:
+      return
+    try:
+      with metrics.timer('ai_usage_write_seconds'):
+        await asyncio.to_thread(self._insert, rows)
+      metrics.increment('ai_usage_rows', len(rows))
+    except Exception as e:
+      metrics.increment('ai_usage_dropped', len(rows))
+      print(f'could not write {len(rows)} ai usage rows: {e!r}')
+
+  def _connect(self):
+    if self._db is None:
+      os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+      self._db = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+      self._db.execute('PRAGMA journal_mode=WAL') # So readers (and other shards) dont block writers
+      self._db.execute(SCHEMA)
+      self._db.execute('CREATE INDEX IF NOT EXISTS ai_usage_at ON ai_usage(at)')
+    return self._db
+
+  def _insert(self, rows):
+    with self._lock:
+      db = self._connect()
+      with db:
+        db.executemany(f'INSERT INTO ai_usage ({", ".join(COLUMNS)}) VALUES ({", ".join("?" * len(COLUMNS))})', rows)
+
+  # Total up the requests made since a time (unix time, None for all of them), grouped by some
+  #   of GROUPS. Returns a list of dicts, the most tokens first: each group's values, plus
+  #   requests, errors, prompt_tokens, completion_tokens, messages (the average sent),
+  #   latency (the average) and max_latency
+  def rollup(self, by=('model',), since=None, limit=20):
+    unknown = set(by) - GROUPS.keys()
+    if unknown:
+      raise ValueError(f'cant group usage by {", ".join(sorted(unknown))}')
+    groups = ''.join(f'{GROUPS[group]} AS {group}, ' for group in by)
+    query = f'''SELECT {groups}COUNT(*), SUM(outcome = 'error'), SUM(prompt_tokens),
+      SUM(completion_tokens), AVG(messages), AVG(latency), MAX(latency)
+      FROM ai_usage WHERE at >= ? {"GROUP BY " + ", ".join(by) if by else ""}
+      ORDER BY SUM(prompt_tokens + completion_tokens) DESC LIMIT ?'''
+    with self._lock:
+      rows = self._connect().execute(query, (since or 0, limit)).fetchall()
+    names = list(by) + ['requests', 'errors', 'prompt_tokens', 'completion_tokens', 'messages', 'latency', 'max_latency']
+    return [dict(zip(names, row)) for row in rows if row[len(by)]] # (no requests at all still gives one empty row)
+
+  # Stop writing in the background, writing out whatever is left
+  async def close(self):
+    if self.writer:
+      self.writer.cancel()
+      await asyncio.gather(self.writer, return_exceptions=True)
+      self.writer = None
+    await self.flush()
+    with self._lock:
+      if self._db:
+        self._db.close()
+        self._db = None
+
+# The command and guild requests made in the current context are accounted to
+_account = ContextVar('ai_account', default=(None, None))
+
+# Account the ai requests made inside the block (including in tasks started there) to a command and guild
+@contextmanager
+def account(callsign, guild):
+  token = _account.set((callsign, guild))
+  try:
+    yield
+  finally:
+    _account.reset(token)
+
+# Get the (callsign, guild) requests are currently accounted to
+def current():
+  return _account.get()
+
+# The usage log of this process
+log = UsageLog()
+
+# Format a rollup as a short text table, eg. for !usage
+def format_rollup(rows, by):
+  if not rows:
+    return 'No ai requests have been recorded yet.'
+  lines = []
+  for row in rows:
+    name = ' / '.join(str(row[group]) for group in by) or 'everything'
+    lines.append(f'{name}: {row["requests"]} requests ({row["errors"]} failed), '
+      f'{row["prompt_tokens"]:,} prompt + {row["completion_tokens"]:,} completion tokens, '
+      f'{row["messages"]:.1f} messages and {row["latency"]:.2f}s (max {row["max_latency"]:.1f}s) on average')
+  return '\n'.join(lines)
@@ -0,0 +1,195 @@
+# Local cache of the images attached to discord messages, for the ai models that can see them
+#   Each image is downloaded once, shrunk to fit in MAX_EDGE pixels, and saved to disk under the
+#   hash of its contents (so an image posted twice is only kept once). Requests then include the
+#   image itself, as a data url, instead of a discord link that the provider has to download
+#   again every time (and that stops working once it expires).
+import asyncio
+import base64
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from io import BytesIO
+import aiohttp
+from lib import metrics
+
+CACHE_DIR = 'data/attachments'
+
+# Longest side of a cached image (pixels), and the most disk space the cache can use
+MAX_EDGE = int(os.getenv('ATTACHMENT_MAX_EDGE', '1024'))
+MAX_CACHE_MB = float(os.getenv('ATTACHMENT_CACHE_MB', '200'))
+
+# Images larger than this arent downloaded (bytes), and downloads give up after this long (seconds)
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 15
+
+# Most attachments remembered (by discord id), and the most bytes of data urls kept in memory
+MAX_KNOWN_ATTACHMENTS = 10000
+MAX_MEMORY_BYTES = 32 * 1024 * 1024
+
+# Check if an attachment is an image
+def is_image(attachment):
+  return (attachment.content_type or '').split('/')[0] == 'image'
+
+# Shrink an image to fit in max_edge pixels, returning (image bytes, content type)
+#   Needs Pillow. Without it, images are kept as they are
+def shrink(data, content_type, max_edge):
+  try:
+    from PIL import Image # Only needed for images, so its loaded on first use
+  except ImportError:
+    return data, content_type
+  with Image.open(BytesIO(data)) as image:
+    if max(image.size) <= max_edge and content_type in ('image/jpeg', 'image/png'):
+      return data, content_type
+    image.thumbnail((max_edge, max_edge))
+    output = BytesIO()
+    image.convert('RGB').save(output, 'JPEG', quality=85)
+    return output.getvalue(), 'image/jpeg'
+
+EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+CONTENT_TYPES = {extension: content_type for content_type, extension in EXTENSIONS.items()}
+
+class AttachmentCache():
+  def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_MB * 1024 * 1024, max_edge=MAX_EDGE):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.max_edge = max_edge
+    self.known = OrderedDict() # {attachment id: file name}
+    self.files = None # {file name: size} of the files on disk, least recently used first (read on first use)
+    self.data_urls = OrderedDict() # {file name: data url}, the most recently used
+    self.data_url_bytes = 0
+    self.pending = {} # {attachment id: task}, downloads in progress
+    self.session = None
+
+  # Download any of these attachments that arent cached yet (all at once)
+  #   Images that cant be downloaded are skipped, and their links are used instead
+  async def prepare(self, attachments):
+    await asyncio.gather(*[self.fetch(attachment) for attachment in attachments if is_image(attachment)])
+
+  # Make sure an attachment is cached, returning its file name (or None if that failed)
+  async def fetch(self, attachment):
+    name = self.known.get(attachment.id)
+    if name and name in self.get_files():
+      metrics.increment('attachment_cache', outcome='hit')
+      await self.load(name)
+      return name
+
+    task = self.pending.get(attachment.id)
+    if task is None:
+      metrics.increment('attachment_cache', outcome='miss')
+      task = self.pending[attachment.id] = asyncio.ensure_future(self.add(attachment))
+      task.add_done_callback(lambda _: self.pending.pop(attachment.id, None))
+    try:
+      return await asyncio.shield(task)
+    except Exception as e:
+      metrics.increment('attachment_cache', outcome='failed')
+      print(f'couldnt cache attachment {attachment.url}: {e!r}')
+      return None
+
+  # Download, shrink and save an attachment
+  async def add(self, attachment):
+    self.get_files() # Read what is on disk before saving anything new, so it isnt counted before it is added
+    data = await self.download(attachment.url)
+    name, size = await asyncio.to_thread(self.save, data, attachment.content_type)
+    await self.load(name)
+    self.known[attachment.id] = name
+    if len(self.known) > MAX_KNOWN_ATTACHMENTS:
+      self.known.popitem(last=False)
+    self.get_files()[name] = size
+    self.evict()
+    return name
+
+  async def download(self, url):
+    if self.session is None:
+      self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT))
+    async with self.session.get(url) as response:
+      response.raise_for_status()
+      if (response.content_length or 0) > MAX_DOWNLOAD_BYTES:
+        raise ValueError(f'image is too big ({response.content_length} bytes)')
+      data = await response.content.read(MAX_DOWNLOAD_BYTES + 1)
+      if len(data) > MAX_DOWNLOAD_BYTES:
+        raise ValueError('image is too big')
+      metrics.increment('attachment_download_bytes', len(data))
+      return data
+
+  # Save an image under the hash of its contents (run in a thread). Returns (file name, size)
+  def save(self, data, content_type):
+    digest = hashlib.sha256(data).hexdigest()
+    for extension in CONTENT_TYPES:
+      if os.path.exists(os.path.join(self.directory, digest + extension)):
+        return digest + extension, os.path.getsize(os.path.join(self.directory, digest + extension))
+
+    data, content_type = shrink(data, content_type, self.max_edge)
+    name = digest + EXTENSIONS.get(content_type, '.jpg')
+    os.makedirs(self.directory, exist_ok=True)
+    # Written to a temporary file first, so a half written file is never used
+    #   (and the same image being saved twice at once cant trip over itself)
+    with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as file:
+      file.write(data)
+    os.replace(file.name, os.path.join(self.directory, name))
+    return name, len(data)
+
+  # Get the files on disk, reading them the first time
+  def get_files(self):
+    if self.files is None:
+      files = []
+      if os.path.isdir(self.directory):
+        for name in os.listdir(self.directory):
+          if os.path.splitext(name)[1] in CONTENT_TYPES:
+            stat = os.stat(os.path.join(self.directory, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+      self.files = OrderedDict((name, size) for _, name, size in sorted(files))
+    return self.files
+
+  # Delete the least recently used files until the cache fits on disk again
+  def evict(self):
+    files = self.get_files()
+    total = sum(files.values())
+    while total > self.max_bytes and len(files) > 1:
+      name, size = files.popitem(last=False)
+      total -= size
+      self.forget_data_url(name)
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except FileNotFoundError:
+        pass
+      metrics.increment('attachment_cache_evictions')
+
+  # Read a cached image into memory as a data url
+  async def load(self, name):
+    if name in self.get_files():
+      self.files.move_to_end(name)
+    if name in self.data_urls:
+      self.data_urls.move_to_end(name)
+      return
+    path = os.path.join(self.directory, name)
+    data = await asyncio.to_thread(read_file, path)
+    data_url = f'data:{CONTENT_TYPES[os.path.splitext(name)[1]]};base64,' + base64.b64encode(data).decode()
+    self.data_urls[name] = data_url
+    self.data_url_bytes += len(data_url)
+    while self.data_url_bytes > MAX_MEMORY_BYTES and len(self.data_urls) > 1:
+      self.forget_data_url(next(iter(self.data_urls)))
+
+  def forget_data_url(self, name):
+    data_url = self.data_urls.pop(name, None)
+    if data_url:
+      self.data_url_bytes -= len(data_url)
+
+  # Get the data url of a cached attachment (prepared beforehand), or None
+  def get_data_url(self, attachment):
+    return self.data_urls.get(self.known.get(attachment.id))
+
+  async def close(self):
+    if self.session is not None:
+      await self.session.close()
+      self.session = None
+
+# Read a file and mark it as just used (so the least recently used files are still known after a restart)
+def read_file(path):
+  with open(path, 'rb') as file:
+    data = file.read()
+  os.utime(path)
+  return data
+
+# The cache used by this process
+cache = AttachmentCache()
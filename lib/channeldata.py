@@ -1,17 +1,21 @@
 import sqlite3
 import os
+import time
+from lib import metrics
 
 class ChannelDatabase():
   # Initialize the database connection
   def __init__(self, channel):
+    self._opened = time.perf_counter()
     os.makedirs('data/users', exist_ok=True)
     self._db = sqlite3.connect(f'data/users/ch{channel}.db')
     query = 'CREATE TABLE IF NOT EXISTS prompts(id INTEGER UNIQUE, prompt TEXT, context INTEGER)'
     self._db.execute(query)
     
-  # Close the database
+  # Close the database (and record how long it was in use for)
   def close(self):
     self._db.close()
+    metrics.observe('sqlite_seconds', time.perf_counter() - self._opened, db='channel')
   
   # instantiation method when used in 'with' block  
   def __enter__(self):
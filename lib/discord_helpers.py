@@ -1,11 +1,33 @@
 # Pile of various helper methods to do discord api things
 from lib.serverdata import get_name_and_pronouns
+from lib import metrics, history
 import re
 from discord import File as dfile
 
-# Get the chat history of a specific channel
-async def get_history(channel, **kwargs):
-  return [x async for x in channel.history(**kwargs)]
+# Get the chat history of a specific channel (newest first)
+#   Read from the messages kept in memory when they go back far enough (see lib/history.py)
+#   Those are only copies of what is needed for context, so use get_message on one before
+#   acting on it (eg. replying to it)
+async def get_history(channel, limit=100, before=None, **kwargs):
+  if not kwargs:
+    messages = history.store.read(channel.id, limit, before)
+    if messages is not None:
+      metrics.increment('history_reads', source='memory')
+      return messages
+
+  metrics.increment('history_reads', source='api')
+  with metrics.timer('history_fetch_seconds'):
+    messages = [x async for x in channel.history(limit=limit, before=before, **kwargs)]
+  if not kwargs:
+    history.store.backfill(channel.id, messages, limit, before)
+  return messages
+
+# Get a message from get_history that can be acted on (replied to, reacted to, deleted...)
+#   In-memory copies are turned back into a (partial) discord message, without an api call
+def get_message(message):
+  if isinstance(message, history.HistoryMessage):
+    return message.channel.get_partial_message(message.id)
+  return message
 
 # Turn a partial reference embedded within the input message
 #   into a fully resolved message and return it (or None, of not found)
@@ -19,6 +41,11 @@ async def resolve_reference(message):
       print("couldnt resolve reference")
   return None
   
+# Check if a user has administrator permissions in the server they are talking in
+def is_admin(user):
+  permissions = getattr(user, 'guild_permissions', None)
+  return bool(permissions and permissions.administrator)
+
 # Get a string username for a given user
 def get_username(user):
   return user.nick or user.global_name or user.name
@@ -125,11 +152,11 @@ def package_discord_images(images):
 
 # Get an array of urls for all images attached to the input message
 def get_attached_images(message):
-  images = []
-  for attachment in message.attachments:
-    if attachment.content_type.split('/')[0] == 'image':
-      images += [attachment.url]
-  return images
+  return [attachment.url for attachment in get_image_attachments(message)]
+
+# Get all of the images attached to the input message
+def get_image_attachments(message):
+  return [attachment for attachment in message.attachments if attachment.content_type.split('/')[0] == 'image']
 
 # True/Flase indicating if the message has any attached images
 def has_images(message):
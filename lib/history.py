@@ -0,0 +1,134 @@
+# Recent messages of each channel, kept in memory from the gateway's message events
+#   Reading chat history for context is most of what the ai commands ask discord for, but the bot
+#   already sees every message as it's posted. So each channel keeps a ring buffer of compact copies
+#   of its latest messages, updated as messages are posted, edited and deleted. Reads that reach
+#   further back than a buffer goes (eg. just after startup) fall back to discord's api, and what
+#   they fetch fills in the buffer.
+import os
+from collections import OrderedDict, deque
+from discord.utils import time_snowflake, parse_time
+
+# Messages kept per channel, and the most channels kept (the least recently used are forgotten)
+CHANNEL_MESSAGES = int(os.getenv('HISTORY_CHANNEL_MESSAGES', '100'))
+MAX_CHANNELS = int(os.getenv('HISTORY_CHANNELS', '1000'))
+
+# A copy of just the parts of a message that are used for context
+class HistoryMessage():
+  __slots__ = ('id', 'author', 'content', 'attachments', 'channel', 'guild', 'created_at', 'edited_at')
+
+  def __init__(self, message):
+    self.id = message.id
+    self.author = message.author
+    self.content = message.content
+    self.attachments = tuple(message.attachments)
+    self.channel = message.channel
+    self.guild = message.guild
+    self.created_at = message.created_at
+    self.edited_at = message.edited_at
+
+# The latest messages of one channel, oldest first and with no gaps between them
+class ChannelHistory():
+  __slots__ = ('messages', 'reaches_start')
+
+  def __init__(self, size):
+    self.messages = deque(maxlen=size)
+    self.reaches_start = False # True if there are no older messages in the channel than these
+
+  def append(self, message):
+    if len(self.messages) == self.messages.maxlen:
+      self.reaches_start = False # The oldest one is about to be forgotten
+    self.messages.append(HistoryMessage(message))
+
+  def find(self, message_id):
+    for i in range(len(self.messages) - 1, -1, -1): # Usually one of the latest
+      if self.messages[i].id == message_id:
+        return i
+    return None
+
+class MessageHistory():
+  def __init__(self, channel_messages=CHANNEL_MESSAGES, max_channels=MAX_CHANNELS):
+    self.channel_messages = channel_messages
+    self.max_channels = max_channels
+    self.channels = OrderedDict() # {channel id: ChannelHistory}, least recently used first
+
+  def get_channel(self, channel_id, create=False):
+    channel = self.channels.get(channel_id)
+    if channel is not None:
+      self.channels.move_to_end(channel_id)
+    elif create:
+      channel = self.channels[channel_id] = ChannelHistory(self.channel_messages)
+      if len(self.channels) > self.max_channels:
+        self.channels.popitem(last=False)
+    return channel
+
+  # Record a newly posted message
+  def add(self, message):
+    channel = self.get_channel(message.channel.id, create=True)
+    if not channel.messages or channel.messages[-1].id < message.id:
+      channel.append(message)
+
+  # Record an edited message (the whole message, or just the raw changes from the gateway)
+  def edit(self, channel_id, message_id, message=None, data=None):
+    channel = self.get_channel(channel_id)
+    i = channel.find(message_id) if channel else None
+    if i is None:
+      return
+    if message is not None:
+      channel.messages[i] = HistoryMessage(message)
+    else:
+      if 'content' in data:
+        channel.messages[i].content = data['content']
+      if data.get('edited_timestamp'):
+        channel.messages[i].edited_at = parse_time(data['edited_timestamp'])
+
+  def delete(self, channel_id, message_id):
+    channel = self.get_channel(channel_id)
+    i = channel.find(message_id) if channel else None
+    if i is not None:
+      del channel.messages[i]
+
+  # Forget everything (eg. after a reconnect that may have missed some messages)
+  def clear(self):
+    self.channels.clear()
+
+  # Get up to limit messages from before a message (or datetime), newest first
+  #   Returns None if they arent all in memory
+  def read(self, channel_id, limit, before=None):
+    channel = self.get_channel(channel_id)
+    if channel is None or limit is None:
+      return None
+    before_id = get_snowflake(before)
+    messages = [m for m in reversed(channel.messages) if before_id is None or m.id < before_id][:limit]
+    if len(messages) < limit and not channel.reaches_start:
+      return None
+    return messages
+
+  # Fill in the history with messages fetched from the api (newest first), the result of
+  #   channel.history(limit=limit, before=before). Only messages that join up with the ones
+  #   already kept, with no gaps in between, can be added
+  def backfill(self, channel_id, fetched, limit, before=None):
+    before_id = get_snowflake(before)
+    channel = self.get_channel(channel_id, create=before_id is None)
+    if channel is None:
+      return
+    if channel.messages and before_id is not None and before_id < channel.messages[0].id:
+      return # There could be a gap between the fetched messages and the ones kept
+
+    oldest = channel.messages[0].id if channel.messages else None
+    older = [m for m in fetched if oldest is None or m.id < oldest]
+    space = channel.messages.maxlen - len(channel.messages)
+    for message in older[:space]:
+      channel.messages.appendleft(HistoryMessage(message))
+    if limit is not None and len(fetched) < limit and len(older) <= space:
+      channel.reaches_start = True
+
+# Get the snowflake id of a message (or object with an id), or the first possible one at a datetime
+def get_snowflake(before):
+  if before is None:
+    return None
+  if hasattr(before, 'id'):
+    return before.id
+  return time_snowflake(before)
+
+# The history kept by this process
+store = MessageHistory()
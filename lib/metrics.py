@@ -0,0 +1,158 @@
+# Lightweight in-process metrics: counters, gauges and latency histograms
+#   Everything reports into the module level registry, which can be viewed with !stats
+#   or scraped in the OpenMetrics text format (see start_server)
+import time
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+class Histogram():
+  __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    self.bounds = bounds
+    self.counts = [0] * len(bounds)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.bounds, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  # Estimate a quantile (0.0-1.0), interpolating linearly inside the bucket it falls in
+  def quantile(self, q):
+    if not self.count:
+      return 0.0
+    target = q * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      if count and seen + count >= target:
+        lower = self.bounds[i - 1] if i else 0.0
+        upper = self.bounds[i] if i < len(self.bounds) - 1 else lower # Cant interpolate into infinity
+        return lower + (upper - lower) * ((target - seen) / count)
+      seen += count
+    return self.bounds[-2]
+
+# Turn keyword labels into a hashable, consistently ordered key
+def _label_key(labels):
+  return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+# Format a label key in the OpenMetrics/Prometheus style, eg. {model="gpt-4o",le="0.5"}
+def format_labels(key, extra=()):
+  pairs = list(key) + list(extra)
+  if not pairs:
+    return ''
+  escape = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+class MetricsRegistry():
+  def __init__(self):
+    self.counters = {} # {name: {label_key: value}}
+    self.histograms = {} # {name: {label_key: Histogram}}
+    self.collectors = [] # functions yielding (name, labels, value) gauges when metrics are read
+
+  # Add to a counter
+  def increment(self, name, amount=1, **labels):
+    series = self.counters.setdefault(name, {})
+    key = _label_key(labels)
+    series[key] = series.get(key, 0) + amount
+
+  # Record a latency (in seconds)
+  def observe(self, name, seconds, **labels):
+    series = self.histograms.setdefault(name, {})
+    key = _label_key(labels)
+    histogram = series.get(key)
+    if histogram is None:
+      histogram = series[key] = Histogram()
+    histogram.observe(seconds)
+
+  # Time the enclosed block, recording it into a latency histogram (works in async code too)
+  @contextmanager
+  def timer(self, name, **labels):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - start, **labels)
+
+  # Register a function that returns a list of (name, labels_dict, value) gauges
+  #   Collectors are called whenever the metrics are read, so gauges are always current
+  def register_collector(self, collector):
+    if collector not in self.collectors:
+      self.collectors.append(collector)
+
+  # Get the current value of all gauges, as {name: {label_key: value}}
+  def collect_gauges(self):
+    gauges = {}
+    for collector in self.collectors:
+      try:
+        for name, labels, value in collector():
+          gauges.setdefault(name, {})[_label_key(labels)] = value
+      except Exception as e:
+        print('metrics collector failed: ' + str(e))
+    return gauges
+
+  # Get a human readable summary, optionally only of metrics whose name contains a filter string
+  def summary(self, name_filter=''):
+    lines = []
+    for name, series in sorted(self.histograms.items()):
+      if name_filter in name:
+        for key, h in sorted(series.items()):
+          lines.append(f'{name}{format_labels(key)}: n={h.count} ' + \
+            f'p50={h.quantile(0.5)*1000:.0f}ms p95={h.quantile(0.95)*1000:.0f}ms p99={h.quantile(0.99)*1000:.0f}ms')
+    for name, series in sorted(self.counters.items()) + sorted(self.collect_gauges().items()):
+      if name_filter in name:
+        for key, value in sorted(series.items()):
+          lines.append(f'{name}{format_labels(key)}: {round(value, 3)}')
+    return '\n'.join(lines)
+
+  # Render every metric in the OpenMetrics text exposition format
+  def render_openmetrics(self):
+    lines = []
+    for name, series in sorted(self.counters.items()):
+      lines.append(f'# TYPE {name} counter')
+      lines += [f'{name}_total{format_labels(key)} {value}' for key, value in sorted(series.items())]
+
+    for name, series in sorted(self.collect_gauges().items()):
+      lines.append(f'# TYPE {name} gauge')
+      lines += [f'{name}{format_labels(key)} {value}' for key, value in sorted(series.items())]
+
+    for name, series in sorted(self.histograms.items()):
+      lines.append(f'# TYPE {name} histogram')
+      lines.append(f'# UNIT {name} seconds')
+      for key, h in sorted(series.items()):
+        cumulative = 0
+        for bound, count in zip(h.bounds, h.counts):
+          cumulative += count
+          le = '+Inf' if bound == float('inf') else repr(bound)
+          lines.append(f'{name}_bucket{format_labels(key, [("le", le)])} {cumulative}')
+        lines.append(f'{name}_count{format_labels(key)} {h.count}')
+        lines.append(f'{name}_sum{format_labels(key)} {h.sum}')
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+# The process wide registry, and shortcuts to it
+registry = MetricsRegistry()
+increment = registry.increment
+observe = registry.observe
+timer = registry.timer
+register_collector = registry.register_collector
+
+# Serve the registry over http in the OpenMetrics format (eg. for prometheus to scrape)
+#   Only binds to localhost by default. Returns the aiohttp runner (call runner.cleanup() to stop it)
+async def start_server(port, host='127.0.0.1'):
+  async def handle(request):
+    return web.Response(text=registry.render_openmetrics(),
+      headers={'Content-Type': 'application/openmetrics-text; version=1.0.0; charset=utf-8'})
+
+  app = web.Application()
+  app.router.add_get('/metrics', handle)
+  runner = web.AppRunner(app)
+  await runner.setup()
+  await web.TCPSite(runner, host, port).start()
+  return runner
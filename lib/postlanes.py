@@ -0,0 +1,48 @@
+# Per-channel posting scheduler
+#   Every destination channel/thread gets its own ordered lane, so multi-part
+#   replies stay in order within a channel while other channels post in parallel.
+import asyncio
+from contextlib import asynccontextmanager
+
+# A single ordered lane for one destination channel
+class PostLane():
+  __slots__ = ('lock', 'depth')
+
+  def __init__(self):
+    self.lock = asyncio.Lock() # asyncio locks wake waiters in FIFO order
+    self.depth = 0 # Number of posts currently holding or waiting on this lane
+
+class PostScheduler():
+  def __init__(self):
+    self._lanes = {}
+
+  # Hold the lane for a channel for the duration of the block
+  #   Lanes are created on demand and dropped again once they go idle
+  @asynccontextmanager
+  async def lane(self, channel_id):
+    lane = self._lanes.get(channel_id)
+    if lane is None:
+      lane = self._lanes[channel_id] = PostLane()
+
+    lane.depth += 1
+    try:
+      async with lane.lock:
+        yield lane
+    finally:
+      lane.depth -= 1
+      if lane.depth == 0 and self._lanes.get(channel_id) is lane:
+        del self._lanes[channel_id]
+
+  # Get the number of posts queued (or in progress) for a single channel
+  def get_queue_depth(self, channel_id):
+    lane = self._lanes.get(channel_id)
+    return lane.depth if lane else 0
+
+  # Get the queue depth of every currently active lane, keyed by channel id
+  def get_queue_depths(self):
+    return {channel_id: lane.depth for channel_id, lane in self._lanes.items()}
+
+# Get the id of the channel a post will end up in
+#   Replies go to the channel of the message being replied to
+def get_destination_id(context, is_reply):
+  return context.channel.id if is_reply else context.id
@@ -1,10 +1,11 @@
 from lib.nlpstuff import *
 from lib.spellchecker import SpellChecker
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
 
 class PostRater():
   def __init__(self):
+    # Imported here, so only processes that actually rate posts pay for loading it
+    from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
     self.spellchecker = SpellChecker()
     self.sentiment_analyzer = SentimentIntensityAnalyzer()
     
@@ -72,6 +73,23 @@ class PostRater():
     alikeness = chat_topics.alikeness(post_topics)
     return min(alikeness / self.topicality_tgt, 1.0)
   
+# Entry points for running ratings in a worker process
+#   Each worker builds its own PostRater once (via init_worker) and reuses it for every request
+_worker_rater = None
+
+def init_worker():
+  global _worker_rater
+  if _worker_rater is None:
+    _worker_rater = PostRater()
+
+def get_rating(text, history):
+  init_worker()
+  return _worker_rater.get_rating(text, history)
+
+def get_detailed_rating(text, history):
+  init_worker()
+  return _worker_rater.get_detailed_rating(text, history)
+
 def get_point_report(score):
   points = int(score*10000)
   return 'This post is worth {0} points.{1}'.format(points, get_bonus_text(points))
@@ -0,0 +1,122 @@
+# Opt-in profiling of specific commands in production
+#   Turn it on with the PROFILE_COMMANDS environment variable (eg. PROFILE_COMMANDS=rate,ai)
+#   or with the admin only !profile command. Each chosen command is profiled for a number of
+#   invocations (PROFILE_SAMPLES, default 20), then the aggregated stats are written to logs/ as
+#   a .pstats file (load it with pstats or snakeviz) and a .txt summary of the hottest calls.
+#
+#   Note that profiling is per thread, and the event loop keeps running other coroutines while a
+#   command is waiting, so samples can include a little unrelated work. Functions the command sends
+#   through run_thread are profiled inside their worker thread/process and merged into the sample.
+import cProfile
+import os
+import pstats
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+DEFAULT_SAMPLES = int(os.getenv('PROFILE_SAMPLES', '20'))
+
+class CommandProfile():
+  def __init__(self, callsign, samples):
+    self.callsign = callsign
+    self.remaining = samples
+    self.samples = 0
+    self.stats = None
+
+  # Merge a finished profile (anything pstats.Stats accepts) into the aggregate
+  def add(self, profile):
+    if self.stats is None:
+      self.stats = pstats.Stats(profile)
+    else:
+      self.stats.add(profile)
+
+  # Write the aggregated stats out, returning the path of the .pstats file (or None if empty)
+  def dump(self):
+    if self.stats is None:
+      return None
+    os.makedirs('logs', exist_ok=True)
+    path = 'logs/profile_{}_{}'.format(self.callsign, datetime.now().strftime('%y%m%d_%H%M%S'))
+    self.stats.dump_stats(path + '.pstats')
+    with open(path + '.txt', 'w') as summary:
+      summary.write(f'!{self.callsign}: {self.samples} samples\n')
+      self.stats.stream = summary
+      self.stats.sort_stats('cumulative').print_stats(40)
+    return path + '.pstats'
+
+# Commands being profiled, by callsign
+_targets = {}
+
+# Only one profiler can be active on the event loop thread at a time
+_busy = False
+
+# The sample currently being recorded in this context (so run_thread can add to it)
+_current = ContextVar('current_profile', default=None)
+
+# Start profiling a command for a number of invocations
+def enable(callsign, samples=DEFAULT_SAMPLES):
+  _targets[callsign] = CommandProfile(callsign, samples)
+
+# Stop profiling a command early, writing out whatever was collected. Returns the file path or None
+def disable(callsign):
+  target = _targets.pop(callsign, None)
+  return target.dump() if target else None
+
+# Get {callsign: invocations left} for every command being profiled
+def get_targets():
+  return {callsign: target.remaining for callsign, target in _targets.items()}
+
+# Profile the enclosed block if the command is being profiled (and the profiler is free)
+@contextmanager
+def profile(callsign):
+  global _busy
+  target = _targets.get(callsign)
+  if target is None or _busy:
+    yield
+    return
+
+  _busy = True
+  token = _current.set(target)
+  profiler = cProfile.Profile()
+  profiler.enable()
+  try:
+    yield
+  finally:
+    profiler.disable()
+    _current.reset(token)
+    _busy = False
+    target.add(profiler)
+    target.samples += 1
+    target.remaining -= 1
+    if target.remaining <= 0 and _targets.get(callsign) is target:
+      print('profile written to ' + disable(callsign))
+
+# Get the command profile being recorded by the calling code, if any
+def current_sample():
+  return _current.get()
+
+# Profiler results in a form that can be pickled back from a worker and passed to pstats.Stats
+class RawStats():
+  def __init__(self, stats):
+    self.stats = stats
+
+  def create_stats(self):
+    pass
+
+# Run a function under the profiler in a worker thread/process, returning (result, RawStats)
+#   The stats are None if another profiler was already running there
+def run_profiled(func, *args):
+  profiler = cProfile.Profile()
+  try:
+    profiler.enable()
+  except ValueError:
+    return func(*args), None
+  try:
+    result = func(*args)
+  finally:
+    profiler.disable()
+  profiler.create_stats()
+  return result, RawStats(profiler.stats)
+
+# Commands to profile from startup
+for callsign in filter(None, os.getenv('PROFILE_COMMANDS', '').split(',')):
+  enable(callsign.strip())
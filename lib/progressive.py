@@ -0,0 +1,44 @@
+# Progressive posting, for replies that are still being written (eg. streamed ai replies)
+#   The reply is posted as soon as it starts, then edited in place as it grows (no more often
+#   than EDIT_INTERVAL, to stay well inside discord's rate limits on edits), rolling over into a
+#   new message whenever it passes discord's character limit, the same way post splits messages.
+import os
+import time
+from textwrap import wrap
+
+MESSAGE_LIMIT = 2000 # characters
+
+# Shortest time between updates of a progressive message (seconds)
+#   Discord allows about 5 edits every 5 seconds in a channel
+EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+
+# Split text into message sized chunks
+def split_message(text):
+  return wrap(text, MESSAGE_LIMIT, replace_whitespace=False, drop_whitespace=False)
+
+class ProgressiveMessage():
+  def __init__(self, send_first, send_next, interval=EDIT_INTERVAL, clock=time.monotonic):
+    self.send_first = send_first # async (text) -> message, to post the first message
+    self.send_next = send_next # async (text) -> message, to post any after it
+    self.interval = interval
+    self.clock = clock
+    self.messages = [] # [[message, the text it shows]]
+    self.updated_at = None
+    self.edits = 0
+
+  # Whether enough time has passed since the last update for another one
+  def due(self):
+    return self.updated_at is None or self.clock() - self.updated_at >= self.interval
+
+  # Bring the posted messages up to date with the text so far
+  #   Only messages whose text changed are edited (usually just the last one)
+  async def update(self, text):
+    self.updated_at = self.clock()
+    for i, chunk in enumerate(split_message(text)):
+      if i == len(self.messages):
+        message = await (self.send_next if self.messages else self.send_first)(chunk)
+        self.messages.append([message, chunk])
+      elif self.messages[i][1] != chunk:
+        await self.messages[i][0].edit(content=chunk)
+        self.messages[i][1] = chunk
+        self.edits += 1
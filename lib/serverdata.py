@@ -1,9 +1,12 @@
 import sqlite3
 import os
+import time
+from lib import metrics
 
 class ServerDatabase():
   # Initialize the database connection
   def __init__(self, server):
+    self._opened = time.perf_counter()
     os.makedirs('data/users', exist_ok=True)
     self._db = sqlite3.connect(f'data/users/srv{server}.db')
     query = 'CREATE TABLE IF NOT EXISTS users(id INTEGER UNIQUE, name TEXT, pronouns TEXT, special TEXT, points REAL DEFAULT 0 NOT NULL, point_role TEXT)'
@@ -11,9 +14,10 @@ class ServerDatabase():
     query = 'CREATE TABLE IF NOT EXISTS static_vars(id INTEGER UNIQUE, point_name TEXT)'
     self._db.execute(query)
     
-  # Close the database
+  # Close the database (and record how long it was in use for)
   def close(self):
     self._db.close()
+    metrics.observe('sqlite_seconds', time.perf_counter() - self._opened, db='server')
   
   # instantiation method when used in 'with' block  
   def __enter__(self):
@@ -0,0 +1,105 @@
+# State that has to be shared by every shard of the bot (cooldowns, the points deputy, locks)
+#   By default it just lives in memory, which covers any number of shards in one process.
+#   When the shards are split across processes, each process calls use_file() at startup
+#   so they all share one small sqlite database (and file locks) instead.
+#   Values should be plain numbers/strings, so both backends can store them.
+import asyncio
+import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
+# How often a process waiting on a file lock checks it again (seconds)
+LOCK_POLL_INTERVAL = 0.05
+
+class LocalState():
+  shared = False # Only visible to this process
+
+  def __init__(self):
+    self._values = {}
+    self._locks = {}
+
+  def get(self, key, default=None):
+    return self._values.get(key, default)
+
+  def set(self, key, value):
+    self._values[key] = value
+
+  # Record a use of something that can only be used once per interval (seconds)
+  #   Returns True (and records the use) if the interval has passed since the last one
+  def claim(self, key, interval, now=None):
+    now = time.time() if now is None else now
+    if now - interval > self._values.get(key, 0.0):
+      self._values[key] = now
+      return True
+    return False
+
+  # Hold a named lock for the duration of the block
+  @asynccontextmanager
+  async def lock(self, name):
+    lock = self._locks.get(name)
+    if lock is None:
+      lock = self._locks[name] = asyncio.Lock()
+    async with lock:
+      yield
+
+class FileState(LocalState):
+  shared = True # Visible to every process using the same file
+
+  def __init__(self, path):
+    super().__init__()
+    self.path = path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Autocommit mode, so claim() can control its own transaction
+    self._db = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('CREATE TABLE IF NOT EXISTS state(key TEXT PRIMARY KEY, value)')
+
+  def close(self):
+    self._db.close()
+
+  def get(self, key, default=None):
+    row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else default
+
+  def set(self, key, value):
+    self._db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+  def claim(self, key, interval, now=None):
+    now = time.time() if now is None else now
+    self._db.execute('BEGIN IMMEDIATE') # Take the write lock first, so two processes cant both succeed
+    try:
+      row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+      claimed = now - interval > (row[0] if row else 0.0)
+      if claimed:
+        self._db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, now))
+    finally:
+      self._db.execute('COMMIT')
+    return claimed
+
+  # Hold a named lock for the duration of the block, across all processes
+  #   The file lock is polled rather than waited on, so a waiting task can still be cancelled
+  @asynccontextmanager
+  async def lock(self, name):
+    import fcntl # Only needed (and only available on unix) when sharding across processes
+    async with super().lock(name):
+      with open(f'{self.path}.{name}.lock', 'a') as lockfile:
+        while True:
+          try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+          except BlockingIOError:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+          yield
+        finally:
+          fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+# The state store in use by this process
+store = LocalState()
+
+# Share state through a file from now on (call before the bot starts)
+def use_file(path):
+  global store
+  store = FileState(path)
+  return store
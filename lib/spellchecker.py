@@ -1,11 +1,11 @@
 # Python 3.4 and up
 #import language_check
 
-# Python 3.6 and up
-import language_tool_python
-
 class SpellChecker:
   def __init__(self):
+    # Python 3.6 and up (imported here since its slow, and only needed where a checker is made)
+    import language_tool_python
+
     # Pyton 3.4 and up
     #self.spellchecker = language_check.LanguageTool('en-US') # Also checks Grammar
     
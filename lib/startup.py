@@ -0,0 +1,40 @@
+# Startup timing report
+#   Records how long each part of startup took, and when milestones (like the gateway being ready,
+#   or the first reply being posted) were reached, in seconds since the process started
+import time
+from contextlib import contextmanager
+
+class StartupReport():
+  def __init__(self, started_at=None):
+    self.started_at = time.perf_counter() if started_at is None else started_at
+    self.phases = {} # {phase: how long it took}
+    self.milestones = {} # {milestone: seconds since start}
+
+  # Time a phase of startup
+  @contextmanager
+  def phase(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.phases[name] = time.perf_counter() - start
+
+  # Record a milestone the first time it is reached. Returns True if this was the first time
+  def mark(self, name):
+    if name in self.milestones:
+      return False
+    self.milestones[name] = time.perf_counter() - self.started_at
+    return True
+
+  # Human readable report
+  def format(self):
+    lines = ['Startup report:']
+    lines += [f'  {name}: took {seconds*1000:.0f}ms' for name, seconds in self.phases.items()]
+    lines += [f'  {name}: at {seconds:.2f}s' for name, seconds in sorted(self.milestones.items(), key=lambda x: x[1])]
+    return '\n'.join(lines)
+
+  # Gauges for the metrics registry
+  def collect_metrics(self):
+    gauges = [('startup_phase_seconds', {'phase': name}, seconds) for name, seconds in self.phases.items()]
+    gauges += [('startup_milestone_seconds', {'milestone': name}, seconds) for name, seconds in self.milestones.items()]
+    return gauges
@@ -0,0 +1,75 @@
+# Supervisor for background tasks (autofire loops, extra posts, anything sent to run_in_background)
+#   Keeps a reference to every live task (so they cant be garbage collected mid-flight), reports
+#   failures instead of letting them vanish, caps how many tasks of each kind can run at once,
+#   and drains or cancels everything cleanly on shutdown.
+import asyncio
+import traceback
+from collections import Counter
+from lib import metrics
+
+# Most tasks of one kind that can be running at the same time (others are turned away)
+DEFAULT_LIMIT = 50
+KIND_LIMITS = {'autofire': 10}
+
+# Kinds that loop until they're stopped, so there is no point waiting for them at shutdown
+LOOPING_KINDS = {'autofire'}
+
+class TaskSupervisor():
+  def __init__(self, default_limit=DEFAULT_LIMIT, limits=None):
+    self.default_limit = default_limit
+    self.limits = KIND_LIMITS if limits is None else limits
+    self.tasks = {} # {task: (kind, owner)}
+    self.counts = Counter() # live tasks by kind
+    self.closing = False
+
+  # Start running an awaitable in the background, returning its task
+  #   kind groups tasks for the concurrency limits and metrics, and owner says who started it
+  #   (eg. a callsign or channel). Returns None (and closes the awaitable) if it was turned away
+  def spawn(self, awaitable, kind='background', owner=None):
+    if self.closing or self.counts[kind] >= self.limits.get(kind, self.default_limit):
+      metrics.increment('background_tasks', kind=kind, outcome='rejected')
+      print(f"background task '{kind}' for {owner} turned away")
+      if asyncio.iscoroutine(awaitable):
+        awaitable.close()
+      return None
+
+    task = asyncio.ensure_future(awaitable)
+    self.tasks[task] = (kind, owner)
+    self.counts[kind] += 1
+    task.add_done_callback(self._finished)
+    return task
+
+  # Forget a finished task, recording how it went
+  def _finished(self, task):
+    kind, owner = self.tasks.pop(task)
+    self.counts[kind] -= 1
+    if task.cancelled():
+      outcome = 'cancelled'
+    elif task.exception() is not None:
+      outcome = 'failed'
+      print(f"background task '{kind}' for {owner} failed:")
+      traceback.print_exception(task.exception())
+    else:
+      outcome = 'ok'
+    metrics.increment('background_tasks', kind=kind, outcome=outcome)
+
+  # Get the live tasks started by an owner (optionally only of one kind)
+  def get_owned(self, owner, kind=None):
+    return [task for task, (k, o) in self.tasks.items() if o == owner and kind in (None, k)]
+
+  # Gauges of the live tasks by kind (read by the metrics registry)
+  def collect_metrics(self):
+    return [('background_tasks_running', {'kind': kind}, count) for kind, count in self.counts.items()]
+
+  # Stop accepting tasks, give the running ones a little while to finish, then cancel the rest
+  async def shutdown(self, timeout=5.0):
+    self.closing = True
+    for task, (kind, _) in list(self.tasks.items()):
+      if kind in LOOPING_KINDS:
+        task.cancel()
+    if not self.tasks:
+      return
+    _, pending = await asyncio.wait(list(self.tasks), timeout=timeout)
+    for task in pending:
+      task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,120 @@
+import unittest
+from lib.admission import AdmissionControl
+from lib.Responses.response import ResponseInterface
+from helpers import get_mock_discord_message, get_response
+
+# Clock that only moves when the test tells it to
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.admission = AdmissionControl(guild_capacity=3, guild_rate=1.0,
+                                          user_capacity=2, user_rate=0.5, clock=self.clock)
+
+    # A user can only burst up to their own capacity
+    def test_user_bucket(self):
+        results = [self.admission.admit(1, 100) for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+
+    # A busy guild runs out without affecting other guilds
+    def test_guild_bucket_is_per_guild(self):
+        results = [self.admission.admit(1, user) for user in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+        self.assertTrue(self.admission.admit(2, 0))
+
+    # DMs are only limited per user, not all together as one guild
+    def test_dm(self):
+        results = [self.admission.admit(None, user) for user in range(4)]
+        self.assertEqual(results, [True, True, True, True])
+        self.assertEqual([self.admission.admit(None, 0) for _ in range(2)], [True, False])
+        self.assertEqual(self.admission.get_levels()['guilds'], {})
+
+    # A rejected request does not use up the guild's budget
+    def test_rejection_takes_nothing(self):
+        self.admission.admit(1, 100)
+        self.admission.admit(1, 100)
+        self.assertFalse(self.admission.admit(1, 100))
+        self.assertEqual(self.admission.get_levels()['guilds'][1], 1.0)
+
+    # Refunds give the tokens back, but never past a full bucket
+    def test_refund(self):
+        self.admission.admit(1, 100)
+        self.admission.admit(1, 100)
+        self.admission.refund(1, 100)
+        self.assertEqual(self.admission.get_levels(), {'guilds': {1: 2.0}, 'users': {(1, 100): 1.0}})
+        self.admission.refund(1, 100)
+        self.admission.refund(1, 100)
+        self.assertEqual(self.admission.get_levels(), {'guilds': {1: 3.0}, 'users': {(1, 100): 2.0}})
+
+    # Buckets refill over time
+    def test_refill(self):
+        self.admission.admit(1, 100)
+        self.admission.admit(1, 100)
+        self.clock.now += 2.0 # one token for the user at 0.5/s
+        self.assertTrue(self.admission.admit(1, 100))
+        self.assertFalse(self.admission.admit(1, 100))
+
+    # Guild specific limits override the defaults
+    def test_guild_limits(self):
+        self.admission.guild_limits = {1: (1, 1.0)}
+        self.assertTrue(self.admission.admit(1, 100))
+        self.assertFalse(self.admission.admit(1, 101))
+
+    # Full buckets are forgotten by a sweep
+    def test_sweep(self):
+        self.admission.admit(1, 100)
+        self.clock.now += 10.0
+        self.admission.sweep()
+        self.assertEqual(self.admission.get_levels(), {'guilds': {}, 'users': {}})
+
+class TestResponseAdmission(unittest.TestCase):
+
+    # Responses reply with the busy message once their budget is gone
+    def test_busy_reply(self):
+        class Busy(ResponseInterface):
+            async def respond(self):
+                return 'ok'
+
+        to = Busy()
+        to.admission = AdmissionControl(user_capacity=1, user_rate=0.0, busy_message='busy')
+        request = get_mock_discord_message(author_id=1, guildid=2)
+        self.assertEqual(get_response(to, '', request)[0], 'ok')
+        self.assertEqual(get_response(to, '', request)[0], 'busy')
+
+    # DMs are admitted by their user's budget alone
+    def test_dm(self):
+        class Busy(ResponseInterface):
+            async def respond(self):
+                return 'ok'
+
+        to = Busy()
+        to.admission = AdmissionControl(guild_capacity=1, user_capacity=1, user_rate=0.0, busy_message='busy')
+        request = get_mock_discord_message(author_id=1)
+        request.guild = None
+        self.assertEqual(get_response(to, '', request)[0], 'ok')
+        self.assertEqual(get_response(to, '', request)[0], 'busy')
+
+    # Requests refused for being on cooldown dont use up the budget
+    def test_cooldown_refund(self):
+        class Cooling(ResponseInterface):
+            callsign = 'cooling'
+
+            def check_cooldown_timer(self):
+                return False
+
+            def get_cooldown_time(self):
+                return 5
+
+        to = Cooling()
+        to.admission = AdmissionControl(user_capacity=1, user_rate=0.0, busy_message='busy')
+        request = get_mock_discord_message(author_id=1, guildid=2)
+        self.assertEqual(get_response(to, '', request)[0], '!cooling is on cooldown (5s left)')
+        self.assertEqual(get_response(to, '', request)[0], '!cooling is on cooldown (5s left)')
+        self.assertEqual(to.admission.get_levels()['users'], {(2, 1): 1.0})
@@ -0,0 +1,205 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+from lib import aiapi, aiguard, aipriority
+from lib.postlanes import PostScheduler
+from clydebutwigglier import RemiliaClakeBot
+
+class TestClientPool(unittest.TestCase):
+
+    def setUp(self):
+        aiapi.clients.clear()
+        self.keys = patch.dict(aiapi.api_keys, {'deepseek': 'ds-key', 'openai': 'oa-key'})
+        self.keys.start()
+
+    def tearDown(self):
+        asyncio.run(aiapi.close_clients())
+        self.keys.stop()
+
+    # Models from the same provider share one long lived client
+    def test_client_reuse(self):
+        self.assertIs(aiapi.get_client(aiapi.DS_CHAT), aiapi.get_client(aiapi.DS_REASON))
+        self.assertIsNot(aiapi.get_client(aiapi.DS_CHAT), aiapi.get_client(aiapi.GPT4))
+        self.assertEqual(len(aiapi.clients), 2)
+
+    # Clients are configured from the provider table and our pool settings
+    @patch.dict('os.environ', {'DEEPSEEK_BASE_URL': 'http://127.0.0.1:8080/v1'})
+    def test_client_settings(self):
+        client = aiapi.get_client(aiapi.DS_CHAT)
+        self.assertEqual(str(client.base_url), 'http://127.0.0.1:8080/v1/')
+        self.assertEqual(client.api_key, 'ds-key')
+        self.assertEqual(client.max_retries, 0) # Retries are made by call_provider instead
+        self.assertEqual(client.timeout.connect, aiapi.CONNECT_TIMEOUT)
+
+    # Keys that are missing are only looked for once
+    @patch.dict('os.environ', {'DEEPSEEK_API_KEY': ''})
+    def test_missing_key(self):
+        del aiapi.api_keys['deepseek']
+        with patch.object(aiapi, 'missing_api_keys', set()), \
+             patch('builtins.open', side_effect=FileNotFoundError) as opened:
+            self.assertFalse(aiapi.has_api_key('deepseek'))
+            self.assertFalse(aiapi.has_api_key('deepseek'))
+            self.assertTrue(aiapi.has_api_key('openai'))
+        self.assertEqual(opened.call_count, 1)
+
+    # Closing forgets every client
+    def test_close(self):
+        aiapi.get_client(aiapi.DS_CHAT)
+        asyncio.run(aiapi.close_clients())
+        self.assertEqual(aiapi.clients, {})
+
+class TestRouteChat(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [patch.dict(aiapi.api_keys, {'deepseek': 'ds-key', 'openai': 'oa-key'}),
+            patch.object(aiapi, 'latencies', aiapi.LatencyTracker()),
+            patch.object(aiapi, 'HEDGING', True), patch.object(aiapi, 'HEDGE_AFTER', 0.02)]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+
+    # Send a request to models that take this long to answer
+    def route(self, model, delays):
+        def get_client(model):
+            async def create(**kwargs):
+                await asyncio.sleep(delays[model])
+                return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=model))])
+            return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+        with patch.object(aiapi, 'get_client', get_client):
+            return asyncio.run(aiapi.route_chat([{'role': 'user', 'content': 'hi'}], model, False))
+
+    # Only the request that answered has its latency recorded, not the one that lost the race
+    def test_lost_race(self):
+        self.assertEqual(self.route(aiapi.DS_CHAT, {aiapi.DS_CHAT: 0.5, aiapi.GPT4: 0.01}), aiapi.GPT4)
+        self.assertEqual(list(aiapi.latencies.latencies), [aiapi.GPT4])
+        self.assertEqual(self.route(aiapi.GPT4, {aiapi.GPT4: 0.05, aiapi.DS_CHAT: 0.5}), aiapi.GPT4)
+        self.assertEqual(list(aiapi.latencies.latencies), [aiapi.GPT4])
+        self.assertEqual(len(aiapi.latencies.latencies[aiapi.GPT4]), 2)
+
+    # The reasoner is never raced against its fallback, which it isnt equivalent to
+    def test_failover_only(self):
+        self.assertEqual(self.route(aiapi.DS_REASON, {aiapi.DS_REASON: 0.1, aiapi.GPT4: 0.01}), aiapi.DS_REASON)
+        self.assertIsNone(aiapi.get_hedge_after(aiapi.DS_REASON))
+        self.assertEqual(aiapi.get_fallback_model(aiapi.DS_REASON), aiapi.GPT4)
+
+class FakeChunks():
+    def __init__(self, deltas, error=None, delay=0):
+        self.deltas = deltas
+        self.error = error
+        self.delay = delay
+        self.closed = False
+
+    async def __aiter__(self):
+        for delta in self.deltas:
+            await asyncio.sleep(self.delay)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+        if self.error:
+            raise self.error
+
+    async def close(self):
+        self.closed = True
+
+class TestStreamedCompletion(unittest.TestCase):
+
+    def read(self, stream):
+        async def run():
+            return [part async for part in stream]
+        return asyncio.run(run())
+
+    # Text arrives piece by piece, skipping empty chunks, and the stream is closed at the end
+    def test_stream(self):
+        chunks = FakeChunks(['', 'hello', None, ' there '])
+        stream = aiapi.StreamedCompletion(chunks, aiapi.DS_CHAT, 0.0)
+        self.assertEqual(self.read(stream), ['hello', ' there '])
+        self.assertEqual(stream.get_text(), 'hello there')
+        self.assertTrue(chunks.closed)
+
+    # An error part way through ends the text with the error reply
+    def test_error(self):
+        stream = aiapi.StreamedCompletion(FakeChunks(['hello'], ValueError('oops')), aiapi.DS_CHAT, 0.0)
+        self.read(stream)
+        self.assertEqual(stream.get_text(), 'hello\n' + aiapi.ERROR_REPLY)
+
+    # A reply read after its command is done still stops at the command's deadline
+    def test_deadline(self):
+        chunks = FakeChunks(['hello', ' there', ' again'], delay=0.03)
+        with aiguard.deadline(0.05):
+            stream = aiapi.StreamedCompletion(chunks, aiapi.DS_CHAT, 0.0)
+        self.read(stream)
+        self.assertEqual(stream.get_text(), 'hello\n' + aiapi.ERROR_REPLY)
+        self.assertEqual(stream.outcome, 'error')
+        self.assertTrue(chunks.closed)
+
+    # Defaults apply to streams that end up empty, as well as plain replies
+    def test_or_default(self):
+        stream = aiapi.or_default(aiapi.StreamedCompletion(FakeChunks(['', ' ']), aiapi.DS_CHAT, 0.0), ':think:')
+        self.read(stream)
+        self.assertEqual(stream.get_text(), ':think:')
+        self.assertEqual(aiapi.or_default('', ':think:'), ':think:')
+        self.assertEqual(aiapi.or_default('hi', ':think:'), 'hi')
+
+    # A streamed reply is shared with identical requests once it has finished
+    def test_shared_stream(self):
+        sent = []
+
+        async def create(**kwargs):
+            sent.append(kwargs)
+            return FakeChunks(['hello', ' there'])
+
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        messages = [{'role': 'user', 'content': 'hi', 'name': 'remi'}]
+
+        async def run():
+            stream = await aiapi.get_response_to_chat(messages, stream=True)
+            follower = asyncio.create_task(aiapi.get_response_to_chat(messages, stream=True))
+            await asyncio.sleep(0)
+            self.assertFalse(follower.done())
+            parts = [part async for part in stream]
+            return parts, await follower
+
+        with patch.object(aiapi, 'get_client', lambda model: client), \
+             patch.object(aiapi, 'request_cache', aiapi.RequestCache(30, 10)):
+            self.assertEqual(asyncio.run(run()), (['hello', ' there'], 'hello there'))
+        self.assertEqual(len(sent), 1)
+
+    # A reply that is cancelled before it is read still frees the provider's slot and the request cache's entry
+    def test_cancelled_before_read(self):
+        chunks = FakeChunks(['hello'])
+
+        async def create(**kwargs):
+            return chunks
+
+        class Typing():
+            async def __aenter__(self):
+                await asyncio.Event().wait()
+
+            async def __aexit__(self, *error):
+                pass
+
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        limiter = aipriority.PriorityLimiter('test', 1, 10)
+        cache = aiapi.RequestCache(30, 10)
+        bot = SimpleNamespace(post_scheduler=PostScheduler())
+        context = Mock()
+        context.channel.typing = Typing
+
+        async def run():
+            stream = await aiapi.get_response_to_chat([{'role': 'user', 'content': 'hi'}], stream=True)
+            self.assertEqual((limiter.active, len(cache.in_flight)), (1, 1))
+            post = asyncio.create_task(RemiliaClakeBot.post_stream(bot, stream, None, context, {}))
+            await asyncio.sleep(0.01)
+            post.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await post
+
+        with patch.object(aiapi, 'get_client', lambda model: client), \
+             patch.object(aiapi, 'get_limiter', lambda provider: limiter), \
+             patch.object(aiapi, 'request_cache', cache):
+            asyncio.run(run())
+        self.assertEqual((limiter.active, cache.in_flight, cache.entries), (0, {}, {}))
+        self.assertTrue(chunks.closed)
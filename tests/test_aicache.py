@@ -0,0 +1,133 @@
+import unittest
+import asyncio
+from types import SimpleNamespace
+from lib.aicache import RequestCache, FormatCache, make_key
+
+class TestMakeKey(unittest.TestCase):
+
+    # Messages without any text dont change the key, but everything else does
+    def test_normalized(self):
+        messages = [{'role': 'user', 'content': 'hello ', 'name': 'remi'}]
+        bare = [{'role': 'user', 'content': '', 'name': 'clyde'}]
+        self.assertEqual(make_key('m', messages), make_key('m', messages + bare))
+        self.assertEqual(make_key('m', messages), make_key('m', [dict(messages[0], content='hello')]))
+        self.assertNotEqual(make_key('m', messages), make_key('other', messages))
+        self.assertNotEqual(make_key('m', messages, temperature=0.9), make_key('m', messages, temperature=0.5))
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.sent = 0
+
+    def make_request(self, text, delay=0.01):
+        async def request(finish):
+            self.sent += 1
+            await asyncio.sleep(delay)
+            finish(text)
+            return text
+        return request
+
+    # Identical requests in flight at the same time share one
+    def test_coalesced(self):
+        cache = RequestCache(0, 0)
+
+        async def run():
+            return await asyncio.gather(*[cache.get_or_request('key', self.make_request('hi')) for _ in range(3)])
+
+        self.assertEqual(asyncio.run(run()), ['hi'] * 3)
+        self.assertEqual(self.sent, 1)
+        self.assertEqual(cache.in_flight, {})
+
+    # Answers are cached until they expire
+    def test_ttl(self):
+        cache = RequestCache(30, 10, clock=lambda: self.now)
+        asyncio.run(cache.get_or_request('key', self.make_request('hi')))
+        self.now = 29
+        self.assertEqual(asyncio.run(cache.get_or_request('key', self.make_request('new'))), 'hi')
+        self.now = 31
+        self.assertEqual(asyncio.run(cache.get_or_request('key', self.make_request('new'))), 'new')
+        self.assertEqual(self.sent, 2)
+
+    # The least recently used answers are dropped first
+    def test_lru(self):
+        cache = RequestCache(30, 2, clock=lambda: self.now)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+    # Failures are shared with whoever was waiting, but not cached
+    def test_failure(self):
+        cache = RequestCache(30, 10)
+
+        async def failing(finish):
+            await asyncio.sleep(0.01)
+            raise ValueError('oops')
+
+        async def run():
+            return await asyncio.gather(cache.get_or_request('key', failing),
+                cache.get_or_request('key', failing), return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(cache.entries, {})
+
+    # If a request is abandoned, whoever was waiting on it sends their own
+    def test_abandoned(self):
+        cache = RequestCache(30, 10)
+
+        async def abandoned(finish):
+            await asyncio.sleep(0.01)
+            finish(None)
+            return None
+
+        async def run():
+            first = asyncio.create_task(cache.get_or_request('key', abandoned))
+            await asyncio.sleep(0)
+            return await asyncio.gather(first, cache.get_or_request('key', self.make_request('hi')))
+
+        self.assertEqual(asyncio.run(run()), [None, 'hi'])
+
+class TestFormatCache(unittest.TestCase):
+
+    def setUp(self):
+        self.formatted = 0
+
+    def make_message(self, id, content='hello', edited_at=None):
+        return SimpleNamespace(id=id, content=content, edited_at=edited_at)
+
+    def format(self, message):
+        def format():
+            self.formatted += 1
+            return {'content': message.content}
+        return format
+
+    # Messages are only formatted once for each mode
+    def test_hit(self):
+        cache = FormatCache(10)
+        message = self.make_message(1)
+        for _ in range(3):
+            cache.get(message, 'user', self.format(message))
+        cache.get(message, 'assistant', self.format(message))
+        self.assertEqual(self.formatted, 2)
+        self.assertEqual(cache.hit_ratio(), 0.5)
+
+    # Edited (or changed) messages are formatted again
+    def test_edited(self):
+        cache = FormatCache(10)
+        cache.get(self.make_message(1), 'user', self.format(self.make_message(1)))
+        edited = self.make_message(1, 'edited', edited_at=1)
+        self.assertEqual(cache.get(edited, 'user', self.format(edited)), {'content': 'edited'})
+        changed = self.make_message(1, 'changed', edited_at=1)
+        self.assertEqual(cache.get(changed, 'user', self.format(changed)), {'content': 'changed'})
+
+    # Invalidated messages are forgotten, and only the most recently used are kept
+    def test_bounded(self):
+        cache = FormatCache(2)
+        for id in (1, 2, 3):
+            cache.get(self.make_message(id), 'user', self.format(self.make_message(id)))
+        self.assertEqual(list(cache.messages), [2, 3])
+        cache.invalidate(3)
+        self.assertEqual(list(cache.messages), [2])
@@ -0,0 +1,40 @@
+import unittest
+from lib.aicontext import estimate_tokens, fit_to_budget, truncate, IMAGE_TOKENS, TRUNCATION_MARK
+
+def make_message(text, name='remi'):
+    return {'role': 'user', 'content': text, 'name': name}
+
+class TestFitToBudget(unittest.TestCase):
+
+    # Images cost a fixed amount on top of their message's text
+    def test_estimate_images(self):
+        text = make_message('hello')
+        image = make_message([{'type': 'text', 'text': 'hello'}, {'type': 'image_url', 'image_url': {'url': 'x'}}])
+        self.assertEqual(estimate_tokens(image), estimate_tokens(text) + IMAGE_TOKENS)
+
+    # Everything is kept when it fits
+    def test_fits(self):
+        messages = [make_message('hello'), make_message('there')]
+        self.assertEqual(fit_to_budget(messages, 1000), messages)
+
+    # The newest messages are kept first, and the oldest left out
+    def test_drops_oldest(self):
+        messages = [make_message(str(i) * 40) for i in range(10)]
+        kept = fit_to_budget(messages, 5 * estimate_tokens(messages[0]))
+        self.assertEqual(kept, messages[-5:])
+
+    # A long paste is cut short, instead of pushing out the rest of the conversation
+    def test_truncates_long_messages(self):
+        messages = [make_message('older'), make_message('x' * 10000), make_message('newest')]
+        kept = fit_to_budget(messages, 500)
+        self.assertEqual(len(kept), 3)
+        self.assertTrue(kept[1]['content'].endswith(TRUNCATION_MARK))
+        self.assertLessEqual(sum(map(estimate_tokens, kept)), 500)
+
+    # The newest message is always sent, even when nothing else fits
+    def test_keeps_newest(self):
+        messages = [make_message('older'), make_message('x' * 10000)]
+        kept = fit_to_budget(messages, 100)
+        self.assertEqual(len(kept), 1)
+        self.assertLessEqual(estimate_tokens(kept[0]), 100)
+        self.assertIsNone(truncate(make_message('x' * 1000), 10))
@@ -0,0 +1,112 @@
+import unittest
+import asyncio
+from unittest.mock import patch
+from lib import aiguard
+from lib.aiguard import CircuitBreaker, BreakerOpen, deadline, time_left, retry
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    # Enough failures in a row open the breaker, and successes in between reset the count
+    def test_opens(self):
+        breaker = CircuitBreaker('p', failure_threshold=3, reset_after=10)
+        breaker.record_failure(now=0)
+        breaker.record_failure(now=0)
+        breaker.record_success()
+        breaker.record_failure(now=0)
+        breaker.record_failure(now=0)
+        self.assertTrue(breaker.allow(now=0))
+        breaker.record_failure(now=0)
+        self.assertEqual(breaker.state, aiguard.OPEN)
+        self.assertFalse(breaker.allow(now=5))
+
+    # After a while one trial request is let through, which decides whether it closes again
+    def test_half_open(self):
+        changes = []
+        breaker = CircuitBreaker('p', failure_threshold=1, reset_after=10, on_change=lambda b, old: changes.append(b.state))
+        breaker.record_failure(now=0)
+        self.assertTrue(breaker.allow(now=10))
+        self.assertEqual(breaker.state, aiguard.HALF_OPEN)
+        self.assertFalse(breaker.allow(now=10))
+        breaker.record_failure(now=11)
+        self.assertFalse(breaker.allow(now=15))
+        self.assertTrue(breaker.allow(now=21))
+        breaker.record_success()
+        self.assertEqual(changes, ['open', 'half_open', 'open', 'half_open', 'closed'])
+
+    # An open breaker fails requests without making them, and errors that arent failures dont count
+    def test_call(self):
+        breaker = CircuitBreaker('p', failure_threshold=1)
+        calls = []
+
+        async def request():
+            calls.append(1)
+            raise ValueError('bad request')
+
+        with self.assertRaises(ValueError):
+            asyncio.run(breaker.call(request, lambda e: False))
+        self.assertEqual(breaker.state, aiguard.CLOSED)
+        with self.assertRaises(ValueError):
+            asyncio.run(breaker.call(request, lambda e: True))
+        with self.assertRaises(BreakerOpen):
+            asyncio.run(breaker.call(request, lambda e: True))
+        self.assertEqual(len(calls), 2)
+
+class TestDeadline(unittest.TestCase):
+
+    # Deadlines only apply inside their block, and nested ones can only shorten them
+    def test_nesting(self):
+        self.assertIsNone(time_left())
+        self.assertEqual(time_left(5), 5)
+        with deadline(10):
+            self.assertLessEqual(time_left(), 10)
+            self.assertEqual(time_left(5), 5)
+            with deadline(60):
+                self.assertLessEqual(time_left(), 10)
+            with deadline(1):
+                self.assertLessEqual(time_left(), 1)
+            with deadline(None):
+                self.assertGreater(time_left(), 1)
+        self.assertIsNone(time_left())
+
+class TestRetry(unittest.TestCase):
+
+    def flaky(self, failures, error=TimeoutError):
+        calls = []
+
+        async def request():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise error('down')
+            return 'ok'
+        return request, calls
+
+    # Transient errors are retried until it works or the attempts run out
+    def test_retries(self):
+        retried = []
+        request, calls = self.flaky(2)
+        self.assertEqual(asyncio.run(retry(request, 3, lambda e: True, retried.append, base=0.001)), 'ok')
+        self.assertEqual((len(calls), len(retried)), (3, 2))
+
+        request, calls = self.flaky(5)
+        with self.assertRaises(TimeoutError):
+            asyncio.run(retry(request, 3, lambda e: True, base=0.001))
+        self.assertEqual(len(calls), 3)
+
+    # Other errors are raised straight away
+    def test_not_retryable(self):
+        request, calls = self.flaky(1, ValueError)
+        with self.assertRaises(ValueError):
+            asyncio.run(retry(request, 3, lambda e: isinstance(e, TimeoutError), base=0.001))
+        self.assertEqual(len(calls), 1)
+
+    # Nothing is retried if the backoff would run past the deadline
+    def test_deadline(self):
+        request, calls = self.flaky(1)
+
+        async def run():
+            with deadline(0.01):
+                return await retry(request, 3, lambda e: True, base=10, cap=10)
+
+        with patch('random.uniform', lambda low, high: high), self.assertRaises(TimeoutError):
+            asyncio.run(run())
+        self.assertEqual(len(calls), 1)
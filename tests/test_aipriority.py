@@ -0,0 +1,104 @@
+import unittest
+import asyncio
+from lib import aipriority
+from lib.aipriority import PriorityLimiter, QueueFull
+from lib.Responses.selfaware import SelfAwareResponse
+from tests.helpers import get_mock_discord_message
+
+class TestPriorityLimiter(unittest.TestCase):
+
+    # Hold a slot for a while, recording the order slots were given out in
+    async def use(self, limiter, order, name, priority, hold=0.01):
+        await limiter.acquire(priority)
+        order.append(name)
+        await asyncio.sleep(hold)
+        limiter.release()
+
+    # Free slots go to the most important request waiting, then the oldest
+    def test_order(self):
+        async def run():
+            limiter = PriorityLimiter('p', 1, 10)
+            order = []
+            first = asyncio.create_task(self.use(limiter, order, 'first', aipriority.BACKGROUND))
+            await asyncio.sleep(0)
+            tasks = [asyncio.create_task(self.use(limiter, order, name, priority)) for name, priority in (
+                ('image', aipriority.BACKGROUND), ('autofire', aipriority.AUTOFIRE),
+                ('command', aipriority.COMMAND), ('mention', aipriority.INTERACTIVE), ('command2', aipriority.COMMAND))]
+            await asyncio.gather(first, *tasks)
+            return order, limiter.active
+
+        order, active = asyncio.run(run())
+        self.assertEqual(order, ['first', 'mention', 'command', 'command2', 'autofire', 'image'])
+        self.assertEqual(active, 0)
+
+    # A cancelled request leaves the queue without taking (or losing) a slot
+    def test_cancel(self):
+        async def run():
+            limiter = PriorityLimiter('p', 1, 10)
+            await limiter.acquire()
+            waiter = asyncio.create_task(limiter.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            self.assertEqual(limiter.waiting, [])
+            limiter.release()
+            await asyncio.wait_for(limiter.acquire(), 1)
+            return limiter.active
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+    # When too much is queued the least important work is turned away, but never interactive work
+    def test_shed(self):
+        async def run():
+            limiter = PriorityLimiter('p', 1, 2)
+            await limiter.acquire()
+            waiters = {priority: asyncio.create_task(limiter.acquire(priority)) for priority in
+                (aipriority.BACKGROUND, aipriority.AUTOFIRE, aipriority.INTERACTIVE)}
+            with self.assertRaises(QueueFull):
+                await waiters[aipriority.BACKGROUND]
+            self.assertEqual(len(limiter.waiting), 2)
+
+            extra = asyncio.create_task(limiter.acquire(aipriority.COMMAND))
+            with self.assertRaises(QueueFull):
+                await waiters[aipriority.AUTOFIRE]
+            limiter.release()
+            await waiters[aipriority.INTERACTIVE]
+
+        asyncio.run(run())
+
+    # A request turned away and then cancelled before it wakes up never had a slot to give back
+    def test_cancel_after_shed(self):
+        async def run():
+            limiter = PriorityLimiter('p', 1, 1)
+            await limiter.acquire()
+            waiter = asyncio.create_task(limiter.acquire(aipriority.BACKGROUND))
+            await asyncio.sleep(0)
+            other = asyncio.create_task(limiter.acquire(aipriority.INTERACTIVE)) # Turns the waiter away
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            self.assertEqual(limiter.active, 1)
+            self.assertFalse(other.done())
+
+            limiter.release()
+            await other
+            self.assertEqual(limiter.active, 1)
+
+        asyncio.run(run())
+
+    # Requests take the priority of the code that made them
+    def test_context(self):
+        self.assertEqual(aipriority.current(), aipriority.COMMAND)
+        with aipriority.priority(aipriority.AUTOFIRE):
+            self.assertEqual(aipriority.current(), aipriority.AUTOFIRE)
+        self.assertEqual(aipriority.current(), aipriority.COMMAND)
+
+class TestResponsePriority(unittest.TestCase):
+
+    # The roleplay answers mentions of the bot as urgently as _chat does
+    def test_selfaware_mention(self):
+        response = SelfAwareResponse()
+        response.is_me = lambda user: user.id == 1
+        self.assertEqual(response.get_ai_priority(get_mock_discord_message(mentions=[1])), aipriority.INTERACTIVE)
+        self.assertEqual(response.get_ai_priority(get_mock_discord_message(mentions=[2])), aipriority.COMMAND)
@@ -0,0 +1,61 @@
+import unittest
+import asyncio
+from lib.airouting import LatencyTracker, hedged
+
+class TestLatencyTracker(unittest.TestCase):
+
+    # Percentiles are only given once there are enough samples
+    def test_percentile(self):
+        tracker = LatencyTracker(samples=100, min_samples=10)
+        for i in range(9):
+            tracker.record('m', i)
+        self.assertIsNone(tracker.percentile('m'))
+        for i in range(9, 100):
+            tracker.record('m', i)
+        self.assertEqual(tracker.percentile('m'), 95)
+        self.assertIsNone(tracker.percentile('other'))
+
+class TestHedged(unittest.TestCase):
+
+    def reply(self, value, delay=0.0, error=None):
+        async def request():
+            await asyncio.sleep(delay)
+            if error:
+                raise error
+            return value
+        return request
+
+    # A quick answer never sends the backup
+    def test_primary(self):
+        backup = self.reply('backup')
+        result = asyncio.run(hedged(self.reply('first'), backup, 0.05))
+        self.assertEqual(result, ('first', 'primary'))
+
+    # A slow request is raced against the backup, and the faster one wins
+    def test_hedge(self):
+        discarded = []
+
+        async def discard(result):
+            discarded.append(result)
+
+        result = asyncio.run(hedged(self.reply('first', 0.5), self.reply('backup', 0.01), 0.02, discard))
+        self.assertEqual(result, ('backup', 'hedge'))
+
+        result = asyncio.run(hedged(self.reply('first', 0.04), self.reply('backup', 0.5), 0.02, discard))
+        self.assertEqual(result, ('first', 'primary'))
+        self.assertEqual(discarded, [])
+
+    # A failed request goes straight to the backup
+    def test_failover(self):
+        result = asyncio.run(hedged(self.reply('first', error=ValueError('down')), self.reply('backup'), 10))
+        self.assertEqual(result, ('backup', 'failover'))
+
+        result = asyncio.run(hedged(self.reply('first', error=ValueError('down')), self.reply('backup'), None))
+        self.assertEqual(result, ('backup', 'failover'))
+
+    # When nothing works, the first error is raised
+    def test_everything_fails(self):
+        with self.assertRaisesRegex(ValueError, 'first'):
+            asyncio.run(hedged(self.reply(None, error=ValueError('first')), self.reply(None, 0.01, KeyError('backup')), 10))
+        with self.assertRaisesRegex(ValueError, 'first'):
+            asyncio.run(hedged(self.reply(None, error=ValueError('first')), None, 10))
@@ -0,0 +1,29 @@
+import unittest
+from lib.aitemplate import PromptTemplate
+
+class TestPromptTemplate(unittest.TestCase):
+
+    # The static text always comes first, unchanged, with the fields filled in after it
+    def test_render(self):
+        template = PromptTemplate('test', '\nBe nice {not a field}.\n', '\nName: {name}\nCount: {count}')
+        first = template.render(name='clyde {x}', count=1)
+        second = template.render(name='remi', count=2)
+        self.assertEqual(first, 'Be nice {not a field}.\n\nName: clyde {x}\nCount: 1')
+        self.assertTrue(second.startswith(template.prefix))
+        self.assertTrue(second.endswith('Name: remi\nCount: 2'))
+
+    # Every field has to be given
+    def test_missing(self):
+        template = PromptTemplate('test', 'static', '{a} {b}')
+        with self.assertRaisesRegex(KeyError, 'b'):
+            template.render(a=1)
+
+    # The size of each half of the latest prompt is reported
+    def test_report(self):
+        template = PromptTemplate('test', 'x' * 400, '{text}')
+        self.assertEqual(template.collect_metrics(), [])
+        template.render(text='y' * 100)
+        gauges = {(name, labels.get('part')): value for name, labels, value in template.collect_metrics()}
+        self.assertEqual(gauges[('ai_prompt_last_tokens', 'static')], 101)
+        self.assertEqual(gauges[('ai_prompt_last_tokens', 'dynamic')], 25)
+        self.assertAlmostEqual(gauges[('ai_prompt_static_share', None)], 101 / 126)
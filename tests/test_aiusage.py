@@ -0,0 +1,58 @@
+import unittest
+import asyncio
+import os
+import shutil
+import tempfile
+from lib import aiusage
+from lib.aiusage import UsageLog
+
+class TestUsageLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = UsageLog(os.path.join(self.directory, 'usage.db'), batch_size=3, flush_interval=0.05)
+
+    def tearDown(self):
+        asyncio.run(self.log.close())
+        shutil.rmtree(self.directory)
+
+    # Rows are kept in memory until a batch is full (or a while passes), then written all at once
+    def test_batches(self):
+        async def run():
+            self.log.start()
+            self.log.record('m', 'p', 'ok', 3, 100, 10, 0.5)
+            self.log.record('m', 'p', 'ok', 3, 100, 10, 0.5)
+            await asyncio.sleep(0)
+            self.assertEqual(len(self.log.pending), 2)
+            self.log.record('m', 'p', 'ok', 3, 100, 10, 0.5)
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.log.pending, [])
+            self.log.record('m', 'p', 'ok', 3, 100, 10, 0.5)
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.log.pending, [])
+            await self.log.close()
+            return self.log.rollup(())
+
+        self.assertEqual(asyncio.run(run())[0]['requests'], 4)
+
+    # Requests are totalled up by whatever they're grouped by, and accounted to the command they were for
+    def test_rollup(self):
+        with aiusage.account('gpt', 1):
+            self.log.record('gpt-4o-mini', 'openai', 'ok', 5, 1000, 100, 1.0)
+            self.log.record('gpt-4o-mini', 'openai', 'error', 5, 0, 0, 3.0)
+        with aiusage.account('aichat', 2):
+            self.log.record('deepseek-chat', 'deepseek', 'ok', 1, 50, 50, 2.0)
+        self.log.record('deepseek-chat', 'deepseek', 'ok', 3, 10, 10, 2.0, account=('infodump', 2))
+        asyncio.run(self.log.flush())
+
+        by_model = self.log.rollup(['model'])
+        self.assertEqual([row['model'] for row in by_model], ['gpt-4o-mini', 'deepseek-chat'])
+        self.assertEqual((by_model[0]['requests'], by_model[0]['errors'], by_model[0]['prompt_tokens']), (2, 1, 1000))
+        self.assertEqual(by_model[0]['latency'], 2.0)
+        self.assertEqual(by_model[1]['max_latency'], 2.0)
+
+        by_guild = self.log.rollup(['guild', 'callsign'])
+        self.assertEqual([(row['guild'], row['callsign']) for row in by_guild], [(1, 'gpt'), (2, 'aichat'), (2, 'infodump')])
+        self.assertEqual(self.log.rollup(['model'], since=2**40), [])
+        with self.assertRaises(ValueError):
+            self.log.rollup(['model; DROP TABLE ai_usage'])
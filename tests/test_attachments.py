@@ -0,0 +1,60 @@
+import unittest
+import asyncio
+import base64
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+from lib.attachments import AttachmentCache
+
+def make_attachment(id, content_type='image/png'):
+    return SimpleNamespace(id=id, url=f'https://cdn.example.com/{id}.png', content_type=content_type)
+
+class TestAttachmentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = AttachmentCache(self.directory, max_bytes=1000, max_edge=1024)
+        self.downloads = []
+
+        async def download(url):
+            self.downloads.append(url)
+            return url.encode() * 10
+
+        self.cache.download = download
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # Images are downloaded once, and sent as data urls afterwards
+    def test_download_once(self):
+        attachment = make_attachment(1)
+        asyncio.run(self.cache.prepare([attachment, attachment, make_attachment(2, 'text/plain')]))
+        asyncio.run(self.cache.prepare([attachment]))
+        self.assertEqual(len(self.downloads), 1)
+        data_url = self.cache.get_data_url(attachment)
+        self.assertEqual(base64.b64decode(data_url.split(',')[1]), attachment.url.encode() * 10)
+        self.assertIsNone(self.cache.get_data_url(make_attachment(2)))
+
+    # The same image attached twice is only stored once
+    def test_content_addressed(self):
+        first, second = make_attachment(1), make_attachment(2)
+        second.url = first.url
+        asyncio.run(self.cache.prepare([first, second]))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(self.cache.get_data_url(first), self.cache.get_data_url(second))
+
+    # The least recently used images are deleted to keep the cache under its size
+    def test_bounded(self):
+        asyncio.run(self.cache.prepare([make_attachment(n) for n in range(5)]))
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.directory, f)) for f in os.listdir(self.directory)), 1000)
+        self.assertEqual(len(self.cache.files), len(os.listdir(self.directory)))
+        self.assertLess(len(self.cache.files), 5)
+
+    # Images that cant be downloaded are skipped
+    def test_failed_download(self):
+        async def download(url):
+            raise OSError('expired')
+        self.cache.download = download
+        asyncio.run(self.cache.prepare([make_attachment(1)]))
+        self.assertIsNone(self.cache.get_data_url(make_attachment(1)))
@@ -0,0 +1,95 @@
+import unittest
+import asyncio
+import discord
+from collections import Counter
+from unittest.mock import AsyncMock, Mock, patch
+from lib import aiapi, aiusage, attachments, history, metrics
+from lib.postlanes import PostScheduler
+from lib.Responses.response import ResponseInterface
+import clydebutwigglier
+from clydebutwigglier import RemiliaClakeBot
+from tests.helpers import get_mock_discord_message
+
+class TestProcessWorkers(unittest.TestCase):
+
+    def get_workers(self, process_count=1):
+        bot = RemiliaClakeBot.__new__(RemiliaClakeBot)
+        bot.process_count = process_count
+        return bot.get_process_workers()
+
+    # By default only a few of the cores are used, shared between the bot processes
+    @patch.dict('os.environ', {'PROCESS_WORKERS': ''})
+    def test_default(self):
+        with patch('os.cpu_count', return_value=32):
+            self.assertEqual(self.get_workers(), 4)
+            self.assertEqual(self.get_workers(process_count=2), 2)
+        with patch('os.cpu_count', return_value=None):
+            self.assertEqual(self.get_workers(process_count=2), 1)
+
+    # PROCESS_WORKERS overrides it
+    @patch.dict('os.environ', {'PROCESS_WORKERS': '6'})
+    def test_setting(self):
+        with patch('os.cpu_count', return_value=2):
+            self.assertEqual(self.get_workers(process_count=2), 6)
+
+class TestClose(unittest.TestCase):
+
+    # Closing the bot also stops serving metrics
+    @patch.object(discord.Client, 'close', AsyncMock())
+    @patch.object(aiapi, 'close_clients', AsyncMock())
+    @patch.object(attachments.cache, 'close', AsyncMock())
+    @patch.object(aiusage.log, 'close', AsyncMock())
+    def test_metrics_server(self):
+        async def run():
+            bot = RemiliaClakeBot.__new__(RemiliaClakeBot)
+            runner = bot.metrics_server = await metrics.start_server(0)
+            await bot.close()
+            self.assertIsNone(bot.metrics_server)
+            self.assertEqual((runner.server, runner.sites), (None, set()))
+
+        asyncio.run(run())
+
+class TestDispatch(unittest.TestCase):
+
+    # Several commands in one message run at the same time, but their replies are still posted in order
+    @patch.object(history, 'store', Mock())
+    @patch('random.randrange', lambda stop: 0)
+    @patch.object(clydebutwigglier.startup, 'mark', Mock(return_value=False))
+    def test_concurrent_responses(self):
+        events = []
+
+        class Slow(ResponseInterface):
+            def __init__(self, callsign, delay):
+                self.callsign = callsign
+                self.delay = delay
+
+            async def respond(self):
+                events.append(('start', self.callsign))
+                await asyncio.sleep(self.delay)
+                events.append(('end', self.callsign))
+                return self.callsign
+
+        async def post(content, **kwargs):
+            await asyncio.sleep(0.01)
+            events.append(('post', content))
+
+        bot = RemiliaClakeBot.__new__(RemiliaClakeBot)
+        bot.responses = {'slower': Slow('slower', 0.05), 'slow': Slow('slow', 0.01)}
+        bot.post_scheduler = PostScheduler()
+        bot.message_counts = Counter()
+        bot.is_me = lambda user: False
+        message = get_mock_discord_message(author_id=1)
+        message.guild = None
+        message.content = '!slower !slow hi'
+        message.channel.id = 2
+        message.channel.typing = Mock(return_value=AsyncMock())
+        message.reply = message.channel.send = post
+
+        async def run():
+            await asyncio.gather(bot.on_message(message), bot.post('first in line', message.channel, {}, is_reply=False))
+
+        asyncio.run(run())
+        self.assertEqual(events[:2], [('start', 'slower'), ('start', 'slow')])
+        self.assertLess(events.index(('end', 'slow')), events.index(('end', 'slower')))
+        self.assertEqual([event for kind, event in events if kind == 'post'], ['first in line', 'slower', 'slow'])
+        self.assertEqual(bot.post_scheduler.get_queue_depths(), {})
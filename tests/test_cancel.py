@@ -0,0 +1,28 @@
+import unittest
+import asyncio
+from unittest.mock import Mock, patch
+from lib import history
+from lib.Responses.cancel import find_evidence
+from tests.test_history import make_message
+
+class TestFindEvidence(unittest.TestCase):
+
+    # Evidence read from the in-memory history can still be replied to
+    def test_warm_history(self):
+        channel = Mock()
+        channel.id = 1
+        channel.history.side_effect = AssertionError('should be read from memory')
+        messages = [make_message(n, content=f'a long enough message number {n}') for n in range(3)]
+        for message in messages:
+            message.author.id = 7
+            message.channel = channel
+
+        store = history.MessageHistory()
+        store.backfill(1, messages[::-1], 1500)
+        self.assertTrue(store.channels[1].reaches_start)
+        with patch.object(history, 'store', store), patch('random.randint', lambda low, high: 1500):
+            evidence = asyncio.run(find_evidence(channel, 7, lambda _: True))
+
+        channel.get_partial_message.assert_called_once_with(messages[0].id)
+        self.assertIs(evidence, channel.get_partial_message.return_value)
+        self.assertTrue(hasattr(evidence, 'reply'))
@@ -0,0 +1,77 @@
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import Mock
+from discord.utils import snowflake_time
+from lib.history import MessageHistory
+
+# Message ids are snowflakes, so they sort by time (and can be compared to datetimes)
+BASE_ID = 1300000000000000000
+
+def make_message(n, channel_id=1, content=None):
+    message = Mock()
+    message.id = BASE_ID + (n << 22)
+    message.channel.id = channel_id
+    message.content = content or f'message {n}'
+    message.attachments = []
+    message.created_at = snowflake_time(message.id)
+    message.edited_at = None
+    return message
+
+class TestMessageHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.history = MessageHistory(channel_messages=5, max_channels=2)
+        self.messages = [make_message(n) for n in range(10)]
+
+    def contents(self, messages):
+        return [m.content for m in messages]
+
+    # Recent messages are read back newest first, from before a message or a datetime
+    def test_read(self):
+        for message in self.messages[5:]:
+            self.history.add(message)
+        self.assertEqual(self.contents(self.history.read(1, 2)), ['message 9', 'message 8'])
+        self.assertEqual(self.contents(self.history.read(1, 2, before=self.messages[9])), ['message 8', 'message 7'])
+        self.assertEqual(self.contents(self.history.read(1, 1, before=self.messages[7].created_at)), ['message 6'])
+
+    # Reads that go further back than the messages kept (or unknown channels) arent answered
+    def test_cold(self):
+        for message in self.messages[7:]:
+            self.history.add(message)
+        self.assertIsNone(self.history.read(1, 5))
+        self.assertIsNone(self.history.read(2, 1))
+
+    # Messages fetched from the api fill in the history, if they join up with it
+    def test_backfill(self):
+        self.history.add(self.messages[8])
+        self.history.add(self.messages[9])
+        fetched = self.messages[5:9][::-1]
+        self.history.backfill(1, fetched, 4, before=self.messages[9])
+        self.assertEqual(self.contents(self.history.read(1, 5)), self.contents(self.messages[5:][::-1]))
+
+        # A fetch from further back might leave a gap, so it is left out
+        self.history.backfill(1, self.messages[:2][::-1], 2, before=self.messages[2])
+        self.assertIsNone(self.history.read(1, 6))
+
+    # A channel with fewer messages than asked for is still answered once its start is known
+    def test_reaches_start(self):
+        self.history.add(self.messages[2])
+        self.history.backfill(1, self.messages[:2][::-1], 5, before=self.messages[2])
+        self.assertEqual(self.contents(self.history.read(1, 5)), ['message 2', 'message 1', 'message 0'])
+
+    # Edits and deletes are kept up to date
+    def test_edit_delete(self):
+        for message in self.messages[5:]:
+            self.history.add(message)
+        self.history.edit(1, self.messages[9].id, message=make_message(9, content='edited'))
+        self.history.edit(1, self.messages[8].id, data={'content': 'raw edit', 'edited_timestamp': '2024-01-01T00:00:00+00:00'})
+        self.history.delete(1, self.messages[7].id)
+        messages = self.history.read(1, 4)
+        self.assertEqual(self.contents(messages), ['edited', 'raw edit', 'message 6', 'message 5'])
+        self.assertEqual(messages[1].edited_at, datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+    # Only the most recently used channels are kept
+    def test_channel_limit(self):
+        for channel_id in (1, 2, 3):
+            self.history.add(make_message(0, channel_id))
+        self.assertEqual(list(self.history.channels), [2, 3])
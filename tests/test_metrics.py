@@ -0,0 +1,96 @@
+import unittest
+import asyncio
+from unittest.mock import Mock
+from lib import aiapi, metrics
+from lib.Responses import stats
+from lib.Responses.response import ResponseInterface
+from tests.test_aiapi import FakeChunks
+from helpers import get_mock_discord_message, get_response
+
+class TestHistogram(unittest.TestCase):
+
+    # Quantiles are interpolated inside the bucket they land in
+    def test_quantiles(self):
+        h = metrics.Histogram(bounds=(1.0, 2.0, float('inf')))
+        for value in [0.5] * 50 + [1.5] * 45 + [100.0] * 5:
+            h.observe(value)
+
+        self.assertAlmostEqual(h.quantile(0.5), 1.0)
+        self.assertAlmostEqual(h.quantile(0.95), 2.0)
+        self.assertAlmostEqual(h.quantile(0.99), 2.0) # Cant estimate past the last finite bound
+        self.assertEqual(h.count, 100)
+
+    def test_empty(self):
+        self.assertEqual(metrics.Histogram().quantile(0.5), 0.0)
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    # Labels are tracked as separate series
+    def test_counters(self):
+        self.registry.increment('responses', callsign='ai')
+        self.registry.increment('responses', callsign='ai')
+        self.registry.increment('responses', callsign='gpt')
+        self.assertEqual(self.registry.counters['responses'], {(('callsign', 'ai'),): 2, (('callsign', 'gpt'),): 1})
+
+    # Timers record into histograms even if the block raises
+    def test_timer(self):
+        with self.assertRaises(ValueError):
+            with self.registry.timer('thing_seconds', model='m'):
+                raise ValueError()
+        self.assertEqual(self.registry.histograms['thing_seconds'][(('model', 'm'),)].count, 1)
+
+    # The exposition format has the right types, cumulative buckets, gauges and the EOF marker
+    def test_openmetrics(self):
+        self.registry.increment('hits')
+        self.registry.observe('wait_seconds', 0.007)
+        self.registry.register_collector(lambda: [('depth', {'channel': 5}, 3)])
+        text = self.registry.render_openmetrics()
+
+        self.assertIn('# TYPE hits counter\nhits_total 1\n', text)
+        self.assertIn('# TYPE depth gauge\ndepth{channel="5"} 3\n', text)
+        self.assertIn('wait_seconds_bucket{le="0.005"} 0\n', text)
+        self.assertIn('wait_seconds_bucket{le="0.01"} 1\n', text)
+        self.assertIn('wait_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('wait_seconds_count 1\n', text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+class TestResponseTime(unittest.TestCase):
+
+    # Streamed replies are timed until they have been read to the end, not just to their first words
+    def test_streamed(self):
+        class Streamed(ResponseInterface):
+            callsign = 'test_streamed'
+            manual_timer = True
+
+            async def respond(self):
+                return aiapi.StreamedCompletion(FakeChunks(['hello', ' there'], delay=0.02), aiapi.DS_CHAT, 0.0)
+
+        async def run():
+            stream, _ = await Streamed().get_response('', get_mock_discord_message(), None)
+            self.assertNotIn(series, metrics.registry.histograms.get('response_seconds', {}))
+            return [part async for part in stream]
+
+        series = (('callsign', 'test_streamed'),)
+        self.assertEqual(asyncio.run(run()), ['hello', ' there'])
+        timings = metrics.registry.histograms['response_seconds'][series]
+        self.assertEqual(timings.count, 1)
+        self.assertGreaterEqual(timings.sum, 0.04)
+
+class TestStats(unittest.TestCase):
+    to = stats.Stats()
+
+    def test_admins_only(self):
+        request = get_mock_discord_message()
+        request.author.guild_permissions = Mock(administrator=False)
+        actual, _ = get_response(self.to, '', request)
+        self.assertEqual(actual, "Sorry, that's for admins only. :spy:")
+
+    def test_filtered_summary(self):
+        metrics.increment('test_stats_counter')
+        request = get_mock_discord_message()
+        request.author.guild_permissions = Mock(administrator=True)
+        actual, _ = get_response(self.to, 'test_stats_counter', request)
+        self.assertEqual(actual, 'test_stats_counter: 1')
@@ -0,0 +1,55 @@
+import unittest
+import asyncio
+from lib.postlanes import PostScheduler
+
+class TestPostScheduler(unittest.TestCase):
+
+    # Posts to the same channel finish in the order they were queued
+    def test_same_channel_is_ordered(self):
+        scheduler = PostScheduler()
+        posted = []
+
+        async def post(channel, part, delay):
+            async with scheduler.lane(channel):
+                await asyncio.sleep(delay)
+                posted.append(part)
+
+        async def run():
+            await asyncio.gather(post(1, 'a', 0.02), post(1, 'b', 0.0), post(1, 'c', 0.01))
+
+        asyncio.run(run())
+        self.assertEqual(posted, ['a', 'b', 'c'])
+
+    # A slow post in one channel does not hold up another channel
+    def test_channels_run_in_parallel(self):
+        scheduler = PostScheduler()
+        posted = []
+
+        async def post(channel, delay):
+            async with scheduler.lane(channel):
+                await asyncio.sleep(delay)
+                posted.append(channel)
+
+        async def run():
+            await asyncio.gather(post(1, 0.05), post(2, 0.0))
+
+        asyncio.run(run())
+        self.assertEqual(posted, [2, 1])
+
+    # Queue depth counts the holder and all waiters, and idle lanes are dropped
+    def test_queue_depths(self):
+        scheduler = PostScheduler()
+        depths = []
+
+        async def post(channel):
+            async with scheduler.lane(channel):
+                await asyncio.sleep(0)
+                depths.append(scheduler.get_queue_depths())
+
+        async def run():
+            await asyncio.gather(post(1), post(1), post(2))
+
+        asyncio.run(run())
+        self.assertEqual(depths[0], {1: 2, 2: 1})
+        self.assertEqual(scheduler.get_queue_depths(), {})
+        self.assertEqual(scheduler.get_queue_depth(1), 0)
@@ -0,0 +1,50 @@
+import unittest
+import asyncio
+from lib.progressive import ProgressiveMessage, MESSAGE_LIMIT
+
+class FakeMessage():
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content):
+        self.content = content
+
+class TestProgressiveMessage(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.sent = []
+
+        async def send(text):
+            self.sent.append(FakeMessage(text))
+            return self.sent[-1]
+
+        self.message = ProgressiveMessage(send, send, interval=1.5, clock=lambda: self.now)
+
+    # The first update posts, and later ones edit that message in place
+    def test_edits_in_place(self):
+        asyncio.run(self.message.update('hello'))
+        asyncio.run(self.message.update('hello there'))
+        self.assertEqual([m.content for m in self.sent], ['hello there'])
+        self.assertEqual(self.message.edits, 1)
+
+    # Updates are only due once the interval has passed since the last one
+    def test_throttled(self):
+        self.assertTrue(self.message.due())
+        asyncio.run(self.message.update('hello'))
+        self.now = 1.0
+        self.assertFalse(self.message.due())
+        self.now = 1.5
+        self.assertTrue(self.message.due())
+
+    # Text past the character limit rolls over into a new message, leaving the full one alone
+    def test_rolls_over(self):
+        words = 'wiggle ' * (MESSAGE_LIMIT // 7)
+        asyncio.run(self.message.update(words))
+        asyncio.run(self.message.update(words + 'clyde clyde'))
+        first = self.sent[0].content
+        asyncio.run(self.message.update(words + 'clyde clyde clyde'))
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.sent[0].content, first)
+        self.assertLessEqual(len(first), MESSAGE_LIMIT)
+        self.assertEqual(''.join(m.content for m in self.sent), words + 'clyde clyde clyde')
@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import Mock, patch
+from lib.Responses import stats
+from lib.Responses.registry import ResponseRegistry
+from helpers import get_mock_discord_message, get_response
+
+class TestResponseRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.connected = []
+        self.registry = ResponseRegistry(lambda response, previous: self.connected.append((response, previous)),
+                                         manifest={'basic': ['Time', 'Echo']})
+
+    # Everything in the manifest is loaded and connected
+    def test_load_all(self):
+        responses = self.registry.load_all()
+        self.assertEqual(list(responses), ['time', 'echo'])
+        self.assertEqual([previous for _, previous in self.connected], [None, None])
+
+    # Reloading swaps in new responses, in the same dictionary, connected to the ones they replace
+    def test_reload(self):
+        responses = self.registry.load_all()
+        old = responses['time']
+        self.assertEqual(self.registry.reload('basic'), ['time', 'echo'])
+
+        self.assertIs(self.registry.responses, responses)
+        self.assertIsNot(responses['time'], old)
+        self.assertIs(self.connected[2][1], old)
+
+    # A module that fails to load leaves the old responses in place
+    def test_failed_reload(self):
+        responses = self.registry.load_all()
+        old = dict(responses)
+        self.registry.manifest['basic'].append('Missing')
+        with self.assertRaises(AttributeError):
+            self.registry.reload('basic')
+        self.assertEqual(responses, old)
+
+    def test_unknown_module(self):
+        with self.assertRaises(KeyError):
+            self.registry.load('nope')
+
+class TestReload(unittest.TestCase):
+    to = stats.Reload()
+
+    def setUp(self):
+        self.request = get_mock_discord_message()
+        self.request.author.guild_permissions = Mock(administrator=True)
+
+    def test_reload(self):
+        self.to.reload_module = Mock(return_value=['time', 'echo'])
+        actual, _ = get_response(self.to, 'basic', self.request)
+        self.assertEqual(actual, 'Reloaded basic: !time, !echo')
+        self.to.reload_module.assert_called_once_with('basic')
+
+    def test_reload_error(self):
+        self.to.reload_module = Mock(side_effect=SyntaxError('bad'))
+        actual, _ = get_response(self.to, 'basic', self.request)
+        self.assertTrue(actual.startswith('Could not reload basic, the old version is still running'))
+
+    def test_list_modules(self):
+        actual, _ = get_response(self.to, '', self.request)
+        self.assertTrue(actual.startswith('Reloadable modules: stats, basic'))
@@ -0,0 +1,45 @@
+import unittest
+from unittest.mock import patch
+from lib import selfawareness
+from lib.selfawareness import AiRpResponseType, SelfAwarenessState, should_redirect_response
+from tests.helpers import get_mock_discord_message
+
+class TestRedirectPrefilter(unittest.TestCase):
+
+    def setUp(self):
+        self.state = SelfAwarenessState({'enabled': True, 'server_id': 1, 'channel_id': 2, 'is_capturing_responses': True})
+        selfawareness.remember_active_location(self.state)
+        self.loads = []
+
+        def load_state():
+            self.loads.append(1)
+            selfawareness.remember_active_location(self.state)
+            return self.state
+
+        self.load_state = patch.object(selfawareness, 'load_state', load_state)
+        self.load_state.start()
+
+    def tearDown(self):
+        self.load_state.stop()
+        selfawareness.remember_active_location(None)
+
+    # DMs are answered normally, without looking for the roleplay
+    def test_dm(self):
+        message = get_mock_discord_message()
+        message.guild = None
+        self.assertEqual(should_redirect_response(True, message), AiRpResponseType.RESPOND_NORMALLY)
+        self.assertEqual(self.loads, [])
+
+    # Messages outside the roleplay channel never read the state file
+    def test_inactive_channel(self):
+        message = get_mock_discord_message(guildid=1)
+        message.channel.id = 3
+        self.assertEqual(should_redirect_response(False, message), AiRpResponseType.RESPOND_NORMALLY)
+        self.assertEqual(self.loads, [])
+
+    # Messages in the roleplay channel follow its state
+    def test_active_channel(self):
+        message = get_mock_discord_message(guildid=1)
+        message.channel.id = 2
+        self.assertEqual(should_redirect_response(False, message), AiRpResponseType.CAPTURE_RESPONSE)
+        self.assertEqual(len(self.loads), 1)
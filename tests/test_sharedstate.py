@@ -0,0 +1,104 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from lib import sharedstate
+from lib.Responses import points
+from lib.Responses.response import ResponseInterface
+
+class TestLocalState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = sharedstate.LocalState()
+
+    # Something can only be claimed once per interval
+    def test_claim(self):
+        self.assertTrue(self.state.claim('thing', 10, now=100.0))
+        self.assertFalse(self.state.claim('thing', 10, now=105.0))
+        self.assertTrue(self.state.claim('thing', 10, now=111.0))
+
+    # A negative interval never blocks
+    def test_negative_interval(self):
+        self.assertTrue(self.state.claim('thing', -20, now=100.0))
+        self.assertTrue(self.state.claim('thing', -20, now=100.0))
+
+    # Locks with the same name exclude eachother
+    def test_lock(self):
+        order = []
+        async def hold(name, n):
+            async with self.state.lock(name):
+                order.append(('start', n))
+                await asyncio.sleep(0.01)
+                order.append(('end', n))
+
+        async def run():
+            await asyncio.gather(hold('a', 1), hold('a', 2))
+        asyncio.run(run())
+        self.assertEqual(order, [('start', 1), ('end', 1), ('start', 2), ('end', 2)])
+
+class TestFileState(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'shared.db')
+        self.first = sharedstate.FileState(path)
+        self.second = sharedstate.FileState(path) # as if it was another process
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        self.directory.cleanup()
+
+    # Values and claims are seen by every user of the file
+    def test_shared(self):
+        self.first.set('name', 'dollars')
+        self.assertEqual(self.second.get('name'), 'dollars')
+        self.assertEqual(self.second.get('missing', 1), 1)
+
+        self.assertTrue(self.first.claim('cooldown', 10, now=100.0))
+        self.assertFalse(self.second.claim('cooldown', 10, now=105.0))
+
+    # The file lock is held across state objects
+    def test_lock(self):
+        order = []
+        async def hold(state, n):
+            async with state.lock('state'):
+                order.append(('start', n))
+                await asyncio.sleep(0.1)
+                order.append(('end', n))
+
+        async def run():
+            await asyncio.gather(hold(self.first, 1), hold(self.second, 2))
+        asyncio.run(run())
+        self.assertEqual(order, [('start', 1), ('end', 1), ('start', 2), ('end', 2)])
+
+class TestStateUsers(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local = sharedstate.store
+        sharedstate.use_file(os.path.join(self.directory.name, 'shared.db'))
+
+    def tearDown(self):
+        sharedstate.store.close()
+        sharedstate.store = self.local
+        self.directory.cleanup()
+
+    # Cooldowns are kept in the shared store
+    def test_cooldown(self):
+        class Slow(ResponseInterface):
+            callsign = 'test_slow'
+            cooldown = timedelta(minutes=1)
+
+        self.assertTrue(Slow().check_cooldown_timer())
+        self.assertFalse(Slow().check_cooldown_timer())
+        self.assertIn(Slow().get_cooldown_time(), (59, 60))
+
+    # The points deputy's term survives being read back from the file
+    def test_deputy_timeout(self):
+        timeout = datetime.now() + timedelta(minutes=3)
+        points.Points().deputy_timeout = timeout
+        self.assertAlmostEqual(points.Points().deputy_timeout, timeout, delta=timedelta(milliseconds=1))
+        points.Points().deputy_timeout = datetime.min
+        self.assertEqual(points.Points().deputy_timeout, datetime.min)
@@ -0,0 +1,26 @@
+import unittest
+from lib.startup import StartupReport
+
+class TestStartupReport(unittest.TestCase):
+
+    # Milestones are only recorded the first time they are reached
+    def test_mark_once(self):
+        report = StartupReport()
+        self.assertTrue(report.mark('ready'))
+        first = report.milestones['ready']
+        self.assertFalse(report.mark('ready'))
+        self.assertEqual(report.milestones['ready'], first)
+
+    # Phases are timed, and everything shows up in the report and the gauges
+    def test_report(self):
+        report = StartupReport()
+        with report.phase('responses'):
+            pass
+        report.mark('ready')
+
+        text = report.format()
+        self.assertIn('responses: took', text)
+        self.assertIn('ready: at', text)
+        names = [(name, labels) for name, labels, _ in report.collect_metrics()]
+        self.assertEqual(names, [('startup_phase_seconds', {'phase': 'responses'}),
+                                 ('startup_milestone_seconds', {'milestone': 'ready'})])
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+from lib import metrics
+from lib.supervisor import TaskSupervisor
+
+class TestTaskSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = TaskSupervisor(default_limit=2, limits={'small': 1})
+
+    # Tasks are tracked by owner until they finish
+    def test_tracking(self):
+        async def run():
+            task = self.supervisor.spawn(asyncio.sleep(0.01), owner='ai')
+            self.assertEqual(self.supervisor.get_owned('ai'), [task])
+            self.assertEqual(self.supervisor.collect_metrics(), [('background_tasks_running', {'kind': 'background'}, 1)])
+            await task
+            await asyncio.sleep(0)
+            self.assertEqual(self.supervisor.get_owned('ai'), [])
+        asyncio.run(run())
+
+    # Each kind has its own cap, and work over the cap is turned away
+    def test_limits(self):
+        async def run():
+            first = self.supervisor.spawn(asyncio.sleep(0.01), 'small')
+            second = self.supervisor.spawn(asyncio.sleep(0.01), 'small')
+            other = self.supervisor.spawn(asyncio.sleep(0.01), 'background')
+            await asyncio.gather(first, other)
+            return first, second, other
+        first, second, other = asyncio.run(run())
+        self.assertIsNotNone(first)
+        self.assertIsNone(second)
+        self.assertIsNotNone(other)
+
+    # Failures are counted instead of vanishing
+    def test_failure(self):
+        async def fail():
+            raise ValueError('oops')
+
+        async def run():
+            task = self.supervisor.spawn(fail(), 'failing')
+            await asyncio.gather(task, return_exceptions=True)
+            await asyncio.sleep(0)
+        before = metrics.registry.counters.get('background_tasks', {}).get((('kind', 'failing'), ('outcome', 'failed')), 0)
+        asyncio.run(run())
+        after = metrics.registry.counters['background_tasks'][(('kind', 'failing'), ('outcome', 'failed'))]
+        self.assertEqual(after - before, 1)
+
+    # Shutdown lets short tasks finish, cancels the rest, and turns new work away
+    def test_shutdown(self):
+        results = []
+        async def short():
+            await asyncio.sleep(0.01)
+            results.append('short')
+
+        async def run():
+            self.supervisor.spawn(short())
+            endless = self.supervisor.spawn(asyncio.sleep(60))
+            await self.supervisor.shutdown(timeout=0.1)
+            self.assertIsNone(self.supervisor.spawn(short()))
+            return endless
+        endless = asyncio.run(run())
+        self.assertEqual(results, ['short'])
+        self.assertTrue(endless.cancelled())